@@ -1,9 +1,13 @@
+from django.conf import settings
 from django.contrib import admin
 from django.contrib.admin import AdminSite
+from django.template.response import TemplateResponse
+from django.urls import path
 from django.utils.translation import ugettext_lazy as _
 
 from .models import Album, Photo, ExifData
-from .tasks import update_album_localities
+from .similarity import near_duplicate_groups
+from .tasks import update_album_localities, update_thumbnail_data
 
 
 class GalleryAdminSite(AdminSite):
@@ -95,6 +99,44 @@ class PhotoAdmin(admin.ModelAdmin):
     )
     readonly_fields = ('file_hash',)
     list_filter = ('album', 'ready')
+    actions = ['update_thumbnail_data']
+
+    def get_urls(self):
+        urls = [
+            path(
+                'near-duplicates/',
+                self.admin_site.admin_view(self.near_duplicates_view),
+                name='gallery_photo_near_duplicates'
+            ),
+        ]
+        return urls + super(PhotoAdmin, self).get_urls()
+
+    def near_duplicates_view(self, request):
+        try:
+            distance = int(request.GET.get('distance', settings.PERCEPTUAL_HASH_DISTANCE))
+        except ValueError:
+            distance = settings.PERCEPTUAL_HASH_DISTANCE
+        groups = near_duplicate_groups(distance)
+        photos = Photo.objects.select_related('album').in_bulk([photo_id for group in groups for photo_id in group])
+        # The index of this process may still have photos deleted in another one
+        groups = [[photos[photo_id] for photo_id in group if photo_id in photos] for group in groups]
+        context = dict(
+            self.admin_site.each_context(request),
+            title=_('Near-duplicate photos'),
+            opts=self.model._meta,
+            distance=distance,
+            groups=[group for group in groups if len(group) > 1],
+            missing_hashes=Photo.objects.filter(ready=True).filter(perceptual_hash='').count(),
+        )
+        return TemplateResponse(request, 'admin/gallery/photo/near_duplicates.html', context)
+
+    def update_thumbnail_data(self, request, queryset):
+        update_thumbnail_data.delay(list(queryset.values_list('id', flat=True)))
+        self.message_user(request, _('Perceptual hashes and placeholders will be updated in the background.'))
+
+    update_thumbnail_data.short_description = _(
+        'Update selected photos perceptual hashes and placeholders'
+    )
 
 
 class ExifAdmin(admin.ModelAdmin):
@@ -0,0 +1,266 @@
+import multiprocessing
+import random
+import resource
+from math import sqrt
+from os import makedirs, path, replace
+from statistics import median
+from time import perf_counter, process_time
+
+from PIL import Image
+
+from .exif_reader import ExifInfo
+from .renditions import describe_thumbnail, draft_size, render_renditions, rendition_specs
+from .utils import auto_orient, calc_hash
+
+CORPUS_MEGAPIXELS = (12, 24, 60)
+CORPUS_FORMATS = ('JPEG', 'PNG')
+ORIENTATIONS = tuple(range(1, 9))
+EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png'}
+
+
+def _icc_profile():
+    # ImageCms needs Little CMS, which isn't installed in every build
+    try:
+        from PIL import ImageCms
+    except ImportError:
+        return None
+    return ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+
+
+def corpus_entries(megapixels=CORPUS_MEGAPIXELS, formats=CORPUS_FORMATS, orientations=ORIENTATIONS, seed=0):
+    # Every orientation of every size and format, every other one with an ICC profile
+    for size in megapixels:
+        for image_format in formats:
+            for orientation in orientations:
+                icc = orientation % 2 == 0
+                name = f'{size}mp-{image_format.lower()}-o{orientation}{"-icc" if icc else ""}-{seed}'
+                yield {
+                    'name': name,
+                    'file': name + EXTENSIONS[image_format],
+                    'format': image_format,
+                    'megapixels': size,
+                    'orientation': orientation,
+                    'icc': icc,
+                }
+
+
+def generate_image(megapixels, seed):
+    # Smooth noise upscaled over gradients, which compresses roughly like a photo.
+    # The same seed always gives the same pixels.
+    width = round(sqrt(megapixels * 1e6 * 4 / 3))
+    height = round(width * 3 / 4)
+    rng = random.Random(seed)
+    small = (max(2, width // 16), max(2, height // 16))
+    bands = []
+    for band in range(3):
+        noise = Image.frombytes('L', small, rng.randbytes(small[0] * small[1]))
+        noise = noise.resize((width, height), resample=Image.BICUBIC)
+        gradient = Image.linear_gradient('L').rotate(band * 120).resize((width, height))
+        bands.append(Image.blend(noise, gradient, 0.5))
+    return Image.merge('RGB', bands)
+
+
+def build_corpus(directory, entries, seed=0, log=None):
+    # Generates the files that don't exist yet. Returns the entries that have a file.
+    makedirs(directory, exist_ok=True)
+    icc_profile = _icc_profile()
+    images = {}
+    corpus = []
+    for entry in entries:
+        if entry['icc'] and icc_profile is None:
+            if log:
+                log(f'Skipping {entry["name"]}, ICC profiles need Pillow with Little CMS')
+            continue
+        file = path.join(directory, entry['file'])
+        if not path.isfile(file):
+            if log:
+                log(f'Generating {entry["name"]}')
+            if entry['megapixels'] not in images:
+                images[entry['megapixels']] = generate_image(entry['megapixels'], seed)
+            exif = Image.Exif()
+            exif[0x0112] = entry['orientation']
+            options = {'exif': exif.tobytes()}
+            if entry['icc']:
+                options['icc_profile'] = icc_profile
+            if entry['format'] == 'JPEG':
+                options['quality'] = 92
+            else:
+                options['compress_level'] = 1
+            temp_file = file + '.tmp'
+            images[entry['megapixels']].save(temp_file, format=entry['format'], **options)
+            replace(temp_file, file)
+        corpus.append(dict(entry, file=file))
+    return corpus
+
+
+def _decode(source_file):
+    # Decodes the original like render_renditions does
+    original = Image.open(source_file)
+    if original.format == 'JPEG':
+        requested_size = draft_size(rendition_specs(), *original.size)
+        if requested_size:
+            original.draft(None, requested_size)
+    original.load()
+    return original
+
+
+def _outputs(source_file, output_dir, profile):
+    extension = path.splitext(source_file)[1].lower()
+    return [(spec, path.join(output_dir, spec.key + extension)) for spec in rendition_specs(profile)]
+
+
+def _output_bytes(rendered):
+    return sum(path.getsize(file) for spec, size, files in rendered for file in files.values())
+
+
+def _run_hash(source_file, output_dir, profile, state):
+    calc_hash(source_file)
+
+
+def _run_exif(source_file, output_dir, profile, state):
+    ExifInfo(source_file)
+
+
+def _run_decode(source_file, output_dir, profile, state):
+    _decode(source_file)
+
+
+def _run_orient(source_file, output_dir, profile, image):
+    auto_orient(image)
+
+
+def _run_renditions(source_file, output_dir, profile, state):
+    size, rendered = render_renditions(source_file, _outputs(source_file, output_dir, profile))
+    return _output_bytes(rendered)
+
+
+def _prepare_thumbnail_data(source_file, output_dir, profile):
+    size, rendered = render_renditions(source_file, _outputs(source_file, output_dir, profile))
+    return min(rendered, key=lambda rendition: rendition[0].size)[2]
+
+
+def _run_thumbnail_data(source_file, output_dir, profile, files):
+    describe_thumbnail(next(iter(files.values())))
+
+
+# Stage name: (prepare, run). prepare runs before the measurement and its result is
+# passed to run, which returns the number of bytes written if it writes files.
+STAGES = {
+    'hash': (None, _run_hash),
+    'exif': (None, _run_exif),
+    'decode': (None, _run_decode),
+    'orient': (lambda source_file, output_dir, profile: _decode(source_file), _run_orient),
+    'renditions': (None, _run_renditions),
+    'thumbnail_data': (_prepare_thumbnail_data, _run_thumbnail_data),
+}
+
+
+def _peak_rss():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_peak_rss():
+    # Linux resets the peak to the current RSS, elsewhere the peak includes prepare()
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _run_stage(connection, stage, source_file, output_dir, profile):
+    try:
+        prepare, run = STAGES[stage]
+        state = prepare(source_file, output_dir, profile) if prepare else None
+        _reset_peak_rss()
+        start_rss = _peak_rss()
+        start_wall = perf_counter()
+        start_cpu = process_time()
+        output_bytes = run(source_file, output_dir, profile, state) or 0
+        connection.send({
+            'wall_time': perf_counter() - start_wall,
+            'cpu_time': process_time() - start_cpu,
+            'peak_rss': _peak_rss(),
+            'rss_growth': _peak_rss() - start_rss,
+            'output_bytes': output_bytes,
+        })
+    except Exception as e:
+        connection.send({'error': f'{type(e).__name__}: {e}'})
+    finally:
+        connection.close()
+
+
+def measure(stage, source_file, output_dir, profile=None):
+    # Every run is a fresh process, so the peak RSS belongs to the stage alone and
+    # caches of earlier runs don't carry over
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_run_stage, args=(sender, stage, source_file, output_dir, profile))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {'error': f'Process exited with code {process.exitcode}'}
+    process.join()
+    return result
+
+
+def benchmark(corpus, stages, output_dir, repeat=3, profile=None, log=None):
+    results = []
+    for entry in corpus:
+        for stage in stages:
+            runs = [measure(stage, entry['file'], output_dir, profile) for _ in range(repeat)]
+            errors = [run['error'] for run in runs if 'error' in run]
+            result = {
+                'image': entry['name'],
+                'format': entry['format'],
+                'megapixels': entry['megapixels'],
+                'orientation': entry['orientation'],
+                'icc': entry['icc'],
+                'stage': stage,
+                'runs': repeat,
+            }
+            if errors:
+                result['error'] = errors[0]
+            else:
+                result.update(
+                    wall_time=median(run['wall_time'] for run in runs),
+                    wall_time_min=min(run['wall_time'] for run in runs),
+                    cpu_time=median(run['cpu_time'] for run in runs),
+                    peak_rss=max(run['peak_rss'] for run in runs),
+                    rss_growth=max(run['rss_growth'] for run in runs),
+                    output_bytes=runs[-1]['output_bytes'],
+                )
+            if log:
+                log(result)
+            results.append(result)
+    return results
+
+
+def stage_totals(results):
+    totals = {}
+    for result in results:
+        if 'error' in result:
+            continue
+        total = totals.setdefault(result['stage'], {'wall_time': 0, 'cpu_time': 0, 'peak_rss': 0, 'output_bytes': 0})
+        total['wall_time'] += result['wall_time']
+        total['cpu_time'] += result['cpu_time']
+        total['peak_rss'] = max(total['peak_rss'], result['peak_rss'])
+        total['output_bytes'] += result['output_bytes']
+    return totals
+
+
+def compare(results, previous):
+    # Wall time of each stage relative to an earlier run, over the images both have
+    before = {(result['image'], result['stage']): result for result in previous if 'error' not in result}
+    changes = {}
+    for result in results:
+        old = before.get((result['image'], result['stage']))
+        if 'error' in result or not old:
+            continue
+        times = changes.setdefault(result['stage'], [0, 0])
+        times[0] += old['wall_time']
+        times[1] += result['wall_time']
+    return {stage: new / old for stage, (old, new) in changes.items() if old}
@@ -0,0 +1,214 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from os import link, makedirs, path, remove, replace, scandir
+from shutil import copy2, move
+from time import perf_counter, sleep
+
+from django.conf import settings
+from django.utils.text import slugify
+
+from .models import SCAN_EXTENSIONS, Album, Photo
+from .tasks import post_process_photos
+from .utils import calc_hash, file_fingerprint
+
+TRANSFER_MODES = ('copy', 'hardlink', 'move')
+
+PHASES = ('scan', 'albums', 'transfer', 'insert', 'dispatch')
+
+
+def walk_tree(root):
+    # (directory relative to root, [photo file names]) of root and every directory
+    # under it, parents before their subdirectories. Hidden entries are left out.
+    directories = []
+    pending = ['']
+    while pending:
+        relative = pending.pop()
+        files = []
+        subdirectories = []
+        with scandir(path.join(root, relative)) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(path.join(relative, entry.name))
+                elif path.splitext(entry.name)[1].lower() in SCAN_EXTENSIONS and entry.is_file():
+                    files.append(entry.name)
+        directories.append((relative, sorted(files)))
+        pending.extend(sorted(subdirectories, reverse=True))
+    return directories
+
+
+def _unique(value, exists, separator):
+    # value, or value with the lowest number from 2 up that isn't taken
+    candidate = value
+    number = 2
+    while exists(candidate):
+        candidate = f'{value}{separator}{number}'
+        number += 1
+    return candidate
+
+
+def create_album(name, parent):
+    title = _unique(name, lambda title: Album.objects.filter(title=title).exists(), ' ')
+    directory = _unique(
+        slugify(title) or 'album', lambda directory: Album.objects.filter(directory=directory).exists(), '-'
+    )
+    return Album.objects.create(title=title, directory=directory, parent=parent)
+
+
+def transfer(source_file, target_file, mode):
+    # Puts the file in the album directory and returns its (file hash, fingerprint).
+    # Files that were transferred by an interrupted run are hashed again.
+    if mode == 'move':
+        if path.exists(source_file):
+            move(source_file, target_file)
+    elif mode == 'hardlink':
+        if not (path.exists(target_file) and path.samefile(source_file, target_file)):
+            if path.exists(target_file):
+                remove(target_file)
+            link(source_file, target_file)
+    else:
+        copy2(source_file, target_file)
+    return calc_hash(target_file), file_fingerprint(target_file)
+
+
+class Checkpoint:
+    # Albums created and directories imported so far, and the last photo id queued for
+    # post-processing. Saved after every step, so an interrupted import continues
+    # where it stopped.
+    def __init__(self, file, source):
+        self.file = file
+        data = {}
+        if path.isfile(file):
+            with open(file) as f:
+                data = json.load(f)
+            if data['source'] != source:
+                raise ValueError(f'{file} is the checkpoint of another import: {data["source"]}')
+        self.source = source
+        self.albums = data.get('albums', {})
+        self.imported = set(data.get('imported', []))
+        self.dispatched = data.get('dispatched', 0)
+
+    def save(self):
+        makedirs(path.dirname(self.file), exist_ok=True)
+        temp_file = self.file + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump({
+                'source': self.source,
+                'albums': self.albums,
+                'imported': sorted(self.imported),
+                'dispatched': self.dispatched,
+            }, f)
+        replace(temp_file, self.file)
+
+
+class Phase:
+    def __init__(self):
+        self.items = 0
+        self.seconds = 0
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.seconds += perf_counter() - self.start
+
+    @property
+    def rate(self):
+        return self.items / self.seconds if self.seconds else 0
+
+
+class TreeImporter:
+    # Imports a directory tree as nested albums, one album per directory
+    def __init__(self, source, checkpoint, parent=None, mode='copy', workers=4, chunk_size=200, rate=0,
+                 queue='bulk', log=None):
+        self.source = path.abspath(source)
+        self.checkpoint = checkpoint
+        self.parent = parent
+        self.mode = mode
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.rate = rate
+        self.queue = queue
+        self.log = log or (lambda message: None)
+        self.errors = []
+        self.phases = {phase: Phase() for phase in PHASES}
+
+    def run(self, dispatch=True):
+        with self.phases['scan'] as phase:
+            directories = walk_tree(self.source)
+            phase.items = sum(len(files) for relative, files in directories)
+        self.log(f'Found {self.phases["scan"].items} photos in {len(directories)} directories')
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for relative, files in directories:
+                album = self.get_album(relative)
+                if relative not in self.checkpoint.imported:
+                    self.import_directory(executor, album, relative, files)
+        if dispatch:
+            self.dispatch()
+        return self.phases
+
+    def get_album(self, relative):
+        album_id = self.checkpoint.albums.get(relative)
+        album = Album.objects.filter(pk=album_id).first() if album_id else None
+        if not album:
+            # Parents are imported first, so they're in the checkpoint already
+            parent = self.get_album(path.dirname(relative)) if relative else self.parent
+            with self.phases['albums'] as phase:
+                album = create_album(path.basename(relative or self.source), parent)
+                phase.items += 1
+            self.checkpoint.albums[relative] = album.pk
+            self.checkpoint.save()
+            self.log(f'Created album {album.title}')
+        return album
+
+    def import_directory(self, executor, album, relative, files):
+        target_dir = path.join(settings.MEDIA_ROOT, album.media_dir)
+        makedirs(target_dir, exist_ok=True)
+        with self.phases['transfer'] as phase:
+            futures = [
+                (name, executor.submit(
+                    transfer, path.join(self.source, relative, name), path.join(target_dir, name), self.mode
+                ))
+                for name in files
+            ]
+            file_hashes = {}
+            for name, future in futures:
+                # A file that can't be read is left out and the others are imported
+                try:
+                    file_hashes[path.join(album.media_dir, name)] = future.result()
+                except OSError as e:
+                    self.errors.append(f'Failed to import {path.join(relative, name)}: {e}')
+            phase.items += len(file_hashes)
+        # Files moved by a run that stopped before adding them are no longer in the source
+        moved = [file for file in album.get_photos_in_dir() if path.basename(file) not in files]
+        with self.phases['insert'] as phase:
+            photo_ids, errors = album.add_photo_files(sorted(list(file_hashes) + moved), file_hashes)
+            phase.items += len(photo_ids)
+        if errors:
+            self.errors.append(errors)
+        self.checkpoint.imported.add(relative)
+        self.checkpoint.save()
+        self.log(f'Imported {len(photo_ids)} photos to {album.title}')
+
+    def dispatch(self):
+        # Queues post-processing in chunks of chunk_size photos, at most rate photos
+        # per second if rate is set
+        photo_ids = list(
+            Photo.objects
+            .filter(album_id__in=self.checkpoint.albums.values(), ready=False, id__gt=self.checkpoint.dispatched)
+            .order_by('id')
+            .values_list('id', flat=True)
+        )
+        with self.phases['dispatch'] as phase:
+            for index in range(0, len(photo_ids), self.chunk_size):
+                chunk = photo_ids[index:index + self.chunk_size]
+                started = perf_counter()
+                post_process_photos.delay(chunk, self.queue)
+                self.checkpoint.dispatched = chunk[-1]
+                self.checkpoint.save()
+                phase.items += len(chunk)
+                if self.rate:
+                    sleep(max(len(chunk) / self.rate - (perf_counter() - started), 0))
+        self.log(f'Queued {self.phases["dispatch"].items} photos for post-processing')
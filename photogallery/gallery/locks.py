@@ -0,0 +1,32 @@
+from uuid import uuid4
+
+from .redis_client import call
+
+KEY_PREFIX = 'gallery:lock:'
+
+# Deletes the key only if it still holds the token, so an expired lock that another
+# job has taken since isn't released
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def acquire(name, timeout):
+    # Returns a token for release() if the lock was free, otherwise None. The lock
+    # expires after timeout seconds in case its holder never releases it. Without
+    # Redis every lock is free: the same job may run twice, but no job is lost.
+    token = uuid4().hex
+    if call(lambda redis: redis.set(KEY_PREFIX + name, token, nx=True, ex=timeout), True):
+        return token
+    return None
+
+
+def release(name, token=None):
+    # Without a token the lock is released whoever holds it
+    if token is None:
+        call(lambda redis: redis.delete(KEY_PREFIX + name), None)
+    else:
+        call(lambda redis: redis.eval(RELEASE_SCRIPT, 1, KEY_PREFIX + name, token), None)
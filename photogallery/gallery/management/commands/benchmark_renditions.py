@@ -0,0 +1,104 @@
+import json
+import platform
+import subprocess
+import tempfile
+from datetime import datetime
+from os import cpu_count, path
+
+import PIL
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from gallery.benchmark import (
+    CORPUS_FORMATS, CORPUS_MEGAPIXELS, ORIENTATIONS, STAGES, benchmark, build_corpus, compare, corpus_entries,
+    stage_totals
+)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        'Measures wall time, CPU time, peak RSS and output size of each stage of the rendition '
+        'pipeline on a generated corpus and writes the results as JSON'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corpus-dir', default=path.join(settings.BASE_DIR, 'cache', 'benchmark'),
+                            help='Directory for the generated images, reused by later runs')
+        parser.add_argument('--megapixels', type=float, nargs='+', default=list(CORPUS_MEGAPIXELS))
+        parser.add_argument('--formats', nargs='+', choices=CORPUS_FORMATS, default=list(CORPUS_FORMATS))
+        parser.add_argument('--orientations', type=int, nargs='+', choices=ORIENTATIONS, default=list(ORIENTATIONS))
+        parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES))
+        parser.add_argument('--repeat', type=int, default=3, help='Runs of each stage, the median is reported')
+        parser.add_argument('--profile', help='Encoder profile of the renditions instead of the configured ones')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='JSON file for the results, printed to stdout by default')
+        parser.add_argument('--compare', help='JSON file of an earlier run to compare the wall times with')
+
+    def handle(self, *args, **options):
+        if options['profile'] and options['profile'] not in settings.RENDITION_ENCODER_PROFILES:
+            raise CommandError(f'Unknown encoder profile: {options["profile"]}')
+        previous = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                previous = json.load(f)
+
+        megapixels = [int(size) if size.is_integer() else size for size in options['megapixels']]
+        entries = corpus_entries(megapixels, options['formats'], options['orientations'], options['seed'])
+        corpus = build_corpus(options['corpus_dir'], entries, options['seed'], log=self.stderr.write)
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            results = benchmark(
+                corpus, options['stages'], output_dir, options['repeat'], options['profile'], log=self.log_result
+            )
+
+        report = {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'machine': {
+                'platform': platform.platform(),
+                'processor': platform.processor(),
+                'cpu_count': cpu_count(),
+                'python': platform.python_version(),
+                'pillow': PIL.__version__,
+            },
+            'settings': {
+                'profile': options['profile'],
+                'encoder_profile': settings.RENDITION_ENCODER_PROFILE,
+                'rendition_threads': settings.RENDITION_THREADS,
+                'extra_formats': settings.RENDITION_EXTRA_FORMATS,
+                'repeat': options['repeat'],
+                'seed': options['seed'],
+            },
+            'totals': stage_totals(results),
+            'results': results,
+        }
+        if previous:
+            report['compared_to'] = previous.get('commit')
+            report['relative_wall_time'] = compare(results, previous['results'])
+            for stage, ratio in report['relative_wall_time'].items():
+                self.stderr.write(f'{stage}: {ratio:.2f}x the wall time of {previous.get("commit") or options["compare"]}')
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+        else:
+            self.stdout.write(json.dumps(report, indent=2))
+
+    def log_result(self, result):
+        if 'error' in result:
+            self.stderr.write(f'{result["image"]} {result["stage"]}: {result["error"]}')
+        else:
+            self.stderr.write(
+                f'{result["image"]} {result["stage"]}: {result["wall_time"] * 1000:.0f} ms, '
+                f'CPU {result["cpu_time"] * 1000:.0f} ms, peak RSS {result["peak_rss"] / 2 ** 20:.0f} MiB, '
+                f'{result["output_bytes"]} bytes'
+            )
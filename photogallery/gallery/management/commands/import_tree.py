@@ -0,0 +1,70 @@
+import hashlib
+from os import cpu_count, path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from gallery.importer import PHASES, TRANSFER_MODES, Checkpoint, TreeImporter
+from gallery.models import Album
+
+
+class Command(BaseCommand):
+    help = (
+        'Imports a directory tree as nested albums. The photos are copied into the album '
+        'directories, hashed in parallel, added in bulk and queued for post-processing in '
+        'chunks. Running the same import again continues where it stopped.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='Directory to import, which becomes the top album')
+        parser.add_argument('--parent', help='Directory name of an existing album to import the tree into')
+        parser.add_argument('--mode', choices=TRANSFER_MODES, default='copy',
+                            help='How the photos are put into the album directories')
+        parser.add_argument('--workers', type=int, default=cpu_count() or 1,
+                            help='Threads that copy and hash the photos')
+        parser.add_argument('--chunk-size', type=int, default=200,
+                            help='Photos queued for post-processing at a time')
+        parser.add_argument('--rate', type=float, default=20,
+                            help='Photos queued for post-processing per second, 0 for no limit')
+        parser.add_argument('--queue', default='bulk', help='Queue of the post-processing tasks')
+        parser.add_argument('--no-dispatch', action='store_true',
+                            help="Don't queue post-processing yet, a later run queues it")
+        parser.add_argument('--checkpoint', help='Progress file, by default one per source in cache/import')
+
+    def handle(self, *args, **options):
+        source = path.abspath(options['source'])
+        if not path.isdir(source):
+            raise CommandError(f'Not a directory: {source}')
+        parent = None
+        if options['parent']:
+            parent = Album.objects.filter(directory=options['parent']).first()
+            if not parent:
+                raise CommandError(f'Unknown album: {options["parent"]}')
+        checkpoint_file = options['checkpoint'] or path.join(
+            settings.BASE_DIR, 'cache', 'import', hashlib.sha256(source.encode()).hexdigest()[:16] + '.json'
+        )
+        try:
+            checkpoint = Checkpoint(checkpoint_file, source)
+        except ValueError as e:
+            raise CommandError(e)
+        importer = TreeImporter(
+            source,
+            checkpoint,
+            parent=parent,
+            mode=options['mode'],
+            workers=options['workers'],
+            chunk_size=options['chunk_size'],
+            rate=options['rate'],
+            queue=options['queue'],
+            log=self.stderr.write
+        )
+        phases = importer.run(dispatch=not options['no_dispatch'])
+        for errors in importer.errors:
+            self.stderr.write(errors)
+        for name in PHASES:
+            phase = phases[name]
+            unit = 'albums' if name == 'albums' else 'files'
+            self.stdout.write(
+                f'{name}: {phase.items} {unit} in {phase.seconds:.1f} s, {phase.rate:.0f} {unit}/s'
+            )
+        self.stdout.write(f'Checkpoint: {checkpoint_file}')
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from gallery.watcher import watch
+
+
+class Command(BaseCommand):
+    help = (
+        'Adds files copied into the album directories as photos. Watches the directories '
+        'with inotify if watchdog is installed and polls them otherwise.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--settle-time', type=float, default=5,
+                            help='Seconds a file must be unmodified before it is added')
+        parser.add_argument('--poll-interval', type=float, default=10,
+                            help='Seconds between checks of the album directories when polling')
+        parser.add_argument('--poll', action='store_true', help='Poll even if inotify is available')
+
+    def handle(self, *args, **options):
+        try:
+            watch(options['settle_time'], options['poll_interval'], use_inotify=not options['poll'])
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.18 on 2026-10-18 18:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0034_auto_20180414_1756'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='renditions',
+            field=models.JSONField(blank=True, default=dict, verbose_name='Renditions'),
+        ),
+    ]
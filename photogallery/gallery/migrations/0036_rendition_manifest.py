@@ -0,0 +1,65 @@
+from os import path
+
+from PIL import Image
+from django.conf import settings
+from django.db import migrations
+
+LEGACY_RENDITIONS = {
+    'thumbnail': 'thumbnails',
+    'hidpi_thumbnail': 'thumbnails',
+    'preview': 'previews',
+    'hidpi_preview': 'previews',
+}
+
+
+def legacy_sources(photo, name):
+    # Files of a rendition from the format-only manifest or the legacy ImageField
+    sources = photo.renditions.get(name)
+    if sources and 'group' not in sources:
+        return sources
+    file = getattr(photo, f'{name}_img')
+    if file:
+        mime_type = 'image/png' if file.name.lower().endswith('.png') else 'image/jpeg'
+        return {mime_type: file.name}
+    return None
+
+
+def build_manifest(photo):
+    manifest = {}
+    for name, group in LEGACY_RENDITIONS.items():
+        sources = legacy_sources(photo, name)
+        if not sources:
+            continue
+        try:
+            # Only reads the image header
+            with Image.open(path.join(settings.MEDIA_ROOT, next(iter(sources.values())))) as image:
+                width, height = image.size
+        except OSError:
+            continue
+        manifest[name] = {'group': group, 'width': width, 'height': height, 'sources': sources}
+    return manifest
+
+
+def forwards(apps, schema_editor):
+    Photo = apps.get_model('gallery', 'Photo')
+    batch = []
+    for photo in Photo.objects.all().iterator():
+        if photo.renditions and all('group' in rendition for rendition in photo.renditions.values()):
+            continue
+        photo.renditions = build_manifest(photo)
+        batch.append(photo)
+        if len(batch) >= 500:
+            Photo.objects.bulk_update(batch, ['renditions'])
+            batch = []
+    Photo.objects.bulk_update(batch, ['renditions'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0035_photo_renditions'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
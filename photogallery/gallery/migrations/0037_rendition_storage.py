@@ -0,0 +1,34 @@
+# Generated by Django 3.2.18 on 2026-10-18 18:52
+
+from django.db import migrations, models
+import gallery.renditions
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0036_rendition_manifest'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='photo',
+            name='hidpi_preview_img',
+            field=models.ImageField(blank=True, max_length=150, storage=gallery.renditions.RenditionStorage(), upload_to='', verbose_name='High DPI preview image'),
+        ),
+        migrations.AlterField(
+            model_name='photo',
+            name='hidpi_thumbnail_img',
+            field=models.ImageField(blank=True, max_length=150, storage=gallery.renditions.RenditionStorage(), upload_to='', verbose_name='High DPI thumbnail image'),
+        ),
+        migrations.AlterField(
+            model_name='photo',
+            name='preview_img',
+            field=models.ImageField(blank=True, max_length=150, storage=gallery.renditions.RenditionStorage(), upload_to='', verbose_name='Preview image'),
+        ),
+        migrations.AlterField(
+            model_name='photo',
+            name='thumbnail_img',
+            field=models.ImageField(blank=True, max_length=150, storage=gallery.renditions.RenditionStorage(), upload_to='', verbose_name='Thumbnail image'),
+        ),
+    ]
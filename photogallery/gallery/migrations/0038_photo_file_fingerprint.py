@@ -0,0 +1,18 @@
+# Generated by Django 3.2.18 on 2026-10-18 18:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0037_rendition_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='file_fingerprint',
+            field=models.CharField(blank=True, max_length=100, verbose_name='File fingerprint'),
+        ),
+    ]
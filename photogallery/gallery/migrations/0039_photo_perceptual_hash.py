@@ -0,0 +1,18 @@
+# Generated by Django 3.2.18 on 2026-10-18 18:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0038_photo_file_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='perceptual_hash',
+            field=models.CharField(blank=True, max_length=16, verbose_name='Perceptual hash'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.18 on 2026-10-18 19:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0039_photo_perceptual_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='placeholder',
+            field=models.TextField(blank=True, verbose_name='Placeholder'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 3.2.18 on 2026-10-18 19:04
+
+from os import path
+
+from PIL import Image
+from django.conf import settings
+from django.db import migrations, models
+
+
+def oriented_size(image_file):
+    # Only reads the image header. EXIF orientations 5-8 rotate the photo by 90 degrees.
+    with Image.open(image_file) as image:
+        width, height = image.size
+        if image.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+            return height, width
+        return width, height
+
+
+def forwards(apps, schema_editor):
+    Photo = apps.get_model('gallery', 'Photo')
+    batch = []
+    for photo in Photo.objects.filter(width__isnull=True).iterator():
+        try:
+            photo.width, photo.height = oriented_size(path.join(settings.MEDIA_ROOT, photo.image.name))
+        except OSError:
+            continue
+        batch.append(photo)
+        if len(batch) >= 500:
+            Photo.objects.bulk_update(batch, ['width', 'height'])
+            batch = []
+    Photo.objects.bulk_update(batch, ['width', 'height'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0040_photo_placeholder'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='height',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='Height'),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='width',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='Width'),
+        ),
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.2.18 on 2026-10-18 19:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0041_photo_size'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Upload',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=255, verbose_name='File name')),
+                ('size', models.PositiveBigIntegerField(verbose_name='Size')),
+                ('content_type', models.CharField(max_length=255, verbose_name='Content type')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+                ('completed', models.DateTimeField(blank=True, null=True, verbose_name='Completed')),
+                ('album', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='uploads', to='gallery.album', verbose_name='Album')),
+                ('duplicate', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='gallery.photo', verbose_name='Duplicate of')),
+                ('photo', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='gallery.photo', verbose_name='Photo')),
+            ],
+            options={
+                'verbose_name': 'upload',
+                'verbose_name_plural': 'uploads',
+                'ordering': ('created',),
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.18 on 2026-10-18 20:03
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('gallery', '0042_upload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upload',
+            name='user',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='uploads', to=settings.AUTH_USER_MODEL, verbose_name='User'),
+        ),
+    ]
@@ -1,31 +1,51 @@
+import fcntl
 from datetime import date
-from glob import glob
-from json import loads as jsonloads
+from urllib.parse import urlencode
 from logging import getLogger
-from os import path, makedirs, chdir
+from os import SEEK_END, path, makedirs, remove, scandir, stat
 from shutil import rmtree
 from string import ascii_lowercase
+from uuid import uuid4
 
-from PIL import Image, ImageOps
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.template.defaultfilters import slugify
 from django.urls import reverse
 from django.utils.crypto import get_random_string
 from django.utils.functional import cached_property
 from django.utils.safestring import mark_safe
 from django.utils.text import slugify
-from django.utils.timezone import make_aware, get_current_timezone
+from django.utils.timezone import make_aware, get_current_timezone, now
 from django.utils.translation import ugettext_lazy as _
-from django_celery_results.models import TaskResult
 
+from . import locks, progress
 from .exif_reader import ExifInfo
-from .tasks import post_process_image
-from .utils import calc_hash, auto_orient, get_geocoding
+from .renditions import (
+    MIME_TYPES, RENDITIONS_DIR, RenditionStorage, describe_thumbnail, extra_formats, negotiate, render_renditions,
+    rendition_dir, rendition_specs, resize_query, select_rendition
+)
+from .tasks import post_process_image, post_process_photos
+from .uploads import CHUNK_BUFFER_SIZE, UPLOAD_STAGING_DIR, StagedUploadedFile, UploadConflict
+from .utils import calc_hash, file_fingerprint, get_geocoding
 
 log = getLogger(__name__)
 
+# Renditions that are also stored in their own ImageField on Photo
+LEGACY_RENDITION_FIELDS = ('preview', 'hidpi_preview', 'thumbnail', 'hidpi_thumbnail')
+
+# Files that Album.scan_new_photos adds as photos
+SCAN_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+# Rows per query when a scan adds photos
+SCAN_BATCH_SIZE = 500
+
+
+def rendition_files(renditions):
+    # The files of a rendition manifest, relative to MEDIA_ROOT
+    return {file for rendition in renditions.values() for file in rendition['sources'].values()}
+
 
 def validate_album_title(value):
     invalid_names = ['new']
@@ -46,6 +66,29 @@ def validate_photo_title(value):
         )
 
 
+def unique_photo_slugs(titles):
+    # The slugs Photo.save would give the titles, found with a few queries instead of
+    # one per photo. Taken slugs get a random suffix like in Photo.save.
+    slugs = [None] * len(titles)
+    bases = [slugify(title) for title in titles]
+    candidates = dict(enumerate(bases))
+    taken = set()
+    while candidates:
+        values = list(set(candidates.values()))
+        for index in range(0, len(values), SCAN_BATCH_SIZE):
+            batch = values[index:index + SCAN_BATCH_SIZE]
+            taken.update(Photo.objects.filter(slug__in=batch).values_list('slug', flat=True))
+        retry = {}
+        for index, slug in candidates.items():
+            if slug in taken:
+                retry[index] = bases[index] + '-' + get_random_string(length=5, allowed_chars=ascii_lowercase)
+            else:
+                taken.add(slug)
+                slugs[index] = slug
+        candidates = retry
+    return slugs
+
+
 class Album(models.Model):
     sort_order_choices = (
         ('date', _('Date (ascending)')),
@@ -156,58 +199,130 @@ class Album(models.Model):
 
     @cached_property
     def pending_updates(self):
-        task = (
-            TaskResult.objects
-            .filter(status='PROGRESS')
-            .filter(result__contains=self.directory)
-            .first()
-        )
-        if task:
-            content = jsonloads(task.result)
-            if content['album'] == self.directory:
-                return content['total'] - content['current']
-        return 0
+        # Photos left in the running album update, see tasks.async_save_photo
+        return progress.pending(self.directory)
     pending_updates.short_description = _("Photos pending updates")
 
+    def processing_state(self):
+        # Counts shown while the album is processed, see views.AlbumProgressStreamView
+        return {
+            'post_processing': Photo.objects.filter(album_id=self.id, ready=False).count(),
+            **progress.summary(self.directory),
+        }
+
     @property
     def media_dir(self):
         album_dir = path.join('photos', self.directory)
         return album_dir
 
-    def get_photos_in_dir(self):
-        chdir(settings.MEDIA_ROOT)
-        extensions = ['*.jpg', '*.jpeg', '*.png']
+    def get_photos_in_dir(self, modified_before=None):
+        # Paths relative to MEDIA_ROOT, as they're stored in Photo.image. Hidden files
+        # are left out, like partial uploads of some SFTP clients. With modified_before,
+        # files modified at or after that timestamp are left out too.
         photos = []
-        for ext in extensions:
-            photos.extend(glob(path.join(self.media_dir, ext)))
-            photos.extend(glob(path.join(self.media_dir, ext.upper())))
-        return photos
-
-    def scan_new_photos(self):
-        existing_photos = (
-            Photo.objects
-            .all()
-            .filter(album_id=self.pk)
-            .values_list('image', flat=True)
-        )
-        all_photos = self.get_photos_in_dir()
-        new_photos = 0
+        try:
+            with scandir(path.join(settings.MEDIA_ROOT, self.media_dir)) as entries:
+                for entry in entries:
+                    extension = path.splitext(entry.name)[1].lower()
+                    if extension not in SCAN_EXTENSIONS or entry.name.startswith('.') or not entry.is_file():
+                        continue
+                    if modified_before is not None and entry.stat().st_mtime >= modified_before:
+                        continue
+                    photos.append(path.join(self.media_dir, entry.name))
+        except FileNotFoundError:
+            pass
+        return sorted(photos)
+
+    def scan_new_photos(self, modified_before=None):
+        # Adds the files in the album directory that aren't photos yet. They're hashed
+        # and processed by the tasks, so large directories are added in seconds.
+        # modified_before leaves out files that may still be written, see watcher.py.
+        photo_ids, errors = self.add_photo_files(self.get_photos_in_dir(modified_before))
+        if photo_ids:
+            transaction.on_commit(lambda: post_process_photos.delay(photo_ids))
+        return len(photo_ids), errors
+
+    def add_photo_files(self, files, file_hashes=None):
+        # Adds files relative to MEDIA_ROOT that aren't photos of the album yet, without
+        # processing them. file_hashes has the (file hash, fingerprint) of files that
+        # were hashed already. Returns the ids of the new photos and the errors.
+        existing_photos = set(Photo.objects.filter(album_id=self.pk).values_list('image', flat=True))
+        file_hashes = file_hashes or {}
+        max_file_length = Photo._meta.get_field('image').max_length
+        max_title_length = Photo._meta.get_field('title').max_length
+        new_files = []
         errors = ''
-        for photo in all_photos:
-            if photo not in existing_photos:
-                try:
-                    new_photo = Photo(
-                        title=path.splitext(path.basename(photo))[0],
+        for file in files:
+            if file in existing_photos:
+                continue
+            title = path.splitext(path.basename(file))[0]
+            if len(file) > max_file_length or len(title) > max_title_length:
+                errors += _('Failed to add photo %(filename)s to album.') % {'filename': path.basename(file)}
+                log.error(f'Failed to add photo {path.basename(file)}: the file name is too long')
+                continue
+            new_files.append((file, title))
+        if not new_files:
+            return [], errors
+        slugs = unique_photo_slugs([title for file, title in new_files])
+        with transaction.atomic():
+            photos = Photo.objects.bulk_create(
+                [
+                    Photo(
+                        title=title,
+                        slug=slug,
                         album_id=self.pk,
-                        image=photo,
-                        ready=False)
-                    new_photo.save()
-                    new_photos += 1
-                except Exception as e:
-                    errors += _('Failed to add photo %(filename)s to album.') \
-                              % {'filename': path.basename(photo)}
-                    log.error(f'Failed to add photo {path.basename(photo)}: {e}')
-        return new_photos, errors
+                        image=file,
+                        ready=False,
+                        file_hash=file_hashes.get(file, ('', ''))[0],
+                        file_fingerprint=file_hashes.get(file, ('', ''))[1]
+                    )
+                    for (file, title), slug in zip(new_files, slugs)
+                ],
+                batch_size=SCAN_BATCH_SIZE
+            )
+        # bulk_create only sets the ids on databases that return the inserted rows
+        if connection.features.can_return_rows_from_bulk_insert:
+            return [photo.pk for photo in photos], errors
+        added = {file for file, title in new_files}
+        photo_ids = [
+            pk for pk, image in Photo.objects.filter(album_id=self.pk, ready=False).values_list('id', 'image')
+            if image in added
+        ]
+        return photo_ids, errors
+
+    def add_uploaded_photo(self, file):
+        # Returns the new photo, or None when the file is a duplicate that is skipped,
+        # and the existing photo with the same file hash if there is one
+        file_hash = getattr(file, 'file_hash', None)
+        duplicate = None
+        if file_hash and settings.UPLOAD_DUPLICATES != 'process':
+            duplicates = list(
+                Photo.objects
+                .filter(file_hash=file_hash)
+                .filter(ready=True)
+                .select_related('exifdata')
+            )
+            # One whose renditions can be linked if there is one
+            duplicate = next((photo for photo in duplicates if photo.has_shared_renditions()), None)
+            duplicate = duplicate or next(iter(duplicates), None)
+        if duplicate and settings.UPLOAD_DUPLICATES == 'skip':
+            log.info(f'Skipped {file.name}, it is a duplicate of photo {duplicate.pk}')
+            return None, duplicate
+        photo = Photo(
+            title=path.splitext(file.name)[0],
+            album_id=self.pk,
+            ready=False,
+            image=file
+        )
+        linked = duplicate is not None and duplicate.has_shared_renditions()
+        if linked:
+            photo.link_renditions(duplicate)
+        photo.save()
+        if linked and hasattr(duplicate, 'exifdata'):
+            exif_data = duplicate.exifdata
+            exif_data.photo = photo
+            exif_data.save(force_insert=True)
+        return photo, duplicate
 
     def admin_thumbnail(self):
         if self.album_cover_id:
@@ -264,6 +379,11 @@ class Photo(models.Model):
         max_length=255,
         blank=True
     )
+    file_fingerprint = models.CharField(
+        _('File fingerprint'),
+        max_length=100,
+        blank=True
+    )
     ready = models.BooleanField(
         _('Ready'),
         default=True
@@ -271,22 +391,52 @@ class Photo(models.Model):
     preview_img = models.ImageField(
         _('Preview image'),
         blank=True,
-        max_length=150
+        max_length=150,
+        storage=RenditionStorage()
     )
     hidpi_preview_img = models.ImageField(
         _('High DPI preview image'),
         blank=True,
-        max_length=150
+        max_length=150,
+        storage=RenditionStorage()
     )
     thumbnail_img = models.ImageField(
         _('Thumbnail image'),
         blank=True,
-        max_length=150
+        max_length=150,
+        storage=RenditionStorage()
     )
     hidpi_thumbnail_img = models.ImageField(
         _('High DPI thumbnail image'),
         blank=True,
-        max_length=150)
+        max_length=150,
+        storage=RenditionStorage()
+    )
+    renditions = models.JSONField(
+        _('Renditions'),
+        default=dict,
+        blank=True
+    )
+    perceptual_hash = models.CharField(
+        _('Perceptual hash'),
+        max_length=16,
+        blank=True
+    )
+    placeholder = models.TextField(
+        _('Placeholder'),
+        blank=True
+    )
+    # Size of the original after EXIF orientation, so it's never opened just for its size
+    width = models.PositiveIntegerField(
+        _('Width'),
+        blank=True,
+        null=True
+    )
+    height = models.PositiveIntegerField(
+        _('Height'),
+        blank=True,
+        null=True
+    )
 
     class Meta:
         verbose_name = _('photo')
@@ -300,40 +450,33 @@ class Photo(models.Model):
         self.slug = slugify(self.title)
         if self.is_existing_slug():
             self.slug = self.slug + '-' + get_random_string(length=5, allowed_chars=ascii_lowercase)
+        # Uploads are hashed while they're received, see uploads.HashingUploadHandler
+        uploaded_hash = None if self.image._committed else getattr(self.image.file, 'file_hash', None)
         super(Photo, self).save(*args, **kwargs)
-        if calc_hash(self.image.path) != self.file_hash:
-            self.file_hash = calc_hash(self.image.path)
+        # The original is only hashed again when its size, mtime or inode changed
+        fingerprint = file_fingerprint(self.image.path)
+        if fingerprint == self.file_fingerprint and self.file_hash:
+            return
+        file_hash = uploaded_hash or calc_hash(self.image.path)
+        self.file_fingerprint = fingerprint
+        if file_hash == self.file_hash:
+            Photo.objects.filter(pk=self.pk).update(file_fingerprint=fingerprint)
+        else:
+            self.file_hash = file_hash
             if not self.ready:
-                post_process_image.delay(self.id)
+                # Renditions are stored by file hash, so the task needs it saved first
+                Photo.objects.filter(pk=self.pk).update(file_hash=file_hash, file_fingerprint=fingerprint)
+                # A task that's still queued reads the new file, so it isn't queued again
+                if locks.acquire(f'post-process:{self.id}', settings.PHOTO_JOB_TIMEOUT):
+                    post_process_image.delay(self.id)
             else:
-                self.create_previews()
-                self.create_thumbnails()
+                self.create_renditions()
                 self.save_exif_data()
                 super(Photo, self).save(*args, **kwargs)
 
     def get_absolute_url(self):
         return reverse('gallery:photo', kwargs={'slug': self.slug})
 
-    @property
-    def preview_filename(self):
-        fname = path.basename(self.image.name)
-        return 'preview_' + fname
-
-    @property
-    def hidpi_preview_filename(self):
-        fname = path.basename(self.image.name)
-        return 'hidpipreview_' + fname
-
-    @property
-    def thumbnail_img_filename(self):
-        fname = path.basename(self.image.name)
-        return 'thumb_' + fname
-
-    @property
-    def hidpi_thumbnail_img_filename(self):
-        fname = path.basename(self.image.name)
-        return 'hidpithumb_' + fname
-
     @cached_property
     def current_ordering(self):
         photo_list = list(
@@ -364,85 +507,211 @@ class Photo(models.Model):
             return Photo.objects.get(pk=previous_item)
 
     def preview_dir(self):
+        # Renditions created before they were stored by file hash
         preview_dir = path.join(settings.MEDIA_ROOT, 'previews', self.album.directory)
         if not path.exists(preview_dir):
             makedirs(preview_dir)
         return path.relpath(preview_dir, start=settings.MEDIA_ROOT)
 
-    def create_preview_image(self, size, quality, output_file):
-        image = auto_orient(Image.open(self.image.path))
-        max_size = (size, size)
-        image.thumbnail(size=max_size, resample=Image.LANCZOS)
-        image.save(
-            fp=path.join(settings.MEDIA_ROOT, self.preview_dir(), output_file),
-            format=image.format,
-            quality=quality,
-            icc_profile=image.info.get('icc_profile'),
-            optimize=True,
-            progressive=True
-        )
+    def rendition_dir(self):
+        return rendition_dir(self.file_hash)
 
-    def create_thumbnail(self, size, quality, output_file):
-        image = auto_orient(Image.open(self.image.path))
-        width = size
-        height = size
-        image = ImageOps.fit(
-            image=image,
-            size=(width, height),
-            method=Image.LANCZOS,
-            bleed=0,
-            centering=(0.5, 0.5)
-        )
-        image.save(
-            fp=path.join(settings.MEDIA_ROOT, self.preview_dir(), output_file),
-            format=image.format,
-            quality=quality,
-            icc_profile=image.info.get('icc_profile'),
-            optimize=True,
-            progressive=True
-        )
+    def create_renditions(self, profile=None, groups=None):
+        # Renditions are named by the hash of the original and of the spec, so identical
+        # originals share them and existing files can be used as they are. profile
+        # overrides the encoder profile of every rendition. With groups, only the
+        # renditions of those groups are created and the others are kept as they are.
+        output_dir = path.join(settings.MEDIA_ROOT, self.rendition_dir())
+        makedirs(output_dir, exist_ok=True)
+        # render_renditions adds the extension of the original's format
+        outputs = [
+            (spec, path.join(output_dir, spec.key))
+            for spec in rendition_specs(profile)
+            if groups is None or spec.group in groups
+        ]
+        previous = self.renditions
+        renditions = {}
+        if groups is not None:
+            renditions = {name: rendition for name, rendition in previous.items() if rendition['group'] not in groups}
+        (self.width, self.height), rendered = render_renditions(self.image.path, outputs, skip_existing=True)
+        for spec, (width, height), files in rendered:
+            sources = {
+                mime_type: path.relpath(file, settings.MEDIA_ROOT)
+                for mime_type, file in files.items()
+            }
+            renditions[spec.name] = {
+                'group': spec.group,
+                'width': width,
+                'height': height,
+                'sources': sources,
+            }
+            if spec.name in LEGACY_RENDITION_FIELDS:
+                setattr(self, f'{spec.name}_img', negotiate(sources, ''))
+        self.renditions = renditions
+        self.delete_stale_renditions(previous)
+        self.update_thumbnail_data()
 
-    def create_previews(self):
-        if self.image.height > 1327 or self.image.width > 1327:
-            self.create_preview_image(
-                size=1327,
-                quality=90,
-                output_file=self.preview_filename
-            )
-            self.preview_img = path.join(
-                self.preview_dir(),
-                self.preview_filename
-            )
-        if self.image.height > 2340 or self.image.width > 2340:
-            self.create_preview_image(
-                size=2340,
-                quality=90,
-                output_file=self.hidpi_preview_filename
-            )
-            self.hidpi_preview_img = path.join(
-                self.preview_dir(),
-                self.hidpi_preview_filename
-            )
+    def update_file_hash(self):
+        self.file_fingerprint = file_fingerprint(self.image.path)
+        self.file_hash = calc_hash(self.image.path)
 
-    def create_thumbnails(self):
-        self.create_thumbnail(
-            size=380,
-            quality=80,
-            output_file=self.thumbnail_img_filename
-        )
-        self.thumbnail_img = path.join(
-            self.preview_dir(),
-            self.thumbnail_img_filename
-        )
-        self.create_thumbnail(
-            size=600,
-            quality=80,
-            output_file=self.hidpi_thumbnail_img_filename
-        )
-        self.hidpi_thumbnail_img = path.join(
-            self.preview_dir(),
-            self.hidpi_thumbnail_img_filename
+    def is_outdated(self, specs=None):
+        # True if the original changed after it was processed or the renditions don't
+        # match the current specs or are missing. Only stats files, so whole albums can
+        # be checked quickly. specs can be passed to share them between photos.
+        try:
+            if not self.file_hash or file_fingerprint(self.image.path) != self.file_fingerprint:
+                return True
+        except OSError:
+            return True
+        if not self.ready:
+            # Post-processing creates the renditions
+            return False
+        if self.width is None or self.height is None:
+            return True
+        output_dir = self.rendition_dir()
+        # Rendition files without the extension, which depends on the original's format
+        expected = {
+            spec.name: path.join(output_dir, spec.key)
+            for spec in (rendition_specs() if specs is None else specs)
+            if spec.is_needed(self.width, self.height)
+        }
+        if set(expected) != set(self.renditions):
+            return True
+        mime_types = {MIME_TYPES[image_format] for image_format in extra_formats()}
+        for name, file in expected.items():
+            sources = self.renditions[name]['sources']
+            if not mime_types <= set(sources):
+                return True
+            if all(path.splitext(source)[0] != file for source in sources.values()):
+                return True
+            if not all(path.isfile(path.join(settings.MEDIA_ROOT, source)) for source in sources.values()):
+                return True
+        return False
+
+    def refresh(self):
+        # Saving processes a changed original again. Renditions made with other specs
+        # or missing from disk are created again even if the original didn't change.
+        self.save()
+        if self.ready and self.is_outdated():
+            self.create_renditions()
+            self.save()
+
+    def update_thumbnail_data(self):
+        # Perceptual hash and placeholder from the smallest rendition, which is much
+        # cheaper to decode than the original
+        renditions = sorted(self.renditions.values(), key=lambda rendition: rendition['width'])
+        if not renditions:
+            return
+        source = path.join(settings.MEDIA_ROOT, negotiate(renditions[0]['sources'], ''))
+        try:
+            perceptual_hash, self.placeholder = describe_thumbnail(source)
+            self.perceptual_hash = f'{perceptual_hash:016x}'
+        except OSError as e:
+            log.error(f'Failed to read thumbnail data for {self.image.name}: {e}')
+
+    def has_shared_renditions(self):
+        # Renditions from before they were stored by file hash are deleted with their
+        # photo and album, so other photos can't use them
+        files = list(rendition_files(self.renditions))
+        files += [getattr(self, f'{name}_img').name for name in LEGACY_RENDITION_FIELDS if getattr(self, f'{name}_img')]
+        return bool(self.renditions) and all(file.startswith(RENDITIONS_DIR + '/') for file in files)
+
+    def link_renditions(self, photo):
+        # Uses the renditions of a photo with an identical original instead of rendering them
+        self.file_hash = photo.file_hash
+        self.renditions = photo.renditions
+        self.perceptual_hash = photo.perceptual_hash
+        self.placeholder = photo.placeholder
+        self.width = photo.width
+        self.height = photo.height
+        for name in LEGACY_RENDITION_FIELDS:
+            setattr(self, f'{name}_img', getattr(photo, f'{name}_img').name)
+        self.ready = True
+
+    def delete_stale_renditions(self, previous):
+        # Files of an earlier manifest that the current one doesn't use. Shared files
+        # are kept while another photo with the same original still uses them.
+        stale = rendition_files(previous) - rendition_files(self.renditions)
+        used = {}
+        for file in stale:
+            if file.startswith(RENDITIONS_DIR + '/'):
+                file_hash = path.basename(path.dirname(file))
+                if file_hash not in used:
+                    others = Photo.objects.filter(file_hash=file_hash).exclude(pk=self.pk).only('renditions')
+                    used[file_hash] = set().union(*(rendition_files(photo.renditions) for photo in others))
+                if file in used[file_hash]:
+                    continue
+            try:
+                self.image.storage.delete(file)
+            except OSError as e:
+                log.error(f'Failed to delete rendition {file}: {e}')
+
+    @property
+    def aspect_ratio(self):
+        if not self.width or not self.height:
+            return None
+        return round(self.width / self.height, 4)
+
+    def group_renditions(self, group):
+        renditions = [rendition for rendition in self.renditions.values() if rendition['group'] == group]
+        return sorted(renditions, key=lambda rendition: rendition['width'])
+
+    def _rendition_source_url(self, rendition, accept):
+        return self.image.storage.url(negotiate(rendition['sources'], accept))
+
+    def rendition_url(self, name, accept=''):
+        rendition = self.renditions.get(name)
+        if rendition:
+            return self._rendition_source_url(rendition, accept)
+        return ''
+
+    def rendition_size(self, group):
+        # Size of the largest rendition of the group, which has the aspect ratio of all of them
+        renditions = self.group_renditions(group)
+        if not renditions:
+            return None
+        return renditions[-1]['width'], renditions[-1]['height']
+
+    def rendition_display_width(self, group):
+        # Width in CSS pixels when shown in the display_size box of the group
+        renditions = self.group_renditions(group)
+        display_size = settings.RENDITION_GROUPS[group]['display_size']
+        if not renditions:
+            return display_size
+        largest = renditions[-1]
+        return round(display_size * largest['width'] / max(largest['width'], largest['height']))
+
+    def rendition_candidates(self, group, accept=''):
+        return [
+            (self._rendition_source_url(rendition, accept), rendition['width'])
+            for rendition in self.group_renditions(group)
+        ]
+
+    def rendition_srcset(self, group, accept=''):
+        return ', '.join(f'{url} {width}w' for url, width in self.rendition_candidates(group, accept))
+
+    def rendition_sizes(self, group):
+        sizes = settings.RENDITION_GROUPS[group]['sizes']
+        return sizes.format(width=self.rendition_display_width(group))
+
+    def rendition_src(self, group, accept='', hints=None):
+        hints = hints or {}
+        rendition = select_rendition(
+            self.group_renditions(group),
+            display_width=self.rendition_display_width(group),
+            dpr=hints.get('dpr') or 1.0,
+            width=hints.get('width'),
+            viewport_width=hints.get('viewport_width')
         )
+        if rendition:
+            return self._rendition_source_url(rendition, accept)
+        return ''
+
+    def resize_url(self, width, height, fit='contain', image_format='auto'):
+        # Signed URL of a resized copy that's rendered on first request
+        query = resize_query(self.pk, width, height, fit, image_format)
+        return reverse('gallery:photo-resize', kwargs={'pk': self.pk}) + '?' + urlencode(query)
 
     def is_existing_slug(self):
         try:
@@ -452,7 +721,7 @@ class Photo(models.Model):
         except Exception:
             return False
 
-    def save_exif_data(self):
+    def save_exif_data(self, geocode=True):
         try:
             exif_data = ExifInfo(self.image.path)
             if exif_data.has_exif_data:
@@ -474,7 +743,8 @@ class Photo(models.Model):
                     data.latitude = exif_data.latitude
                     data.longitude = exif_data.longitude
                     data.altitude = exif_data.altitude
-                    data.get_locality_and_country()
+                    if geocode:
+                        data.get_locality_and_country()
                 data.save()
         except Exception as e:
             log.error(f'Failed to save EXIF data for file {self.image.path}: {e}')
@@ -636,3 +906,170 @@ class ExifData(models.Model):
         else:
             return None
     admin_thumbnail.short_description = _("Thumbnail")
+
+
+class Upload(models.Model):
+    # A photo uploaded in chunks, so that an interrupted upload can be resumed. The chunks
+    # are appended to a staging file, whose size is the offset of the next chunk.
+    id = models.UUIDField(
+        primary_key=True,
+        default=uuid4,
+        editable=False
+    )
+    album = models.ForeignKey(
+        Album,
+        related_name='uploads',
+        on_delete=models.CASCADE,
+        verbose_name=_('Album')
+    )
+    # Uploads started before they had a user can't be continued and expire
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name='uploads',
+        on_delete=models.CASCADE,
+        null=True,
+        editable=False,
+        verbose_name=_('User')
+    )
+    name = models.CharField(
+        _('File name'),
+        max_length=255
+    )
+    size = models.PositiveBigIntegerField(
+        _('Size')
+    )
+    content_type = models.CharField(
+        _('Content type'),
+        max_length=255
+    )
+    created = models.DateTimeField(
+        _('Created'),
+        auto_now_add=True
+    )
+    completed = models.DateTimeField(
+        _('Completed'),
+        blank=True,
+        null=True
+    )
+    # The photo added from the upload and the existing photo it duplicates. Neither is
+    # set if the completed file couldn't be added.
+    photo = models.ForeignKey(
+        Photo,
+        related_name='+',
+        blank=True,
+        null=True,
+        on_delete=models.SET_NULL,
+        verbose_name=_('Photo')
+    )
+    duplicate = models.ForeignKey(
+        Photo,
+        related_name='+',
+        blank=True,
+        null=True,
+        on_delete=models.SET_NULL,
+        verbose_name=_('Duplicate of')
+    )
+
+    class Meta:
+        verbose_name = _('upload')
+        verbose_name_plural = _('uploads')
+        ordering = ('created',)
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def staging_file(self):
+        extension = path.splitext(self.name)[1].lower()
+        return path.join(settings.MEDIA_ROOT, UPLOAD_STAGING_DIR, f'{self.id}.upload{extension}')
+
+    @property
+    def offset(self):
+        if self.completed:
+            return self.size
+        try:
+            return stat(self.staging_file).st_size
+        except FileNotFoundError:
+            return 0
+
+    def start(self):
+        makedirs(path.dirname(self.staging_file), exist_ok=True)
+        open(self.staging_file, 'xb').close()
+
+    def receive(self, stream, offset, length):
+        # Appends length bytes of stream at offset and adds the photo when the whole file
+        # has been received. Whatever arrived of a chunk that was cut short is kept, and
+        # the next chunk continues from there.
+        if self.completed:
+            raise UploadConflict('The upload has been completed')
+        try:
+            file = open(self.staging_file, 'r+b')
+        except FileNotFoundError:
+            raise UploadConflict('The upload has been cancelled')
+        with file:
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadConflict('Another chunk of the upload is being received')
+            # The chunk that held the lock may have completed the upload
+            self.refresh_from_db()
+            if self.completed:
+                raise UploadConflict('The upload has been completed')
+            end = file.seek(0, SEEK_END)
+            if offset != end:
+                raise UploadConflict(f'The upload continues at offset {end}, not {offset}')
+            if offset + length > self.size:
+                raise ValueError(f'The chunk ends after the {self.size} bytes of the upload')
+            while length > 0 and stream:
+                data = stream.read(min(CHUNK_BUFFER_SIZE, length))
+                if not data:
+                    break
+                file.write(data)
+                length -= len(data)
+            file.flush()
+            if file.tell() == self.size:
+                self.complete()
+
+    def complete(self):
+        file = StagedUploadedFile(
+            self.staging_file, self.name, self.content_type, self.size, calc_hash(self.staging_file)
+        )
+        try:
+            self.photo, self.duplicate = self.album.add_uploaded_photo(file)
+        except Exception as e:
+            log.error(f'Failed to process photo: {self.name} Error: {e}')
+        finally:
+            file.close()
+        self.completed = now()
+        self.save()
+        # Skipped duplicates and rejected files aren't moved into the album
+        self.remove_staging_file()
+
+    def remove_staging_file(self):
+        try:
+            remove(self.staging_file)
+        except FileNotFoundError:
+            pass
+
+
+@receiver(post_delete, sender=Photo)
+def delete_unused_renditions(sender, instance, **kwargs):
+    # Renditions are removed with the last photo that has the same original
+    file_hash = instance.file_hash
+    if not file_hash:
+        return
+
+    def delete():
+        if Photo.objects.filter(file_hash=file_hash).exists():
+            return
+        directory = path.join(settings.MEDIA_ROOT, rendition_dir(file_hash))
+        if path.isdir(directory):
+            rmtree(directory, ignore_errors=True)
+
+    transaction.on_commit(delete)
+
+
+@receiver(post_delete, sender=Upload)
+def delete_upload_file(sender, instance, **kwargs):
+    # Removes what was received of an upload that was cancelled or expired
+    instance.remove_staging_file()
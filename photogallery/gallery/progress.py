@@ -0,0 +1,138 @@
+from json import dumps, loads
+from time import monotonic
+
+from django.conf import settings
+from redis import RedisError
+
+from .redis_client import call
+
+KEY_PREFIX = 'gallery:progress:'
+
+COUNTERS = ('total', 'done', 'failed')
+
+# Seconds between comments that keep idle event streams open through proxies
+KEEPALIVE_INTERVAL = 15
+
+# Seconds before the browser opens an event stream again after it ended. Without
+# Redis streams end right away, so this is how often the page polls then.
+RECONNECT_DELAY = 1
+
+
+def _key(album):
+    return KEY_PREFIX + album
+
+
+def _channel(album):
+    return KEY_PREFIX + album + ':events'
+
+
+def start(album, job_id, total):
+    # One hash per album with the counters of each job as job_id:counter fields. Only
+    # one update of an album runs at a time, so what's left of earlier jobs is removed.
+    def operation(redis):
+        pipeline = redis.pipeline()
+        pipeline.delete(_key(album))
+        pipeline.hset(_key(album), mapping={f'{job_id}:total': total, f'{job_id}:done': 0, f'{job_id}:failed': 0})
+        # A job whose worker died is forgotten when the album lock expires
+        pipeline.expire(_key(album), settings.ALBUM_JOB_TIMEOUT)
+        pipeline.hgetall(_key(album))
+        _publish_summary(redis, album, pipeline.execute()[-1])
+    call(operation, None)
+
+
+def advance(album, job_id, done=0, failed=0):
+    def operation(redis):
+        pipeline = redis.pipeline()
+        if done:
+            pipeline.hincrby(_key(album), f'{job_id}:done', done)
+        if failed:
+            pipeline.hincrby(_key(album), f'{job_id}:failed', failed)
+        pipeline.hgetall(_key(album))
+        _publish_summary(redis, album, pipeline.execute()[-1])
+    call(operation, None)
+
+
+def finish(album, job_id):
+    def operation(redis):
+        pipeline = redis.pipeline()
+        pipeline.hdel(_key(album), *(f'{job_id}:{counter}' for counter in COUNTERS))
+        pipeline.hgetall(_key(album))
+        _publish_summary(redis, album, pipeline.execute()[-1])
+    call(operation, None)
+
+
+def _jobs(fields):
+    result = {}
+    for field, value in fields.items():
+        job_id, counter = field.rsplit(':', 1)
+        result.setdefault(job_id, dict.fromkeys(COUNTERS, 0))[counter] = int(value)
+    return result
+
+
+def _summary(fields):
+    jobs = _jobs(fields).values()
+    return {
+        'updating': sum(job['total'] - job['done'] - job['failed'] for job in jobs),
+        'failed': sum(job['failed'] for job in jobs),
+    }
+
+
+def _publish_summary(redis, album, fields):
+    redis.publish(_channel(album), dumps(_summary(fields)))
+
+
+def jobs(album):
+    # {job_id: {'total': n, 'done': n, 'failed': n}} of the album's running jobs
+    return _jobs(call(lambda redis: redis.hgetall(_key(album)), None) or {})
+
+
+def summary(album):
+    # Photos left and photos failed in the album's running updates
+    return _summary(call(lambda redis: redis.hgetall(_key(album)), None) or {})
+
+
+def pending(album):
+    return summary(album)['updating']
+
+
+def publish(album, **state):
+    # Sends changed counts to the event streams of the album
+    call(lambda redis: redis.publish(_channel(album), dumps(state)), None)
+
+
+def _event(state):
+    return f'data: {dumps(state)}\n\n'
+
+
+def _is_done(state):
+    return not state.get('post_processing') and not state.get('updating')
+
+
+def stream(album, get_state, timeout):
+    # Server-sent events with the counts from get_state() and every change published
+    # after that. Ends when nothing is pending, after timeout seconds or if Redis
+    # can't be reached, and the browser connects again if the page is still open.
+    pubsub = call(lambda redis: redis.pubsub(ignore_subscribe_messages=True), None)
+    try:
+        if pubsub:
+            # Subscribed before reading the counts, so no change is missed in between
+            try:
+                pubsub.subscribe(_channel(album))
+            except RedisError:
+                pubsub = None
+        state = get_state()
+        yield f'retry: {RECONNECT_DELAY * 1000}\n' + _event(state)
+        deadline = monotonic() + timeout
+        while pubsub and not _is_done(state) and monotonic() < deadline:
+            try:
+                message = pubsub.get_message(timeout=min(KEEPALIVE_INTERVAL, max(deadline - monotonic(), 0)))
+            except RedisError:
+                return
+            if message is None:
+                yield ': keepalive\n\n'
+                continue
+            state.update(loads(message['data']))
+            yield _event(state)
+    finally:
+        if pubsub:
+            pubsub.close()
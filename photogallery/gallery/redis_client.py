@@ -0,0 +1,38 @@
+from logging import getLogger
+from threading import Lock
+from time import time
+
+from django.conf import settings
+from redis import Redis, RedisError
+
+log = getLogger(__name__)
+
+# Seconds before Redis is tried again after an error
+RETRY_INTERVAL = 30
+
+_client = {'url': None, 'redis': None, 'failed': 0}
+_client_lock = Lock()
+
+
+def get_redis():
+    # The client and its connection pool are shared by all threads of the process
+    with _client_lock:
+        if _client['url'] != settings.REDIS_URL:
+            _client['redis'] = Redis.from_url(
+                settings.REDIS_URL, socket_connect_timeout=1, socket_timeout=1, decode_responses=True
+            )
+            _client['url'] = settings.REDIS_URL
+        return _client['redis']
+
+
+def call(operation, default):
+    # Runs operation(redis) and returns default if Redis can't be reached. Locks and
+    # progress are only bookkeeping, so the jobs go on without them.
+    if time() - _client['failed'] < RETRY_INTERVAL:
+        return default
+    try:
+        return operation(get_redis())
+    except RedisError as e:
+        _client['failed'] = time()
+        log.warning(f'Redis disabled for {RETRY_INTERVAL} seconds: {e}')
+        return default
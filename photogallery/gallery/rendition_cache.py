@@ -0,0 +1,154 @@
+import fcntl
+from contextlib import contextmanager
+from logging import getLogger
+from os import close, makedirs, path, replace, scandir, stat, unlink, utime
+from tempfile import mkstemp
+from threading import Lock
+from time import time
+
+from django.conf import settings
+
+log = getLogger(__name__)
+
+_caches = {}
+_caches_lock = Lock()
+
+
+class RenditionCache(object):
+    # Files are stored as <directory>/<key[:2]>/<key>, where key is a hex digest.
+    # The modification time of a file is bumped on every hit, so the files with the
+    # oldest modification time are the least recently used ones.
+
+    # Misses hash into this many lock files, so concurrent misses for the same key
+    # render only once, across threads and processes
+    LOCK_STRIPES = 256
+    # Eviction removes files until the cache is this much of max_bytes
+    LOW_WATERMARK = 0.9
+    # Seconds between full scans that correct the running size estimate
+    RESCAN_INTERVAL = 60
+    # Temporary files older than this are leftovers from crashed renders
+    STALE_TEMP_AGE = 3600
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        self._total = None
+        self._scanned = 0
+
+    def path(self, key):
+        return path.join(self.directory, key[:2], key)
+
+    def open(self, key):
+        try:
+            file = open(self.path(key), 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            utime(file.fileno())
+        except OSError:
+            pass
+        return file
+
+    def get_or_create(self, key, render):
+        # Returns the cached file opened for reading. On a miss render(output_file) is
+        # called to write it. An open file stays readable even if it's evicted meanwhile.
+        file = self.open(key)
+        if file:
+            return file
+        with self._key_lock(key):
+            file = self.open(key)
+            if file:
+                return file
+            self._create(key, render)
+            file = open(self.path(key), 'rb')
+        self._added(stat(file.fileno()).st_size)
+        return file
+
+    @contextmanager
+    def _key_lock(self, key):
+        lock_dir = path.join(self.directory, 'locks')
+        makedirs(lock_dir, exist_ok=True)
+        stripe = int(key[:8], 16) % self.LOCK_STRIPES
+        # flock() locks belong to the open file, so this also works between threads
+        with open(path.join(lock_dir, str(stripe)), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _create(self, key, render):
+        output_file = self.path(key)
+        makedirs(path.dirname(output_file), exist_ok=True)
+        fd, temp_file = mkstemp(dir=path.dirname(output_file), suffix='.tmp')
+        close(fd)
+        try:
+            render(temp_file)
+            replace(temp_file, output_file)
+        except BaseException:
+            try:
+                unlink(temp_file)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def _added(self, size):
+        # Other processes write to the same directory, so the running total is only an
+        # estimate that a full scan corrects every RESCAN_INTERVAL seconds
+        with self._lock:
+            if self._total is not None and time() - self._scanned < self.RESCAN_INTERVAL:
+                self._total += size
+                if self._total <= self.max_bytes:
+                    return
+            self._total = self.trim()
+            self._scanned = time()
+
+    def _entries(self):
+        try:
+            directories = [entry for entry in scandir(self.directory) if entry.is_dir()]
+        except FileNotFoundError:
+            return
+        for directory in directories:
+            if directory.name == 'locks':
+                continue
+            for entry in scandir(directory.path):
+                try:
+                    yield entry, entry.stat()
+                except FileNotFoundError:
+                    continue
+
+    def trim(self):
+        # Removes the least recently used files when the cache is over its budget.
+        # Returns the size of the cache in bytes.
+        entries = []
+        for entry, entry_stat in self._entries():
+            if entry.name.endswith('.tmp'):
+                if time() - entry_stat.st_mtime > self.STALE_TEMP_AGE:
+                    self._remove(entry.path)
+                continue
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+        total = sum(size for mtime, size, file in entries)
+        if total > self.max_bytes:
+            target = self.max_bytes * self.LOW_WATERMARK
+            evicted = 0
+            for mtime, size, file in sorted(entries):
+                if total <= target:
+                    break
+                self._remove(file)
+                total -= size
+                evicted += 1
+            log.info(f'Evicted {evicted} files from rendition cache {self.directory}')
+        return total
+
+    def _remove(self, file):
+        try:
+            unlink(file)
+        except FileNotFoundError:
+            pass
+
+
+def get_cache():
+    # One instance per process and configuration, so the size estimate is shared by all requests
+    key = (settings.RESIZE_CACHE_DIR, settings.RESIZE_CACHE_MAX_BYTES)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = RenditionCache(*key)
+        return _caches[key]
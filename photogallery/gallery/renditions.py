@@ -0,0 +1,479 @@
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from hashlib import sha256
+from io import BytesIO
+from json import dumps
+from math import ceil
+from mimetypes import guess_type
+from os import path, replace, unlink
+from uuid import uuid4
+
+from PIL import Image, ImageOps
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.core.signing import BadSignature, Signer
+from django.utils.crypto import constant_time_compare
+
+from .utils import auto_orient, exif_orientation
+
+log = getLogger(__name__)
+
+MIME_TYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+    'AVIF': 'image/avif',
+}
+
+# Extensions of rendition files by format, so originals named .JPG, .jpeg and .jpg with
+# the same hash share their renditions
+FORMAT_EXTENSIONS = {
+    'JPEG': '.jpg',
+    'PNG': '.png',
+    'WEBP': '.webp',
+    'AVIF': '.avif',
+}
+
+# Formats whose renditions are written in another format. MPO is a JPEG with extra
+# frames, which many cameras write.
+FORMAT_ALIASES = {
+    'MPO': 'JPEG',
+}
+
+DRAFT_OVERSAMPLING = 2.0
+
+RESIZE_FITS = ('contain', 'cover')
+
+# Longest side and JPEG quality of inline placeholders
+PLACEHOLDER_SIZE = 20
+PLACEHOLDER_QUALITY = 40
+
+# Directory under MEDIA_ROOT for renditions stored by file hash
+RENDITIONS_DIR = 'renditions'
+
+
+class RenditionSpec(object):
+
+    def __init__(self, name, group, size, quality, crop=False, draft_oversampling=DRAFT_OVERSAMPLING, profile=None):
+        self.name = name
+        self.group = group
+        self.size = size
+        self.quality = quality
+        self.crop = crop
+        self.draft_oversampling = draft_oversampling
+        self.profile = profile or settings.RENDITION_ENCODER_PROFILE
+
+    def __repr__(self):
+        return f'RenditionSpec({self.name}, {self.size})'
+
+    def __eq__(self, other):
+        return isinstance(other, RenditionSpec) and vars(self) == vars(other)
+
+    def __hash__(self):
+        return hash(self.name)
+
+    @property
+    def key(self):
+        # Identifies the output of this spec for any original. The name and group
+        # only place the rendition in the layout, so they're left out. The encoder
+        # options are included instead of the profile name, so editing a profile
+        # creates new files.
+        encoder = dumps(encoder_profile(self.profile), sort_keys=True)
+        options = f'{self.size}:{self.quality}:{self.crop}:{self.draft_oversampling}:{encoder}'
+        return sha256(options.encode()).hexdigest()[:16]
+
+    def is_needed(self, width, height):
+        # Cropped thumbnails are always created, previews only when the original is larger
+        if self.crop:
+            return True
+        return width > self.size or height > self.size
+
+    def can_render_from(self, width, height):
+        if self.crop:
+            return min(width, height) >= self.size
+        return max(width, height) >= self.size
+
+    def output_size(self, width, height):
+        if self.crop:
+            return self.size, self.size
+        ratio = self.size / max(width, height)
+        return max(1, round(width * ratio)), max(1, round(height * ratio))
+
+
+class RenditionStorage(FileSystemStorage):
+    # Content-addressed renditions are shared by all photos with the same original,
+    # so they're never deleted through a single photo's fields. Photo removes them
+    # once no photo uses them anymore.
+    def delete(self, name):
+        if name and name.startswith(RENDITIONS_DIR + '/'):
+            return
+        super(RenditionStorage, self).delete(name)
+
+
+def rendition_dir(file_hash):
+    return path.join(RENDITIONS_DIR, file_hash[:2], file_hash)
+
+
+def rendition_specs(profile=None):
+    # profile overrides the encoder profile of every spec for a single job
+    specs = [RenditionSpec(**spec) for spec in settings.RENDITIONS]
+    if profile:
+        for spec in specs:
+            spec.profile = profile
+    return specs
+
+
+def encoder_profile(name):
+    try:
+        return settings.RENDITION_ENCODER_PROFILES[name]
+    except KeyError:
+        raise ValueError(f'Unknown encoder profile: {name}')
+
+
+def draft_size(specs, width, height):
+    # Smallest decoded size that still leaves every rendition at least
+    # draft_oversampling times its own size before the LANCZOS pass
+    scale = 0
+    for spec in specs:
+        side = min(width, height) if spec.crop else max(width, height)
+        scale = max(scale, spec.size * spec.draft_oversampling / side)
+    if scale >= 1:
+        return None
+    # Round off float noise so that an exact fit doesn't get bumped up by one pixel
+    return ceil(round(width * scale, 6)), ceil(round(height * scale, 6))
+
+
+def can_write(image_format):
+    Image.init()
+    return image_format in MIME_TYPES and image_format in Image.SAVE
+
+
+def rendition_format(image_format):
+    return FORMAT_ALIASES.get(image_format, image_format)
+
+
+def format_mime_type(image_format):
+    Image.init()
+    return MIME_TYPES.get(image_format) or Image.MIME.get(image_format, 'application/octet-stream')
+
+
+def format_extension(image_format):
+    if image_format in FORMAT_EXTENSIONS:
+        return FORMAT_EXTENSIONS[image_format]
+    Image.init()
+    extensions = sorted(extension for extension, extension_format in Image.EXTENSION.items()
+                        if extension_format == image_format)
+    return extensions[0] if extensions else '.' + image_format.lower()
+
+
+def extra_formats():
+    # Formats from RENDITION_EXTRA_FORMATS that this Pillow build can write
+    return [image_format for image_format in settings.RENDITION_EXTRA_FORMATS if can_write(image_format)]
+
+
+def accepted_types(accept_header):
+    types = set()
+    for item in accept_header.split(','):
+        media_type, *params = item.split(';')
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        if quality > 0:
+            types.add(media_type.strip().lower())
+    return types
+
+
+def negotiate(sources, accept_header):
+    # sources maps MIME types to files of the same rendition. Extra formats are
+    # only used when explicitly listed in the Accept header, because */* is also
+    # sent by browsers that can't decode them.
+    accepted = accepted_types(accept_header)
+    extra_types = [MIME_TYPES[image_format] for image_format in settings.RENDITION_EXTRA_FORMATS]
+    for mime_type in extra_types:
+        if mime_type in sources and mime_type in accepted:
+            return sources[mime_type]
+    for mime_type, source in sources.items():
+        if mime_type not in extra_types:
+            return source
+    return None
+
+
+def select_rendition(renditions, display_width, dpr=1.0, width=None, viewport_width=None):
+    # renditions are manifest entries of one group sorted by width. The Width client
+    # hint is already in device pixels, otherwise the CSS display width is used.
+    if not width:
+        if viewport_width:
+            display_width = min(display_width, viewport_width)
+        width = display_width * dpr
+    for rendition in renditions:
+        if rendition['width'] >= width:
+            return rendition
+    return renditions[-1] if renditions else None
+
+
+def _save_options(image_format, quality, profile):
+    encoder = encoder_profile(profile)
+    quality = encoder.get('quality', quality)
+    if image_format == 'WEBP':
+        return {'quality': quality, 'method': encoder['webp_method']}
+    if image_format == 'AVIF':
+        return {'quality': quality, 'speed': encoder['avif_speed']}
+    if image_format == 'PNG':
+        # optimize makes zlib search for the smallest output, which can take seconds
+        return {'optimize': encoder['optimize'], 'compress_level': encoder['compress_level']}
+    return {
+        'quality': quality,
+        'optimize': encoder['optimize'],
+        'progressive': encoder['progressive'],
+        'subsampling': encoder['subsampling'],
+    }
+
+
+def _save(image, output_file, image_format, quality, profile, icc_profile, copy=False):
+    # Image.save() stores the encoder options on the image object, so formats
+    # encoded at the same time from one rendition each need their own copy
+    if image_format in ('WEBP', 'AVIF') and image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    elif copy:
+        image = image.copy()
+    # Written under a temporary name, so other photos sharing the file never see it half written
+    temp_file = f'{output_file}.{uuid4().hex}.tmp'
+    try:
+        image.save(
+            fp=temp_file,
+            format=image_format,
+            icc_profile=icc_profile,
+            **_save_options(image_format, quality, profile)
+        )
+        replace(temp_file, output_file)
+    except BaseException:
+        try:
+            unlink(temp_file)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _oriented_size(image):
+    # EXIF orientations 5-8 rotate the photo by 90 degrees, see auto_orient
+    width, height = image.size
+    if exif_orientation(image) in (5, 6, 7, 8):
+        return height, width
+    return width, height
+
+
+def _pick_source(spec, original, rendered):
+    # Renditions are created largest first, so the last usable one is the smallest
+    # image that still has enough pixels for this spec. Cropped renditions are all
+    # centered squares, so they can only be used as a source for other crops.
+    for rendered_spec, image in reversed(rendered):
+        if rendered_spec.crop and not spec.crop:
+            continue
+        if spec.can_render_from(image.width, image.height):
+            return image
+    return original
+
+
+def _resize(spec, source, size):
+    if spec.crop:
+        return ImageOps.fit(
+            image=source,
+            size=size,
+            method=Image.LANCZOS,
+            bleed=0,
+            centering=(0.5, 0.5)
+        )
+    return source.resize(size=size, resample=Image.LANCZOS)
+
+
+def _output_files(output_file, formats, image_format):
+    return {
+        format_mime_type(output_format): output_file if output_format == image_format
+        else f'{output_file}.{output_format.lower()}'
+        for output_format in formats
+    }
+
+
+def render_renditions(source_file, outputs, skip_existing=False):
+    # Decodes the original once and writes all (spec, output path) pairs in outputs.
+    # The extension of the output paths is replaced with the one of the original's
+    # format. Extra formats are written next to the output path with their own extension.
+    # With skip_existing, renditions that already have all their files are not rendered
+    # again, which is only safe when the output paths are derived from the original.
+    # Returns the oriented (width, height) of the original and
+    # (spec, (width, height), {MIME type: file}) for each rendition.
+    results = []
+    with Image.open(source_file) as original:
+        image_format = rendition_format(original.format)
+        icc_profile = original.info.get('icc_profile')
+        formats = [image_format] + [extra for extra in extra_formats() if extra != image_format]
+        extension = format_extension(image_format)
+        outputs = [(spec, path.splitext(output_file)[0] + extension) for spec, output_file in outputs]
+        # Sizes are calculated from the original, so reused renditions don't need decoding
+        size = _oriented_size(original)
+        pending = []
+        for spec, output_file in outputs:
+            if not spec.is_needed(*size):
+                continue
+            files = _output_files(output_file, formats, image_format)
+            if skip_existing and all(path.isfile(file) for file in files.values()):
+                results.append((spec, spec.output_size(*size), files))
+            else:
+                pending.append((spec, output_file))
+        if not pending:
+            return size, results
+        if image_format == 'JPEG':
+            requested_size = draft_size([spec for spec, output_file in pending], *original.size)
+            if requested_size:
+                # libjpeg decodes at 1/2, 1/4 or 1/8 scale directly from the DCT coefficients
+                original.draft(None, requested_size)
+        original.load()
+        image = auto_orient(original)
+
+    pending = sorted(pending, key=lambda output: output[0].size, reverse=True)
+    rendered = []
+    # The resize cascade runs here while the previous renditions are encoded in the
+    # pool. Pillow releases the GIL for both, so they run on separate cores.
+    with ThreadPoolExecutor(max_workers=settings.RENDITION_THREADS) as executor:
+        jobs = []
+        for spec, output_file in pending:
+            rendition = _resize(spec, _pick_source(spec, image, rendered), spec.output_size(*size))
+            rendered.append((spec, rendition))
+            files = _output_files(output_file, formats, image_format)
+            for output_format in formats:
+                jobs.append(executor.submit(
+                    _save, rendition, files[format_mime_type(output_format)], output_format, spec.quality, spec.profile,
+                    icc_profile, copy=output_format != image_format
+                ))
+            results.append((spec, rendition.size, files))
+        for job in jobs:
+            job.result()
+    return size, results
+
+
+def dhash(image):
+    # Difference hash: one bit per horizontally adjacent pixel pair of a 9x8 grayscale
+    # image, set when the left pixel is brighter. Similar photos differ in few bits.
+    pixels = list(image.convert('L').resize((9, 8), resample=Image.BOX).getdata())
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            value = value << 1 | (left > pixels[row * 9 + column + 1])
+    return value
+
+
+def placeholder(image):
+    # Tiny blurry JPEG as a data URI, shown inline until the real image has loaded
+    image = image.convert('RGB')
+    image.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE), resample=Image.BOX)
+    output = BytesIO()
+    image.save(output, format='JPEG', quality=PLACEHOLDER_QUALITY, optimize=True)
+    return 'data:image/jpeg;base64,' + b64encode(output.getvalue()).decode('ascii')
+
+
+def describe_thumbnail(image_file):
+    # Perceptual hash and placeholder from one decode of a small rendition
+    with Image.open(image_file) as image:
+        # Both need only a few pixels, so JPEGs can be decoded at a reduced scale
+        image.draft('RGB', (PLACEHOLDER_SIZE * 2, PLACEHOLDER_SIZE * 2))
+        image.load()
+        return dhash(image), placeholder(image)
+
+
+def _resize_signer():
+    return Signer(salt='gallery.renditions.resize')
+
+
+def _resize_value(photo_id, width, height, fit, image_format):
+    return f'{photo_id}:{width}:{height}:{fit}:{image_format}'
+
+
+def resize_query(photo_id, width, height, fit='contain', image_format='auto'):
+    # Query parameters of a signed on-demand resize. Sizes are rounded up to
+    # RESIZE_SIZE_STEP so that similar layouts share the cached files.
+    width, height = int(width), int(height)
+    if width < 1 or height < 1:
+        raise ValueError('Width and height must be positive')
+    if fit not in RESIZE_FITS:
+        raise ValueError(f'Unknown fit {fit}')
+    image_format = image_format.upper() if image_format != 'auto' else image_format
+    if image_format != 'auto' and not can_write(image_format):
+        raise ValueError(f'Unsupported format {image_format}')
+    step = settings.RESIZE_SIZE_STEP
+    width = min(ceil(width / step) * step, settings.RESIZE_MAX_SIZE)
+    height = min(ceil(height / step) * step, settings.RESIZE_MAX_SIZE)
+    signature = _resize_signer().signature(_resize_value(photo_id, width, height, fit, image_format))
+    return {'w': width, 'h': height, 'fit': fit, 'format': image_format, 's': signature}
+
+
+def verify_resize(photo_id, query):
+    # Returns width, height, fit and format from the query of a signed resize URL
+    try:
+        width, height = int(query['w']), int(query['h'])
+        fit, image_format, signature = query['fit'], query['format'], query['s']
+    except (KeyError, ValueError):
+        raise BadSignature('Missing or malformed resize parameters')
+    expected = _resize_signer().signature(_resize_value(photo_id, width, height, fit, image_format))
+    if not constant_time_compare(signature, expected):
+        raise BadSignature(f'Resize signature "{signature}" does not match')
+    return width, height, fit, image_format
+
+
+def resize_format(image_format, source_file, accept_header):
+    # 'auto' picks the first extra format the client accepts like negotiate() does,
+    # otherwise the format of the original
+    if image_format != 'auto':
+        return image_format
+    accepted = accepted_types(accept_header)
+    for extra in extra_formats():
+        if MIME_TYPES[extra] in accepted:
+            return extra
+    mime_type = guess_type(source_file)[0]
+    for original_format, format_mime_type in MIME_TYPES.items():
+        if format_mime_type == mime_type:
+            return original_format
+    return 'JPEG'
+
+
+def resize_cache_key(file_hash, width, height, fit, image_format, quality, profile):
+    # The hash of the original is part of the key, so replacing a photo never serves stale files
+    encoder = dumps(encoder_profile(profile), sort_keys=True)
+    return sha256(f'{file_hash}:{width}:{height}:{fit}:{image_format}:{quality}:{encoder}'.encode()).hexdigest()
+
+
+def resized_size(width, height, box_width, box_height, fit):
+    # Size of a width x height image resized to the box without upscaling. 'contain'
+    # fits the whole image inside the box, 'cover' crops it to the aspect ratio of the box.
+    if fit == 'cover':
+        scale = max(box_width / width, box_height / height)
+        if scale > 1:
+            return max(1, round(box_width / scale)), max(1, round(box_height / scale))
+        return box_width, box_height
+    scale = min(box_width / width, box_height / height, 1)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def render_resized(source_file, output_file, box_width, box_height, fit, image_format, quality, profile):
+    with Image.open(source_file) as original:
+        icc_profile = original.info.get('icc_profile')
+        width, height = _oriented_size(original)
+        size = resized_size(width, height, box_width, box_height, fit)
+        if rendition_format(original.format) == 'JPEG':
+            scale = max(size[0] / width, size[1] / height) * DRAFT_OVERSAMPLING
+            if scale < 1:
+                original.draft(None, (ceil(original.width * scale), ceil(original.height * scale)))
+        original.load()
+        image = auto_orient(original)
+
+    if fit == 'cover':
+        image = ImageOps.fit(image=image, size=size, method=Image.LANCZOS, bleed=0, centering=(0.5, 0.5))
+    else:
+        image = image.resize(size=size, resample=Image.LANCZOS)
+    _save(image, output_file, image_format, quality, profile, icc_profile)
@@ -1,13 +1,81 @@
+from os import path
+
+from django.conf import settings
 from django.contrib.auth.models import User
 from rest_framework import serializers
 
-from .models import Album, Photo
+from .models import SCAN_EXTENSIONS, Album, Photo, Upload
+from .uploads import UPLOAD_CONTENT_TYPES
+from .utils import get_accept, get_client_hints
+
+
+class RenditionField(serializers.ReadOnlyField):
+    # URL of a photo rendition in the smallest format listed in the request Accept header
+    def __init__(self, rendition, **kwargs):
+        self.rendition = rendition
+        kwargs['source'] = '*'
+        super(RenditionField, self).__init__(**kwargs)
+
+    def to_representation(self, photo):
+        request = self.context.get('request')
+        url = photo.rendition_url(self.rendition, get_accept(request))
+        if not url:
+            return None
+        if request:
+            return request.build_absolute_uri(url)
+        return url
+
+
+class RenditionGroupsField(serializers.ReadOnlyField):
+    # src, srcset, sizes and the size of the largest rendition for each rendition group
+    # of a photo. src is picked with the DPR, Width and Viewport-Width client hints of the request.
+    def __init__(self, **kwargs):
+        kwargs['source'] = '*'
+        super(RenditionGroupsField, self).__init__(**kwargs)
+
+    def absolute_url(self, url):
+        request = self.context.get('request')
+        if request and url:
+            return request.build_absolute_uri(url)
+        return url
+
+    def to_representation(self, photo):
+        request = self.context.get('request')
+        accept = get_accept(request)
+        groups = {}
+        for group in settings.RENDITION_GROUPS:
+            candidates = photo.rendition_candidates(group, accept)
+            if not candidates:
+                continue
+            width, height = photo.rendition_size(group)
+            groups[group] = {
+                'src': self.absolute_url(photo.rendition_src(group, accept, get_client_hints(request))),
+                'srcset': ', '.join(f'{self.absolute_url(url)} {width}w' for url, width in candidates),
+                'sizes': photo.rendition_sizes(group),
+                'width': width,
+                'height': height,
+                'aspect_ratio': round(width / height, 4),
+            }
+        return groups
 
 
 class AlbumCoverPhotoSerializer(serializers.ModelSerializer):
+    thumbnail_img = RenditionField('thumbnail')
+    hidpi_thumbnail_img = RenditionField('hidpi_thumbnail')
+    renditions = RenditionGroupsField()
+    aspect_ratio = serializers.ReadOnlyField()
+
     class Meta:
         model = Photo
-        fields = ['thumbnail_img', 'hidpi_thumbnail_img']
+        fields = [
+            'thumbnail_img',
+            'hidpi_thumbnail_img',
+            'renditions',
+            'placeholder',
+            'width',
+            'height',
+            'aspect_ratio',
+        ]
 
 
 class AlbumListSerializer(serializers.ModelSerializer):
@@ -39,6 +107,13 @@ class AlbumListSerializer(serializers.ModelSerializer):
 
 
 class PhotoSerializer(serializers.ModelSerializer):
+    preview_img = RenditionField('preview')
+    hidpi_preview_img = RenditionField('hidpi_preview')
+    thumbnail_img = RenditionField('thumbnail')
+    hidpi_thumbnail_img = RenditionField('hidpi_thumbnail')
+    renditions = RenditionGroupsField()
+    aspect_ratio = serializers.ReadOnlyField()
+
     class Meta:
         model = Photo
         fields = [
@@ -52,9 +127,25 @@ class PhotoSerializer(serializers.ModelSerializer):
             'hidpi_preview_img',
             'thumbnail_img',
             'hidpi_thumbnail_img',
+            'renditions',
+            'placeholder',
+            'width',
+            'height',
+            'aspect_ratio',
         ]
 
 
+class SimilarPhotoSerializer(PhotoSerializer):
+    album = serializers.PrimaryKeyRelatedField(read_only=True)
+    distance = serializers.SerializerMethodField()
+
+    class Meta(PhotoSerializer.Meta):
+        fields = PhotoSerializer.Meta.fields + ['album', 'distance']
+
+    def get_distance(self, obj):
+        return self.context['distances'][obj.id]
+
+
 class AlbumSerializer(serializers.ModelSerializer):
     photos = PhotoSerializer(many=True, read_only=True, allow_null=True)
     parent_albums = serializers.SerializerMethodField()
@@ -110,6 +201,38 @@ class AllAlbumsSerializer(serializers.ModelSerializer):
         )
 
 
+class UploadSerializer(serializers.ModelSerializer):
+    album_url = serializers.CharField(source='album.get_absolute_url', read_only=True)
+    offset = serializers.ReadOnlyField()
+
+    class Meta:
+        model = Upload
+        fields = (
+            'id',
+            'album',
+            'album_url',
+            'name',
+            'size',
+            'content_type',
+            'offset',
+            'completed',
+            'photo',
+            'duplicate'
+        )
+        read_only_fields = ('completed', 'photo', 'duplicate')
+
+    def validate_name(self, value):
+        extension = path.splitext(value)[1]
+        if extension.lower() not in SCAN_EXTENSIONS:
+            raise serializers.ValidationError(f'{extension} files are not supported.')
+        return value
+
+    def validate_content_type(self, value):
+        if value not in UPLOAD_CONTENT_TYPES:
+            raise serializers.ValidationError(f'Unsupported file type {value}')
+        return value
+
+
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
@@ -0,0 +1,137 @@
+from collections import defaultdict
+from logging import getLogger
+from threading import Lock
+from time import time
+
+from django.db.models import Count, Max
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Photo
+
+log = getLogger(__name__)
+
+# Maximum age of the index in seconds
+INDEX_TTL = 300
+
+_index = {'key': None, 'built': 0, 'index': None}
+_index_lock = Lock()
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class HashIndex(object):
+    # Multi-index hashing over 64-bit hashes. Every hash is split into CHUNKS chunks that
+    # are indexed separately. Two hashes that differ in fewer than CHUNKS bits have at
+    # least one identical chunk, so a search only compares the hashes that share a chunk
+    # with the query. Larger distances fall back to comparing every hash.
+
+    CHUNKS = 8
+    CHUNK_BITS = 64 // CHUNKS
+
+    def __init__(self):
+        self.hashes = {}
+        self.tables = [defaultdict(list) for _ in range(self.CHUNKS)]
+
+    def _chunks(self, value):
+        mask = (1 << self.CHUNK_BITS) - 1
+        return [(value >> (self.CHUNK_BITS * index)) & mask for index in range(self.CHUNKS)]
+
+    def add(self, value, item):
+        self.hashes[item] = value
+        for table, chunk in zip(self.tables, self._chunks(value)):
+            table[chunk].append(item)
+
+    def search(self, value, max_distance):
+        # Returns (distance, item) pairs within max_distance, closest first
+        if max_distance >= self.CHUNKS:
+            candidates = self.hashes
+        else:
+            candidates = set()
+            for table, chunk in zip(self.tables, self._chunks(value)):
+                candidates.update(table.get(chunk, ()))
+        results = []
+        for item in candidates:
+            distance = hamming_distance(value, self.hashes[item])
+            if distance <= max_distance:
+                results.append((distance, item))
+        return sorted(results)
+
+
+def _hashed_photos():
+    return Photo.objects.exclude(perceptual_hash='').filter(ready=True)
+
+
+def get_index():
+    # The index is rebuilt when the number of hashed photos or the newest one changes,
+    # when a photo in it changes in this process, and at least every INDEX_TTL seconds
+    # to pick up hashes that changed in other processes
+    stats = _hashed_photos().aggregate(count=Count('id'), last=Max('id'))
+    key = (stats['count'], stats['last'])
+    with _index_lock:
+        if _index['index'] is None or key != _index['key'] or time() - _index['built'] > INDEX_TTL:
+            index = HashIndex()
+            for photo_id, perceptual_hash in _hashed_photos().values_list('id', 'perceptual_hash').iterator():
+                index.add(int(perceptual_hash, 16), photo_id)
+            log.info(f'Built perceptual hash index of {len(index.hashes)} photos')
+            _index.update(key=key, built=time(), index=index)
+        return _index['index']
+
+
+def invalidate_index():
+    with _index_lock:
+        _index['index'] = None
+
+
+@receiver(post_save, sender=Photo)
+def photo_saved(sender, instance, **kwargs):
+    index = _index['index']
+    if index is None:
+        return
+    perceptual_hash = int(instance.perceptual_hash, 16) if instance.perceptual_hash and instance.ready else None
+    if index.hashes.get(instance.pk) != perceptual_hash:
+        invalidate_index()
+
+
+@receiver(post_delete, sender=Photo)
+def photo_deleted(sender, instance, **kwargs):
+    index = _index['index']
+    if index is not None and instance.pk in index.hashes:
+        invalidate_index()
+
+
+def similar_photos(photo, max_distance):
+    # Returns (distance, photo id) pairs of other photos within max_distance
+    if not photo.perceptual_hash:
+        return []
+    return [
+        (distance, photo_id)
+        for distance, photo_id in get_index().search(int(photo.perceptual_hash, 16), max_distance)
+        if photo_id != photo.pk
+    ]
+
+
+def near_duplicate_groups(max_distance):
+    # Groups of photo ids connected by a chain of photos within max_distance of each
+    # other, largest first. Every photo is one index search instead of a pairwise comparison.
+    index = get_index()
+    parents = {}
+
+    def find(photo_id):
+        parents.setdefault(photo_id, photo_id)
+        while parents[photo_id] != photo_id:
+            parents[photo_id] = parents[parents[photo_id]]
+            photo_id = parents[photo_id]
+        return photo_id
+
+    for photo_id, value in index.hashes.items():
+        for distance, other_id in index.search(value, max_distance):
+            if other_id != photo_id:
+                parents[find(other_id)] = find(photo_id)
+
+    groups = defaultdict(list)
+    for photo_id in parents:
+        groups[find(photo_id)].append(photo_id)
+    return sorted((sorted(group) for group in groups.values() if len(group) > 1), key=len, reverse=True)
@@ -1,41 +1,212 @@
-from celery import shared_task
+from datetime import timedelta
+from logging import getLogger
 
-# Avoid circular imports by importing the class inside the functions
+from celery import chord, shared_task
+from django.conf import settings
+from django.utils.timezone import now
 
+from . import locks, progress
 
-@shared_task
-def post_process_image(photo_id):
+log = getLogger(__name__)
+
+# Seconds before a task tries again when another task is processing the same photo
+PHOTO_LOCK_RETRY_DELAY = 10
+
+# Avoid circular imports by importing the class inside the functions. Tasks that
+# nothing waits for don't store their results.
+
+
+def _lock_photo(task, photo_id):
+    # Only one task at a time renders a photo. The others wait for it, because
+    # they may have been queued for a newer file.
+    token = locks.acquire(f'photo:{photo_id}', settings.PHOTO_JOB_TIMEOUT)
+    if not token:
+        raise task.retry(countdown=PHOTO_LOCK_RETRY_DELAY, max_retries=None)
+    return token
+
+
+@shared_task(bind=True, ignore_result=True)
+def post_process_image(self, photo_id):
+    # Only creates what's needed to show the photo in its album. The other renditions,
+    # EXIF data and geocoding are follow-up tasks on lower priority queues.
     from .models import Photo
-    image = Photo.objects.get(id=photo_id)
-    image.create_thumbnails()
-    image.create_previews()
-    image.save_exif_data()
-    image.ready = True
-    image.save()
+    # Saves from here on queue a new task, see Photo.save
+    locks.release(f'post-process:{photo_id}')
+    token = _lock_photo(self, photo_id)
+    try:
+        image = Photo.objects.get(id=photo_id)
+        if not image.file_hash:
+            # Photos added by a directory scan are hashed here instead of in the request
+            image.update_file_hash()
+        image.create_renditions(settings.RENDITION_UPLOAD_PROFILE or None, groups=settings.RENDITION_UPLOAD_GROUPS)
+        image.ready = True
+        image.save()
+    finally:
+        locks.release(f'photo:{photo_id}', token)
+    progress.publish(
+        image.album.directory,
+        post_processing=Photo.objects.filter(album_id=image.album_id, ready=False).count()
+    )
+    complete_renditions.delay(photo_id)
+    save_exif_data.delay(photo_id)
     return image.image.path
 
 
+@shared_task(ignore_result=True)
+def post_process_photos(photo_ids, queue=None):
+    # Queues the photos of a directory scan from the worker, so the request only
+    # queues this task. Imports pass a lower priority queue than the uploads use.
+    for photo_id in photo_ids:
+        if locks.acquire(f'post-process:{photo_id}', settings.PHOTO_JOB_TIMEOUT):
+            post_process_image.apply_async((photo_id,), queue=queue)
+
+
+@shared_task(bind=True, ignore_result=True)
+def complete_renditions(self, photo_id):
+    # Creates the renditions the upload skipped and encodes the others again with
+    # their own profiles if the upload used a faster one
+    from .models import LEGACY_RENDITION_FIELDS, Photo
+    token = _lock_photo(self, photo_id)
+    try:
+        photo = Photo.objects.filter(id=photo_id, ready=True).first()
+        if not photo:
+            return
+        previous = photo.renditions
+        photo.create_renditions()
+        # Only the rendition fields, so edits made meanwhile are kept. Photos with the
+        # same original share the renditions.
+        Photo.objects.filter(file_hash=photo.file_hash, ready=True).update(
+            renditions=photo.renditions,
+            perceptual_hash=photo.perceptual_hash,
+            placeholder=photo.placeholder,
+            **{f'{name}_img': getattr(photo, f'{name}_img').name for name in LEGACY_RENDITION_FIELDS}
+        )
+        # The other photos used the previous files until the update
+        photo.delete_stale_renditions(previous)
+    finally:
+        locks.release(f'photo:{photo_id}', token)
+
+
+@shared_task(ignore_result=True)
+def save_exif_data(photo_id):
+    from .models import ExifData, Photo
+    photo = Photo.objects.filter(id=photo_id).first()
+    if not photo:
+        return
+    photo.save_exif_data(geocode=False)
+    if ExifData.objects.filter(photo_id=photo_id, has_location=True).exists():
+        update_photo_geocoding.delay(photo_id)
+
+
+@shared_task(ignore_result=True)
+def update_photo_geocoding(photo_id):
+    from .models import ExifData
+    exif_data = ExifData.objects.filter(photo_id=photo_id).first()
+    if exif_data:
+        exif_data.update_geocoding()
+
+
+def update_album(album_id, full=False):
+    # Requests made while the album is already being updated join that update.
+    # Returns False if there was one.
+    if not locks.acquire(f'album-update:{album_id}', settings.ALBUM_JOB_TIMEOUT):
+        return False
+    async_save_photo.delay(album_id, full)
+    return True
+
+
 @shared_task(bind=True)
-def async_save_photo(self, album_id):
+def async_save_photo(self, album_id, full=False):
+    # Splits the album into chunks that are saved in parallel by all workers. Unless
+    # full is set, photos that are up to date are skipped.
     from .models import Photo, Album
-    photos = Photo.objects.filter(album_id=album_id).iterator()
+    from .renditions import rendition_specs
     album = Album.objects.get(pk=album_id)
-    total_count = Photo.objects.filter(album_id=album_id).count()
-    for index, photo in enumerate(photos):
-        photo.save()
-        if not self.request.called_directly:
-            self.update_state(
-                state='PROGRESS',
-                meta={
-                    'album': album.directory,
-                    'current': index,
-                    'total': total_count
-                }
-            )
-    return f'Updated {total_count} photos ({album.title})'
+    photos = Photo.objects.filter(album_id=album_id).order_by('id')
+    if full:
+        photo_ids = list(photos.values_list('id', flat=True))
+        skipped = 0
+    else:
+        specs = rendition_specs()
+        photo_ids = []
+        skipped = 0
+        fields = ('id', 'image', 'ready', 'file_hash', 'file_fingerprint', 'renditions', 'width', 'height')
+        for photo in photos.only(*fields).iterator():
+            if photo.is_outdated(specs):
+                photo_ids.append(photo.id)
+            else:
+                skipped += 1
+    if not photo_ids:
+        locks.release(f'album-update:{album_id}')
+        return f'Updated 0 photos, {skipped} up to date ({album.title})'
+    size = settings.ALBUM_UPDATE_CHUNK_SIZE
+    chunks = [photo_ids[index:index + size] for index in range(0, len(photo_ids), size)]
+    # All chunks count towards the same job, see Album.pending_updates
+    progress.start(album.directory, self.request.id, len(photo_ids))
+    header = [save_photos.s(album_id, chunk, self.request.id) for chunk in chunks]
+    callback = album_updated.s(album_id, self.request.id, skipped)
+    # The callback isn't run if a chunk fails
+    callback.link_error(album_update_failed.si(album_id, self.request.id))
+    chord(header)(callback)
+    return f'Updating {len(photo_ids)} photos in {len(chunks)} chunks, {skipped} up to date ({album.title})'
 
 
 @shared_task
+def save_photos(album_id, photo_ids, job_id=None):
+    # Returns the number of photos updated
+    from .models import Photo, Album
+    album = Album.objects.get(pk=album_id)
+    photos = Photo.objects.filter(id__in=photo_ids).iterator()
+    updated = 0
+    for photo in photos:
+        # A photo that another task is rendering is up to date once that task is done
+        token = locks.acquire(f'photo:{photo.id}', settings.PHOTO_JOB_TIMEOUT)
+        if not token:
+            progress.advance(album.directory, job_id, done=1)
+            continue
+        try:
+            photo.refresh()
+            updated += 1
+            progress.advance(album.directory, job_id, done=1)
+        except Exception as e:
+            log.error(f'Failed to update photo {photo.id}: {e}')
+            progress.advance(album.directory, job_id, failed=1)
+        finally:
+            locks.release(f'photo:{photo.id}', token)
+    return updated
+
+
+@shared_task
+def album_updated(counts, album_id, job_id=None, skipped=0):
+    from .models import Album
+    album = Album.objects.get(pk=album_id)
+    progress.finish(album.directory, job_id)
+    locks.release(f'album-update:{album_id}')
+    return f'Updated {sum(counts)} photos, {skipped} up to date ({album.title})'
+
+
+@shared_task
+def album_update_failed(album_id, job_id=None):
+    from .models import Album
+    album = Album.objects.get(pk=album_id)
+    log.error(f'Failed to update album {album_id}')
+    progress.finish(album.directory, job_id)
+    locks.release(f'album-update:{album_id}')
+
+
+@shared_task(ignore_result=True)
+def update_thumbnail_data(photo_ids):
+    from .models import Photo
+    photos = Photo.objects.filter(id__in=photo_ids).filter(ready=True).iterator()
+    for photo in photos:
+        photo.update_thumbnail_data()
+        Photo.objects.filter(pk=photo.pk).update(
+            perceptual_hash=photo.perceptual_hash,
+            placeholder=photo.placeholder
+        )
+
+
+@shared_task(ignore_result=True)
 def update_album_localities(album_id, overwrite=False):
     from .models import Photo
     photos = (Photo.objects.all().filter(album_id=album_id).iterator())
@@ -45,3 +216,14 @@ def update_album_localities(album_id, overwrite=False):
                 photo.exifdata.update_geocoding(overwrite=True)
             else:
                 photo.exifdata.update_geocoding()
+
+
+@shared_task(ignore_result=True)
+def expire_uploads():
+    # Run by celery beat. Removes resumable uploads and what was received of them once
+    # they're too old to be continued.
+    from .models import Upload
+    expired = Upload.objects.filter(created__lt=now() - timedelta(hours=settings.UPLOAD_EXPIRE_HOURS))
+    deleted = expired.delete()[0]
+    if deleted:
+        log.info(f'Removed {deleted} expired uploads')
@@ -0,0 +1,52 @@
+from django import template
+from django.utils.html import format_html
+
+from ..utils import get_accept, get_client_hints
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def rendition_url(context, photo, name):
+    if photo is None:
+        return ''
+    return photo.rendition_url(name, get_accept(context.get('request')))
+
+
+@register.simple_tag(takes_context=True)
+def rendition_src(context, photo, group):
+    if photo is None:
+        return ''
+    request = context.get('request')
+    return photo.rendition_src(group, get_accept(request), get_client_hints(request))
+
+
+@register.simple_tag(takes_context=True)
+def rendition_srcset(context, photo, group):
+    if photo is None:
+        return ''
+    return photo.rendition_srcset(group, get_accept(context.get('request')))
+
+
+@register.simple_tag
+def placeholder_style(photo):
+    # Inline placeholder shown as the background of an img until it has loaded
+    if photo is None or not photo.placeholder:
+        return ''
+    return format_html('style="background: url({}) center / cover no-repeat"', photo.placeholder)
+
+
+@register.simple_tag
+def rendition_dimensions(photo, group):
+    # width and height attributes, so the browser reserves the space before the image loads
+    size = photo.rendition_size(group) if photo is not None else None
+    if not size:
+        return ''
+    return format_html('width="{}" height="{}"', *size)
+
+
+@register.simple_tag
+def rendition_sizes(photo, group):
+    if photo is None:
+        return ''
+    return photo.rendition_sizes(group)
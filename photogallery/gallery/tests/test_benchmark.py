@@ -0,0 +1,53 @@
+import json
+import tempfile
+from io import StringIO
+from os import path
+
+from PIL import Image
+from django.core.management import call_command
+from django.test import TestCase
+
+from gallery.benchmark import STAGES, build_corpus, corpus_entries, generate_image
+
+
+class TestBenchmark(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_reproducible_corpus(self):
+        self.assertEqual(generate_image(0.1, seed=1).tobytes(), generate_image(0.1, seed=1).tobytes())
+        self.assertNotEqual(generate_image(0.1, seed=1).tobytes(), generate_image(0.1, seed=2).tobytes())
+
+    def test_corpus_orientations(self):
+        entries = corpus_entries(megapixels=[0.1], formats=['JPEG'])
+        corpus = build_corpus(self.temp_dir.name, entries)
+        for entry in corpus:
+            with Image.open(entry['file']) as image:
+                self.assertEqual(image.getexif().get(0x0112), entry['orientation'])
+                self.assertEqual('icc_profile' in image.info, entry['icc'])
+
+    def test_command(self):
+        output = path.join(self.temp_dir.name, 'results.json')
+        options = {
+            'corpus_dir': self.temp_dir.name,
+            'megapixels': [0.1],
+            'formats': ['JPEG'],
+            'orientations': [6],
+            'repeat': 1,
+            'output': output,
+        }
+        call_command('benchmark_renditions', stderr=StringIO(), **options)
+        with open(output) as f:
+            report = json.load(f)
+        self.assertEqual([result['stage'] for result in report['results']], list(STAGES))
+        for result in report['results']:
+            self.assertNotIn('error', result)
+            self.assertGreater(result['peak_rss'], 0)
+        self.assertGreater(report['totals']['renditions']['output_bytes'], 0)
+
+        call_command('benchmark_renditions', stderr=StringIO(), compare=output, **options)
+        with open(output) as f:
+            self.assertEqual(set(json.load(f)['relative_wall_time']), set(STAGES))
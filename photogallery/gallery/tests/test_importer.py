@@ -0,0 +1,117 @@
+import json
+import tempfile
+from io import StringIO
+from os import makedirs, path
+from unittest import mock
+
+from PIL import Image
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from gallery.importer import transfer, walk_tree
+from gallery.models import Album, Photo
+from gallery.utils import calc_hash
+
+
+class TestImportTree(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.media_root = path.join(self.temp_dir.name, 'media')
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.source = path.join(self.temp_dir.name, 'Archive')
+        self.checkpoint = path.join(self.temp_dir.name, 'checkpoint.json')
+        for index, file in enumerate(['a.jpg', '2019/b.jpg', '2019/Summer/c.png', 'Other/2019/d.JPG', '.hidden/e.jpg']):
+            makedirs(path.dirname(path.join(self.source, file)), exist_ok=True)
+            image_format = 'PNG' if file.endswith('png') else 'JPEG'
+            Image.new('RGB', (10, 10), color=(index * 50, 0, 0)).save(path.join(self.source, file), format=image_format)
+
+    def import_tree(self, *args):
+        with mock.patch('gallery.importer.post_process_photos') as post_process_photos:
+            call_command(
+                'import_tree', self.source, *args, checkpoint=self.checkpoint, rate=0,
+                stdout=StringIO(), stderr=StringIO()
+            )
+        return post_process_photos
+
+    def test_walk_tree(self):
+        self.assertEqual(walk_tree(self.source), [
+            ('', ['a.jpg']),
+            ('2019', ['b.jpg']),
+            (path.join('2019', 'Summer'), ['c.png']),
+            ('Other', []),
+            (path.join('Other', '2019'), ['d.JPG']),
+        ])
+
+    def test_import(self):
+        post_process_photos = self.import_tree()
+        archive = Album.objects.get(title='Archive')
+        self.assertIsNone(archive.parent)
+        album_2019 = Album.objects.get(parent=archive, title='2019')
+        self.assertEqual(Album.objects.get(parent=album_2019).title, 'Summer')
+        # Album titles and directories are unique
+        other_2019 = Album.objects.get(parent__title='Other')
+        self.assertEqual((other_2019.title, other_2019.directory), ('2019 2', '2019-2'))
+
+        photo = Photo.objects.get(title='b')
+        self.assertEqual(photo.album, album_2019)
+        self.assertEqual(photo.image.name, path.join('photos', '2019', 'b.jpg'))
+        self.assertEqual(photo.file_hash, calc_hash(path.join(self.source, '2019', 'b.jpg')))
+        self.assertFalse(photo.ready)
+        self.assertEqual(Photo.objects.count(), 4)
+
+        post_process_photos.delay.assert_called_once()
+        photo_ids, queue = post_process_photos.delay.call_args[0]
+        self.assertEqual(sorted(photo_ids), sorted(Photo.objects.values_list('id', flat=True)))
+        self.assertEqual(queue, 'bulk')
+
+    def test_resume_move(self):
+        # As if the run had stopped after moving the files but before adding them
+        with mock.patch('gallery.models.Album.add_photo_files', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.import_tree('--mode', 'move')
+        self.assertFalse(path.exists(path.join(self.source, 'a.jpg')))
+        self.assertFalse(Photo.objects.exists())
+
+        self.import_tree('--mode', 'move')
+        archive = Album.objects.get(title='Archive')
+        photo = Photo.objects.get(title='a')
+        self.assertEqual(photo.album, archive)
+        self.assertEqual(photo.image.name, path.join(archive.media_dir, 'a.jpg'))
+        self.assertEqual(Photo.objects.count(), 4)
+
+    def test_unreadable_file(self):
+        def failing_transfer(source_file, target_file, mode):
+            if path.basename(source_file) == 'b.jpg':
+                raise PermissionError(13, 'Permission denied', source_file)
+            return transfer(source_file, target_file, mode)
+
+        stderr = StringIO()
+        with mock.patch('gallery.importer.transfer', side_effect=failing_transfer), \
+                mock.patch('gallery.importer.post_process_photos'):
+            call_command(
+                'import_tree', self.source, checkpoint=self.checkpoint, rate=0, stdout=StringIO(), stderr=stderr
+            )
+        self.assertIn(path.join('2019', 'b.jpg'), stderr.getvalue())
+        self.assertFalse(Photo.objects.filter(title='b').exists())
+        self.assertEqual(sorted(Photo.objects.values_list('title', flat=True)), ['a', 'c', 'd'])
+
+    def test_resume(self):
+        self.import_tree('--no-dispatch')
+        with open(self.checkpoint) as f:
+            checkpoint = json.load(f)
+        self.assertEqual(checkpoint['dispatched'], 0)
+        # As if the run had stopped before the last directory was imported
+        checkpoint['imported'].remove(path.join('Other', '2019'))
+        with open(self.checkpoint, 'w') as f:
+            json.dump(checkpoint, f)
+
+        post_process_photos = self.import_tree()
+        self.assertEqual(Album.objects.count(), 5)
+        self.assertEqual(Photo.objects.count(), 4)
+        self.assertEqual(len(post_process_photos.delay.call_args[0][0]), 4)
+
+        post_process_photos = self.import_tree()
+        post_process_photos.delay.assert_not_called()
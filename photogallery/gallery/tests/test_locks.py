@@ -0,0 +1,159 @@
+import tempfile
+from unittest import mock
+
+from PIL import Image
+from django.test import TestCase, override_settings
+from redis import ConnectionError
+
+from gallery import locks, redis_client
+from gallery.models import Album, Photo
+from gallery.tasks import update_album
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+
+class FakePubSub:
+    def __init__(self, ignore_subscribe_messages=False):
+        self.channels = set()
+        self.messages = []
+
+    def subscribe(self, *channels):
+        self.channels.update(channels)
+
+    def get_message(self, timeout=0):
+        return self.messages.pop(0) if self.messages else None
+
+    def close(self):
+        self.channels = set()
+
+
+class FakeRedis:
+    # Just the commands the locks and the progress registry use
+    def __init__(self):
+        self.keys = {}
+        self.subscribers = []
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def pubsub(self, **kwargs):
+        self.subscribers.append(FakePubSub(**kwargs))
+        return self.subscribers[-1]
+
+    def publish(self, channel, message):
+        receivers = [pubsub for pubsub in self.subscribers if channel in pubsub.channels]
+        for pubsub in receivers:
+            pubsub.messages.append({'type': 'message', 'channel': channel, 'data': message})
+        return len(receivers)
+
+    def expire(self, name, time):
+        return name in self.keys
+
+    def hset(self, name, mapping):
+        self.keys.setdefault(name, {}).update({field: str(value) for field, value in mapping.items()})
+        return len(mapping)
+
+    def hincrby(self, name, field, amount=1):
+        fields = self.keys.setdefault(name, {})
+        fields[field] = str(int(fields.get(field, 0)) + amount)
+        return int(fields[field])
+
+    def hdel(self, name, *fields):
+        return sum(self.keys.get(name, {}).pop(field, None) is not None for field in fields)
+
+    def hgetall(self, name):
+        return dict(self.keys.get(name, {}))
+
+    def set(self, name, value, nx=False, ex=None):
+        if nx and name in self.keys:
+            return None
+        self.keys[name] = value
+        return True
+
+    def delete(self, name):
+        return int(self.keys.pop(name, None) is not None)
+
+    def eval(self, script, numkeys, name, token):
+        if self.keys.get(name) == token:
+            return self.delete(name)
+        return 0
+
+
+class TestLocks(TestCase):
+    def setUp(self):
+        redis_client._client['failed'] = 0
+        self.redis = FakeRedis()
+        patcher = mock.patch('gallery.redis_client.get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_acquire(self):
+        token = locks.acquire('photo:1', 60)
+        self.assertTrue(token)
+        self.assertIsNone(locks.acquire('photo:1', 60))
+        self.assertTrue(locks.acquire('photo:2', 60))
+        locks.release('photo:1', token)
+        self.assertTrue(locks.acquire('photo:1', 60))
+
+    def test_release_other_token(self):
+        locks.acquire('photo:1', 60)
+        locks.release('photo:1', 'expired')
+        self.assertIsNone(locks.acquire('photo:1', 60))
+        locks.release('photo:1')
+        self.assertTrue(locks.acquire('photo:1', 60))
+
+    def test_fail_open(self):
+        with mock.patch.object(self.redis, 'set', side_effect=ConnectionError('down')) as redis_set:
+            self.assertTrue(locks.acquire('photo:1', 60))
+            self.assertTrue(locks.acquire('photo:1', 60))
+            # Redis isn't tried again until the retry interval has passed
+            self.assertEqual(redis_set.call_count, 1)
+
+
+@override_settings(MEDIA_ROOT=tempfile.gettempdir())
+class TestCoalescedJobs(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.album = Album.objects.create(title='Album')
+        cls.temp_files = []
+        for index in range(3):
+            temp_file = tempfile.NamedTemporaryFile(delete=True, suffix='.jpg')
+            Image.new('RGB', (100, 100), color=(index, 0, 0)).save(temp_file, format='JPEG')
+            temp_file.flush()
+            cls.temp_files.append(temp_file)
+
+    def setUp(self):
+        redis_client._client['failed'] = 0
+        patcher = mock.patch('gallery.redis_client.get_redis', return_value=FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch('gallery.models.post_process_image')
+    def test_queued_once(self, post_process_image):
+        photo = Photo(title='Photo', image=self.temp_files[0].name, album=self.album, ready=False)
+        photo.save()
+        # Replaced before the task started
+        photo.image = self.temp_files[1].name
+        photo.save()
+        post_process_image.delay.assert_called_once_with(photo.id)
+        # The task lets the next save queue it again when it starts
+        locks.release(f'post-process:{photo.id}')
+        photo.image = self.temp_files[2].name
+        photo.save()
+        self.assertEqual(post_process_image.delay.call_count, 2)
+
+    @mock.patch('gallery.tasks.async_save_photo')
+    def test_album_updated_once(self, async_save_photo):
+        self.assertTrue(update_album(self.album.id))
+        self.assertFalse(update_album(self.album.id))
+        async_save_photo.delay.assert_called_once_with(self.album.id, False)
@@ -1,13 +1,20 @@
 import datetime
 import tempfile
-from os import path, chdir, remove
-from shutil import copy2
+from os import makedirs, path, chdir, remove
+from shutil import copy2, rmtree
+from unittest import mock
 
 from PIL import Image
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.test import TestCase, override_settings
 
-from gallery.models import Album, Photo
+from gallery.models import Album, Photo, unique_photo_slugs
+from gallery.renditions import rendition_specs
+
+
+def get_spec(name):
+    return next(spec for spec in rendition_specs() if spec.name == name)
 
 
 def get_temporary_image(temp_file, width, height):
@@ -138,6 +145,54 @@ class TestAlbumEdit(TestCase):
         self.assertFalse(self.album.show_location)
 
 
+class TestScanNewPhotos(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.album = Album.objects.create(title='Scanned album')
+        album_dir = path.join(self.media_root.name, self.album.media_dir)
+        makedirs(album_dir)
+        for name in ['a.jpg', 'b.JPG', 'c.png', 'd.jpeg', '.partial.jpg']:
+            Image.new('RGB', (10, 10)).save(path.join(album_dir, name), format='PNG' if name.endswith('png') else 'JPEG')
+        with open(path.join(album_dir, 'notes.txt'), 'w') as f:
+            f.write('Not a photo')
+        other_album = Album.objects.create(title='Other album')
+        with mock.patch('gallery.models.post_process_image'):
+            Photo(title='d', album=other_album, image=path.join(album_dir, 'd.jpeg'), ready=False).save()
+
+    def test_photos_in_dir(self):
+        self.assertEqual(
+            self.album.get_photos_in_dir(),
+            [path.join('photos', 'scanned-album', name) for name in ['a.jpg', 'b.JPG', 'c.png', 'd.jpeg']]
+        )
+
+    @mock.patch('gallery.models.post_process_photos')
+    def test_scan(self, post_process_photos):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.album.scan_new_photos(), (4, ''))
+        photos = Photo.objects.filter(album=self.album)
+        self.assertEqual(sorted(photo.title for photo in photos), ['a', 'b', 'c', 'd'])
+        self.assertFalse(any(photo.ready or photo.file_hash for photo in photos))
+        # The photo in the other album already has the slug "d"
+        self.assertRegex(photos.get(title='d').slug, r'^d-[a-z]{5}$')
+        post_process_photos.delay.assert_called_once()
+        self.assertEqual(sorted(post_process_photos.delay.call_args[0][0]), sorted(photo.id for photo in photos))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.album.scan_new_photos(), (0, ''))
+        post_process_photos.delay.assert_called_once()
+
+    def test_unique_slugs(self):
+        slugs = unique_photo_slugs(['Photo', 'photo', 'Other', 'd'])
+        self.assertEqual(slugs[0], 'photo')
+        self.assertRegex(slugs[1], r'^photo-[a-z]{5}$')
+        self.assertEqual(slugs[2], 'other')
+        self.assertRegex(slugs[3], r'^d-[a-z]{5}$')
+
+
 @override_settings(MEDIA_ROOT=tempfile.gettempdir())
 class TestNewPhoto(TestCase):
     @classmethod
@@ -174,6 +229,11 @@ class TestNewPhoto(TestCase):
         self.assertEqual(self.photo.image.width, 200)
         self.assertEqual(self.photo.image.height, 100)
 
+    def test_stored_size(self):
+        photo = Photo.objects.get(pk=self.photo.pk)
+        self.assertEqual((photo.width, photo.height), (200, 100))
+        self.assertEqual(photo.aspect_ratio, 2.0)
+
     def test_image_name(self):
         self.assertEqual(self.photo.image.name, self.temp_file.name)
 
@@ -195,7 +255,7 @@ class TestNewPhoto(TestCase):
         self.assertEqual(self.photo.thumbnail_img.height, 380)
         self.assertEqual(
             self.photo.thumbnail_img.name,
-            path.join(self.photo.preview_dir(), self.photo.thumbnail_img_filename)
+            path.join(self.photo.rendition_dir(), get_spec('thumbnail').key + '.jpg')
         )
 
     def test_hidpi_thumbnail_img(self):
@@ -204,7 +264,7 @@ class TestNewPhoto(TestCase):
         self.assertEqual(self.photo.hidpi_thumbnail_img.height, 600)
         self.assertEqual(
             self.photo.hidpi_thumbnail_img.name,
-            path.join(self.photo.preview_dir(), self.photo.hidpi_thumbnail_img_filename)
+            path.join(self.photo.rendition_dir(), get_spec('hidpi_thumbnail').key + '.jpg')
         )
 
     def test_get_absolute_url(self):
@@ -216,45 +276,79 @@ class TestNewPhoto(TestCase):
 
 
 @override_settings(MEDIA_ROOT=tempfile.gettempdir())
-class TestPhotoFileNames(TestCase):
+class TestSharedRenditions(TestCase):
+    def setUp(self):
+        self.album = Album.objects.create(title='Album')
+        self.temp_files = []
+        self.photos = [self.create_photo(f'Photo {index}') for index in range(2)]
+
+    def create_photo(self, title):
+        temp_file = tempfile.NamedTemporaryFile(delete=True, suffix='.jpg')
+        Image.new("RGB", (300, 200), color=(10, 20, 30)).save(temp_file, format='JPEG')
+        self.temp_files.append(temp_file)
+        photo = Photo(title=title, image=temp_file.name, album=self.album)
+        photo.save()
+        return photo
+
+    def test_identical_originals_share_renditions(self):
+        first, second = self.photos
+        self.assertEqual(first.file_hash, second.file_hash)
+        self.assertEqual(first.thumbnail_img.name, second.thumbnail_img.name)
+        self.assertEqual(first.renditions, second.renditions)
+
+    def test_existing_renditions_not_rendered(self):
+        photo = self.photos[0]
+        with mock.patch('gallery.renditions._save') as save:
+            photo.create_renditions()
+        save.assert_not_called()
+        self.assertEqual(photo.renditions, self.photos[1].renditions)
+
+    def test_missing_format_rendered(self):
+        photo = self.photos[0]
+        thumbnail = photo.renditions['thumbnail']['sources']
+        remove(path.join(settings.MEDIA_ROOT, thumbnail['image/jpeg']))
+        photo.create_renditions()
+        self.assertTrue(path.isfile(photo.thumbnail_img.path))
+
+    def test_renditions_deleted_with_last_photo(self):
+        first, second = self.photos
+        rendition_dir = path.join(settings.MEDIA_ROOT, first.rendition_dir())
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(path.isfile(second.thumbnail_img.path))
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(path.isdir(rendition_dir))
+
+
+@override_settings(MEDIA_ROOT=tempfile.gettempdir())
+class TestRotatedPhoto(TestCase):
     @classmethod
     def setUpTestData(cls):
-        cls.temp_file = tempfile.NamedTemporaryFile(
-            delete=True,
-            prefix='test-photo',
-            suffix='.jpg'
-        )
-        test_image = get_temporary_image(cls.temp_file, width=100, height=100)
+        cls.temp_file = tempfile.NamedTemporaryFile(delete=True, suffix='.jpg')
+        exif = Image.Exif()
+        # Rotated 90 degrees clockwise
+        exif[0x0112] = 6
+        Image.new("RGB", (1600, 1200)).save(cls.temp_file, format='JPEG', exif=exif)
         cls.album = Album.objects.create(title='Album')
-        cls.photo = Photo(
-            title='Test Photo',
-            image=test_image.name,
-            album=cls.album,
-        )
+        cls.photo = Photo(title='Photo', image=cls.temp_file.name, album=cls.album)
         cls.photo.save()
 
-    def test_preview_filename(self):
-        self.assertEqual(
-            self.photo.preview_filename,
-            'preview_' + path.basename(self.temp_file.name)
-        )
+    def test_oriented_size(self):
+        self.assertEqual((self.photo.width, self.photo.height), (1200, 1600))
+        self.assertEqual(self.photo.aspect_ratio, 0.75)
 
-    def test_hidpi_preview_filename(self):
-        self.assertEqual(
-            self.photo.hidpi_preview_filename,
-            'hidpipreview_' + path.basename(self.temp_file.name)
-        )
+    def test_rendition_size(self):
+        self.assertEqual(self.photo.rendition_size('previews'), (995, 1327))
+        self.assertEqual(self.photo.rendition_size('thumbnails'), (600, 600))
 
-    def thumbnail_img_filename(self):
+    def test_create_rendition_groups(self):
+        previews = self.photo.renditions['preview']
+        self.photo.create_renditions('fast', groups=['thumbnails'])
+        self.assertEqual(self.photo.renditions['preview'], previews)
         self.assertEqual(
-            self.photo.thumbnail_img_filename,
-            'thumb_' + path.basename(self.temp_file.name)
-        )
-
-    def hidpi_thumbnail_img_filename(self):
-        self.assertEqual(
-            self.photo.hidpi_thumbnail_img_filename,
-            'hidpithumb_' + path.basename(self.temp_file.name)
+            path.basename(self.photo.renditions['thumbnail']['sources']['image/jpeg']),
+            next(spec for spec in rendition_specs('fast') if spec.name == 'thumbnail').key + '.jpg'
         )
 
 
@@ -374,6 +468,47 @@ class TestLowResPhoto(TestCase):
         self.assertEqual(image.format, 'JPEG')
 
 
+@override_settings(MEDIA_ROOT=tempfile.gettempdir())
+class TestRotatedHighResPhoto(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.temp_file = tempfile.NamedTemporaryFile(
+            delete=True,
+            prefix='test-photo',
+            suffix='.jpg'
+        )
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        Image.new("RGB", (3000, 2000)).save(cls.temp_file, format='JPEG', exif=exif.tobytes())
+        cls.album = Album.objects.create(title='Album')
+        cls.photo = Photo(
+            title='Test Photo',
+            image=cls.temp_file.name,
+            album=cls.album,
+        )
+        cls.photo.save()
+
+    def test_original_decoded_once(self):
+        rmtree(path.join(settings.MEDIA_ROOT, self.photo.rendition_dir()))
+        with mock.patch('gallery.renditions.Image.open', wraps=Image.open) as image_open:
+            self.photo.create_renditions()
+        # The perceptual hash is calculated from the smallest rendition
+        self.assertEqual(image_open.call_args_list.count(mock.call(self.photo.image.path)), 1)
+        self.assertEqual(image_open.call_count, 2)
+
+    def test_preview_orientation(self):
+        self.assertEqual(self.photo.preview_img.height, 1327)
+        self.assertEqual(self.photo.preview_img.width, 885)
+        self.assertEqual(self.photo.hidpi_preview_img.height, 2340)
+        self.assertEqual(self.photo.hidpi_preview_img.width, 1560)
+
+    def test_thumbnails(self):
+        self.assertEqual(self.photo.thumbnail_img.width, 380)
+        self.assertEqual(self.photo.thumbnail_img.height, 380)
+        self.assertEqual(self.photo.hidpi_thumbnail_img.width, 600)
+        self.assertEqual(self.photo.hidpi_thumbnail_img.height, 600)
+
+
 @override_settings(MEDIA_ROOT=tempfile.gettempdir())
 class TestNextAndPreviousPhoto(TestCase):
     @classmethod
@@ -460,6 +595,30 @@ class TestHashCalculation(TestCase):
             '789c4b74dea2b36e6d229a5ba6fb1a8c0ccc35507a649b261ef01b5734b7a47b'
         )
 
+    def test_unchanged_file_not_hashed(self):
+        self.photo.title = 'New title'
+        with mock.patch('gallery.models.calc_hash') as calc_hash:
+            self.photo.save()
+        calc_hash.assert_not_called()
+
+    def test_modified_file_hashed(self):
+        with open(self.photo.image.path, 'ab') as f:
+            f.write(b'\0')
+        self.photo.save()
+        self.assertEqual(len(self.photo.file_hash), 64)
+        self.assertNotEqual(
+            self.photo.file_hash,
+            '789c4b74dea2b36e6d229a5ba6fb1a8c0ccc35507a649b261ef01b5734b7a47b'
+        )
+
+    @override_settings(FILE_HASH_ALGORITHM='blake2b')
+    def test_blake2b(self):
+        self.photo.save()
+        self.assertEqual(
+            self.photo.file_hash,
+            '333435a5d5c257106c3d37b17d33990a4493727af20f784a8c441bab07a7373f'
+        )
+
     def tearDown(self):
         file = path.join(tempfile.gettempdir(), self.image_file)
         remove(file)
@@ -478,6 +637,30 @@ class TestExif(TestCase):
     def test_has_exif(self):
         self.assertIsNotNone(self.photo.exifdata)
 
+    def test_unchanged_file_not_hashed(self):
+        self.photo.title = 'New title'
+        with mock.patch('gallery.models.calc_hash') as calc_hash:
+            self.photo.save()
+        calc_hash.assert_not_called()
+
+    def test_modified_file_hashed(self):
+        with open(self.photo.image.path, 'ab') as f:
+            f.write(b'\0')
+        self.photo.save()
+        self.assertEqual(len(self.photo.file_hash), 64)
+        self.assertNotEqual(
+            self.photo.file_hash,
+            '789c4b74dea2b36e6d229a5ba6fb1a8c0ccc35507a649b261ef01b5734b7a47b'
+        )
+
+    @override_settings(FILE_HASH_ALGORITHM='blake2b')
+    def test_blake2b(self):
+        self.photo.save()
+        self.assertEqual(
+            self.photo.file_hash,
+            '333435a5d5c257106c3d37b17d33990a4493727af20f784a8c441bab07a7373f'
+        )
+
     def tearDown(self):
         file = path.join(tempfile.gettempdir(), self.image_file)
         remove(file)
@@ -0,0 +1,89 @@
+import tempfile
+from hashlib import sha256
+from os import path, utime
+from threading import Barrier, Thread
+from time import sleep
+
+from django.test import TestCase
+
+from gallery.rendition_cache import RenditionCache
+
+
+def key(name):
+    return sha256(name.encode()).hexdigest()
+
+
+def writer(size):
+    def render(output_file):
+        with open(output_file, 'wb') as f:
+            f.write(b'x' * size)
+    return render
+
+
+class TestRenditionCache(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache = RenditionCache(self.temp_dir.name, max_bytes=1000)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_miss_and_hit(self):
+        renders = []
+
+        def render(output_file):
+            renders.append(output_file)
+            writer(100)(output_file)
+
+        with self.cache.get_or_create(key('a'), render) as file:
+            self.assertEqual(file.read(), b'x' * 100)
+        with self.cache.get_or_create(key('a'), render) as file:
+            self.assertEqual(len(file.read()), 100)
+        self.assertEqual(len(renders), 1)
+        self.assertTrue(path.isfile(self.cache.path(key('a'))))
+
+    def test_failed_render(self):
+        def render(output_file):
+            raise OSError('broken image')
+
+        with self.assertRaises(OSError):
+            self.cache.get_or_create(key('a'), render)
+        self.assertFalse(path.exists(self.cache.path(key('a'))))
+        self.assertEqual(self.cache.trim(), 0)
+
+    def test_least_recently_used_evicted(self):
+        for index, name in enumerate('abc'):
+            self.cache.get_or_create(key(name), writer(300)).close()
+            utime(self.cache.path(key(name)), (1000 + index, 1000 + index))
+        # A hit makes 'a' the most recently used file
+        self.cache.open(key('a')).close()
+        self.cache.get_or_create(key('d'), writer(300)).close()
+        self.assertFalse(path.exists(self.cache.path(key('b'))))
+        for name in 'acd':
+            self.assertTrue(path.isfile(self.cache.path(key(name))))
+        self.assertEqual(self.cache.trim(), 900)
+
+    def test_budget_enforced_on_miss(self):
+        for name in 'abcdefgh':
+            self.cache.get_or_create(key(name), writer(300)).close()
+        self.assertLessEqual(self.cache.trim(), 1000)
+
+    def test_single_flight(self):
+        renders = []
+        barrier = Barrier(4)
+
+        def render(output_file):
+            renders.append(output_file)
+            sleep(0.1)
+            writer(100)(output_file)
+
+        def request():
+            barrier.wait()
+            self.cache.get_or_create(key('a'), render).close()
+
+        threads = [Thread(target=request) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(renders), 1)
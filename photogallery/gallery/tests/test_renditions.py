@@ -0,0 +1,240 @@
+import tempfile
+from base64 import b64decode
+from io import BytesIO
+from os import path
+
+from PIL import Image
+from django.core.signing import BadSignature
+from django.test import TestCase, override_settings
+
+from gallery.renditions import (
+    RenditionSpec, _oriented_size, _save_options, accepted_types, describe_thumbnail, draft_size, negotiate,
+    render_renditions, rendition_specs, resize_query, resized_size, select_rendition, verify_resize
+)
+from gallery.utils import auto_orient
+
+
+def get_spec(name):
+    return next(spec for spec in rendition_specs() if spec.name == name)
+
+
+class TestDraftSize(TestCase):
+    def test_thumbnails_only(self):
+        specs = [get_spec('thumbnail'), get_spec('hidpi_thumbnail')]
+        self.assertEqual(draft_size(specs, 8000, 6000), (1600, 1200))
+
+    def test_previews_limit_draft(self):
+        specs = [get_spec('thumbnail'), get_spec('hidpi_preview')]
+        self.assertEqual(draft_size(specs, 8000, 6000), (3510, 2633))
+
+    def test_no_draft_for_small_images(self):
+        self.assertIsNone(draft_size([get_spec('hidpi_thumbnail')], 1600, 1200))
+
+    def test_oversampling_setting(self):
+        spec = RenditionSpec('thumbnail', 'thumbnails', size=380, quality=80, crop=True, draft_oversampling=1.0)
+        self.assertEqual(draft_size([spec], 8000, 6000), (507, 380))
+
+
+@override_settings(RENDITION_EXTRA_FORMATS=['AVIF', 'WEBP'])
+class TestNegotiation(TestCase):
+    sources = {
+        'image/jpeg': 'thumb.jpg',
+        'image/webp': 'thumb.jpg.webp',
+        'image/avif': 'thumb.jpg.avif',
+    }
+
+    def test_accepted_types(self):
+        self.assertEqual(
+            accepted_types('text/html, image/WebP;q=0.9, image/avif;q=0, */*;q=0.8'),
+            {'text/html', 'image/webp', '*/*'}
+        )
+
+    def test_smallest_accepted_format(self):
+        self.assertEqual(negotiate(self.sources, 'image/avif,image/webp,*/*'), 'thumb.jpg.avif')
+        self.assertEqual(negotiate(self.sources, 'image/webp,*/*'), 'thumb.jpg.webp')
+
+    def test_fallback_to_original_format(self):
+        self.assertEqual(negotiate(self.sources, '*/*'), 'thumb.jpg')
+        self.assertEqual(negotiate(self.sources, ''), 'thumb.jpg')
+
+    def test_missing_format(self):
+        self.assertEqual(negotiate({'image/jpeg': 'thumb.jpg'}, 'image/avif'), 'thumb.jpg')
+        self.assertIsNone(negotiate({}, 'image/avif'))
+
+
+class TestRenditionSelection(TestCase):
+    renditions = [
+        {'name': 'small', 'width': 380},
+        {'name': 'medium', 'width': 600},
+        {'name': 'large', 'width': 1200},
+    ]
+
+    def select(self, **kwargs):
+        return select_rendition(self.renditions, display_width=282, **kwargs)['name']
+
+    def test_display_width(self):
+        self.assertEqual(self.select(), 'small')
+
+    def test_device_pixel_ratio(self):
+        self.assertEqual(self.select(dpr=2), 'medium')
+        self.assertEqual(self.select(dpr=3), 'large')
+
+    def test_width_hint(self):
+        self.assertEqual(self.select(dpr=2, width=390), 'medium')
+
+    def test_viewport_width(self):
+        self.assertEqual(self.select(dpr=2, viewport_width=180), 'small')
+
+    def test_largest_available(self):
+        self.assertEqual(self.select(width=4000), 'large')
+        self.assertIsNone(select_rendition([], display_width=282))
+
+
+class TestDraftDecoding(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(TestDraftDecoding, cls).setUpClass()
+        cls.temp_dir = tempfile.TemporaryDirectory()
+        cls.source = path.join(cls.temp_dir.name, 'source.jpg')
+        Image.new("RGB", (4000, 3000), color=(200, 100, 50)).save(cls.source, format='JPEG')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.temp_dir.cleanup()
+        super(TestDraftDecoding, cls).tearDownClass()
+
+    def test_thumbnail_rendered_from_draft(self):
+        output = path.join(self.temp_dir.name, 'thumb.jpg')
+        size, rendered = render_renditions(self.source, [(get_spec('thumbnail'), output)])
+        self.assertEqual([spec for spec, size, files in rendered], [get_spec('thumbnail')])
+        with Image.open(output) as image:
+            self.assertEqual(image.size, (380, 380))
+            red, green, blue = image.getpixel((190, 190))
+            self.assertAlmostEqual(red, 200, delta=3)
+            self.assertAlmostEqual(green, 100, delta=3)
+            self.assertAlmostEqual(blue, 50, delta=3)
+
+    def test_preview_size(self):
+        output = path.join(self.temp_dir.name, 'hidpipreview.jpg')
+        size, rendered = render_renditions(self.source, [(get_spec('hidpi_preview'), output)])
+        self.assertEqual(size, (4000, 3000))
+        self.assertEqual([spec for spec, size, files in rendered], [get_spec('hidpi_preview')])
+        with Image.open(output) as image:
+            self.assertEqual(image.size, (2340, 1755))
+
+    @override_settings(RENDITION_THREADS=1)
+    def test_single_encoder_thread(self):
+        outputs = [
+            (spec, path.join(self.temp_dir.name, spec.name + '_single.jpg'))
+            for spec in rendition_specs()
+        ]
+        size, rendered = render_renditions(self.source, outputs)
+        self.assertEqual(len(rendered), len(outputs))
+        for spec, output in outputs:
+            self.assertTrue(path.isfile(output))
+
+    @override_settings(RENDITION_EXTRA_FORMATS=['WEBP'])
+    def test_extra_formats(self):
+        output = path.join(self.temp_dir.name, 'formats.jpg')
+        original_size, [(spec, size, files)] = render_renditions(self.source, [(get_spec('thumbnail'), output)])
+        self.assertEqual(size, (380, 380))
+        self.assertEqual(files, {'image/jpeg': output, 'image/webp': output + '.webp'})
+        with Image.open(output + '.webp') as image:
+            self.assertEqual(image.format, 'WEBP')
+            self.assertEqual(image.size, (380, 380))
+
+    def test_extension_from_format(self):
+        # Renditions of originals named .JPEG and .jpg have the same names
+        output = path.join(self.temp_dir.name, 'extension.JPEG')
+        original_size, [(spec, size, files)] = render_renditions(self.source, [(get_spec('thumbnail'), output)])
+        self.assertEqual(files['image/jpeg'], path.join(self.temp_dir.name, 'extension.jpg'))
+
+    def test_mpo_written_as_jpeg(self):
+        source = path.join(self.temp_dir.name, 'camera.jpg')
+        frames = [Image.new('RGB', (800, 600), color=(index * 100, 0, 0)) for index in range(2)]
+        frames[0].save(source, format='MPO', save_all=True, append_images=frames[1:])
+        output = path.join(self.temp_dir.name, 'camera')
+        original_size, [(spec, size, files)] = render_renditions(source, [(get_spec('thumbnail'), output)])
+        self.assertEqual(files['image/jpeg'], output + '.jpg')
+        with Image.open(files['image/jpeg']) as image:
+            self.assertEqual(image.format, 'JPEG')
+
+    def test_placeholder(self):
+        output = path.join(self.temp_dir.name, 'placeholder.jpg')
+        render_renditions(self.source, [(get_spec('thumbnail'), output)])
+        perceptual_hash, placeholder = describe_thumbnail(output)
+        prefix = 'data:image/jpeg;base64,'
+        self.assertTrue(placeholder.startswith(prefix))
+        self.assertLess(len(placeholder), 1000)
+        with Image.open(BytesIO(b64decode(placeholder[len(prefix):]))) as image:
+            self.assertEqual(image.size, (20, 20))
+            red, green, blue = image.getpixel((10, 10))
+            self.assertAlmostEqual(red, 200, delta=5)
+
+
+class TestOrientation(TestCase):
+    def test_orientation_of_any_format(self):
+        # Only JPEG files have _getexif, every image has getexif
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        image = Image.new('RGB', (40, 30))
+        image.info['exif'] = exif.tobytes()
+        self.assertEqual(_oriented_size(image), (30, 40))
+        self.assertEqual(auto_orient(image).size, (30, 40))
+
+
+class TestEncoderProfiles(TestCase):
+    def test_profile_options(self):
+        self.assertEqual(_save_options('PNG', 90, 'fast'), {'optimize': False, 'compress_level': 1})
+        self.assertEqual(
+            _save_options('JPEG', 90, 'smallest'),
+            {'quality': 90, 'optimize': True, 'progressive': True, 'subsampling': '4:2:0'}
+        )
+
+    def test_profile_in_key(self):
+        self.assertNotEqual(rendition_specs('fast')[0].key, rendition_specs('smallest')[0].key)
+        self.assertEqual(rendition_specs('fast')[0].profile, 'fast')
+
+    @override_settings(RENDITION_ENCODER_PROFILE='smallest')
+    def test_default_profile(self):
+        self.assertEqual(get_spec('thumbnail').profile, 'smallest')
+        self.assertEqual(get_spec('thumbnail').key, rendition_specs('smallest')[0].key)
+
+    def test_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            _save_options('JPEG', 90, 'tiny')
+
+
+@override_settings(RESIZE_SIZE_STEP=40, RESIZE_MAX_SIZE=4096)
+class TestResizeSigning(TestCase):
+    def test_signed_query(self):
+        query = resize_query(1, 300, 200, 'cover', 'webp')
+        self.assertEqual((query['w'], query['h'], query['format']), (320, 200, 'WEBP'))
+        self.assertEqual(verify_resize(1, query), (320, 200, 'cover', 'WEBP'))
+
+    def test_size_limit(self):
+        query = resize_query(1, 10000, 10000)
+        self.assertEqual((query['w'], query['h']), (4096, 4096))
+
+    def test_invalid_parameters(self):
+        with self.assertRaises(ValueError):
+            resize_query(1, 0, 200)
+        with self.assertRaises(ValueError):
+            resize_query(1, 200, 200, 'stretch')
+        with self.assertRaises(ValueError):
+            resize_query(1, 200, 200, image_format='gif')
+
+    def test_tampered_query(self):
+        query = resize_query(1, 320, 200)
+        with self.assertRaises(BadSignature):
+            verify_resize(2, query)
+        with self.assertRaises(BadSignature):
+            verify_resize(1, dict(query, w=4000))
+        with self.assertRaises(BadSignature):
+            verify_resize(1, {'w': 320})
+
+    def test_resized_size(self):
+        self.assertEqual(resized_size(4000, 3000, 400, 400, 'contain'), (400, 300))
+        self.assertEqual(resized_size(4000, 3000, 400, 400, 'cover'), (400, 400))
+        self.assertEqual(resized_size(400, 300, 800, 800, 'contain'), (400, 300))
+        self.assertEqual(resized_size(400, 300, 800, 400, 'cover'), (400, 200))
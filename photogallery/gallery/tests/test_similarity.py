@@ -0,0 +1,120 @@
+import random
+import tempfile
+from unittest import mock
+
+from PIL import Image, ImageDraw
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from gallery.models import Album, Photo
+from gallery.renditions import dhash
+from gallery.similarity import HashIndex, hamming_distance, invalidate_index, near_duplicate_groups, similar_photos
+
+
+def get_image(offset=0, brightness=0):
+    image = Image.new('RGB', (400, 300), color=(40 + brightness, 60 + brightness, 90 + brightness))
+    draw = ImageDraw.Draw(image)
+    draw.ellipse((50 + offset, 40, 250 + offset, 240), fill=(220, 200 + brightness, 30))
+    draw.rectangle((280, 150 + offset, 380, 280), fill=(10, 120, 200))
+    return image
+
+
+class TestHashIndex(TestCase):
+    def test_search_matches_linear_scan(self):
+        rng = random.Random(1)
+        values = [rng.getrandbits(64) for _ in range(500)]
+        # Near-duplicates of the first values
+        values += [value ^ (1 << rng.randrange(64)) for value in values[:50]]
+        hash_index = HashIndex()
+        for index, value in enumerate(values):
+            hash_index.add(value, index)
+        for query in values[:20] + [rng.getrandbits(64)]:
+            for max_distance in (0, 4, 7, 12):
+                expected = sorted(
+                    (hamming_distance(query, value), index)
+                    for index, value in enumerate(values)
+                    if hamming_distance(query, value) <= max_distance
+                )
+                self.assertEqual(hash_index.search(query, max_distance), expected)
+
+    def test_empty_index(self):
+        self.assertEqual(HashIndex().search(0, 4), [])
+        self.assertEqual(HashIndex().search(0, 64), [])
+
+
+class TestDHash(TestCase):
+    def test_similar_images(self):
+        self.assertLessEqual(hamming_distance(dhash(get_image()), dhash(get_image(brightness=15))), 4)
+        self.assertLessEqual(hamming_distance(dhash(get_image()), dhash(get_image().resize((200, 150)))), 4)
+
+    def test_different_images(self):
+        other = get_image().transpose(Image.FLIP_LEFT_RIGHT)
+        self.assertGreater(hamming_distance(dhash(get_image()), dhash(other)), 10)
+
+
+@override_settings(MEDIA_ROOT=tempfile.gettempdir())
+class TestNearDuplicates(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.album = Album.objects.create(title='Album')
+        cls.temp_files = []
+        images = {
+            'original': get_image(),
+            'brighter': get_image(brightness=15),
+            'other': get_image().transpose(Image.FLIP_LEFT_RIGHT),
+        }
+        cls.photos = {}
+        for title, image in images.items():
+            temp_file = tempfile.NamedTemporaryFile(delete=True, suffix='.jpg')
+            image.save(temp_file, format='JPEG')
+            cls.temp_files.append(temp_file)
+            photo = Photo(title=title, image=temp_file.name, album=cls.album)
+            photo.save()
+            cls.photos[title] = photo
+
+    def setUp(self):
+        invalidate_index()
+
+    def test_hash_stored(self):
+        for photo in self.photos.values():
+            self.assertEqual(len(photo.perceptual_hash), 16)
+
+    def test_similar_photos(self):
+        similar = similar_photos(self.photos['original'], max_distance=6)
+        self.assertEqual([photo_id for distance, photo_id in similar], [self.photos['brighter'].id])
+
+    def test_changed_hash(self):
+        self.assertEqual(len(similar_photos(self.photos['original'], max_distance=6)), 1)
+        other = Photo.objects.get(pk=self.photos['other'].pk)
+        other.perceptual_hash = self.photos['original'].perceptual_hash
+        other.save()
+        similar = similar_photos(self.photos['original'], max_distance=6)
+        self.assertIn(other.id, [photo_id for distance, photo_id in similar])
+
+    def test_groups(self):
+        self.assertEqual(
+            near_duplicate_groups(max_distance=6),
+            [sorted([self.photos['original'].id, self.photos['brighter'].id])]
+        )
+
+    def test_admin_report(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@domain.tld', 'admin'))
+        response = self.client.get(reverse('admin:gallery_photo_near_duplicates'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [[photo.id for photo in group] for group in response.context['groups']],
+            [sorted([self.photos['original'].id, self.photos['brighter'].id])]
+        )
+
+    def test_admin_report_deleted_photos(self):
+        # Photos deleted in another process are still in the index of this one
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@domain.tld', 'admin'))
+        original, brighter = self.photos['original'].id, self.photos['brighter'].id
+        groups = [[original, brighter, 0], [self.photos['other'].id, 0]]
+        with mock.patch('gallery.admin.near_duplicate_groups', return_value=groups):
+            response = self.client.get(reverse('admin:gallery_photo_near_duplicates'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [[photo.id for photo in group] for group in response.context['groups']], [[original, brighter]]
+        )
@@ -0,0 +1,180 @@
+import tempfile
+from os import path, remove
+from unittest import mock
+
+from PIL import Image
+from django.test import TestCase, override_settings
+
+from gallery import locks, progress, redis_client
+from gallery.models import Album, Photo
+from gallery.renditions import rendition_specs
+from gallery.tasks import album_update_failed, album_updated, async_save_photo, complete_renditions, post_process_image, save_photos
+from gallery.tests.test_locks import FakeRedis
+from photogallery.celery import app
+
+
+@override_settings(MEDIA_ROOT=tempfile.gettempdir())
+class TestAlbumUpdate(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.album = Album.objects.create(title='Album')
+        cls.other_album = Album.objects.create(title='Album 2')
+        cls.temp_files = []
+        for index in range(3):
+            temp_file = tempfile.NamedTemporaryFile(delete=True, suffix='.jpg')
+            Image.new('RGB', (100, 100), color=(index * 100, 0, 0)).save(temp_file, format='JPEG')
+            cls.temp_files.append(temp_file)
+            with mock.patch('gallery.models.post_process_image'):
+                photo = Photo(title=f'Photo {index}', image=temp_file.name, album=cls.album, ready=False)
+                photo.save()
+            photo.create_renditions()
+            photo.ready = True
+            photo.save()
+
+    def setUp(self):
+        redis_client._client['failed'] = 0
+        patcher = mock.patch('gallery.redis_client.get_redis', return_value=FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_pending_updates(self):
+        progress.start(self.album.directory, 'job', 50)
+        progress.advance(self.album.directory, 'job', done=10)
+        progress.advance(self.album.directory, 'job', failed=2)
+        self.assertEqual(progress.jobs(self.album.directory), {'job': {'total': 50, 'done': 10, 'failed': 2}})
+        self.assertEqual(Album.objects.get(pk=self.album.pk).pending_updates, 38)
+        self.assertEqual(Album.objects.get(pk=self.other_album.pk).pending_updates, 0)
+        progress.finish(self.album.directory, 'job')
+        self.assertEqual(Album.objects.get(pk=self.album.pk).pending_updates, 0)
+
+    def test_chunk_progress(self):
+        photo_ids = list(Photo.objects.filter(album=self.album).values_list('id', flat=True))
+        progress.start(self.album.directory, 'job', len(photo_ids) + 1)
+        self.assertEqual(save_photos(self.album.id, photo_ids, 'job'), len(photo_ids))
+        self.assertEqual(Album.objects.get(pk=self.album.pk).pending_updates, 1)
+
+    @override_settings(ALBUM_UPDATE_CHUNK_SIZE=2)
+    @mock.patch('gallery.tasks.chord')
+    def test_chunks(self, chord):
+        result = async_save_photo.apply(args=(self.album.id, True))
+        self.assertEqual(result.get(), 'Updating 3 photos in 2 chunks, 0 up to date (Album)')
+        photo_ids = list(Photo.objects.filter(album=self.album).order_by('id').values_list('id', flat=True))
+        header = chord.call_args[0][0]
+        self.assertEqual([signature.task for signature in header], [save_photos.name] * 2)
+        self.assertEqual(
+            [signature.args for signature in header],
+            [(self.album.id, photo_ids[:2], result.id), (self.album.id, photo_ids[2:], result.id)]
+        )
+        callback = chord.return_value.call_args[0][0]
+        self.assertEqual(callback.task, album_updated.name)
+        self.assertEqual(callback.args, (self.album.id, result.id, 0))
+        # The callback finishes the job once the chunks are done
+        counts = [save_photos(*signature.args) for signature in header]
+        self.assertEqual(album_updated(counts, *callback.args), 'Updated 3 photos, 0 up to date (Album)')
+        self.assertEqual(progress.jobs(self.album.directory), {})
+
+    @mock.patch('gallery.tasks.chord')
+    def test_failed_update(self, chord):
+        self.assertTrue(locks.acquire(f'album-update:{self.album.id}', 60))
+        result = async_save_photo.apply(args=(self.album.id, True))
+        callback = chord.return_value.call_args[0][0]
+        errback = callback.options['link_error'][0]
+        self.assertEqual(errback.task, album_update_failed.name)
+        self.assertEqual(errback.args, (self.album.id, result.id))
+        self.assertEqual(Album.objects.get(pk=self.album.pk).pending_updates, 3)
+        # The errback is called with the failed task, which it ignores
+        errback('task-id')
+        self.assertEqual(progress.jobs(self.album.directory), {})
+        self.assertTrue(locks.acquire(f'album-update:{self.album.id}', 60))
+
+    def test_empty_album(self):
+        self.assertEqual(
+            async_save_photo.apply(args=(self.other_album.id,)).get(),
+            'Updated 0 photos, 0 up to date (Album 2)'
+        )
+
+    @mock.patch('gallery.tasks.chord')
+    def test_incremental(self, chord):
+        self.assertEqual(async_save_photo.apply(args=(self.album.id,)).get(), 'Updated 0 photos, 3 up to date (Album)')
+        chord.assert_not_called()
+        photo = Photo.objects.get(title='Photo 0')
+        source = next(iter(photo.renditions['thumbnail']['sources'].values()))
+        remove(path.join(tempfile.gettempdir(), source))
+        self.assertTrue(photo.is_outdated())
+        result = async_save_photo.apply(args=(self.album.id,))
+        self.assertEqual(result.get(), 'Updating 1 photos in 1 chunks, 2 up to date (Album)')
+        header = chord.call_args[0][0]
+        self.assertEqual([signature.args for signature in header], [(self.album.id, [photo.id], result.id)])
+        save_photos(*header[0].args)
+        self.assertFalse(Photo.objects.get(pk=photo.pk).is_outdated())
+
+    def test_outdated_spec(self):
+        photo = Photo.objects.get(title='Photo 1')
+        self.assertFalse(photo.is_outdated())
+        with self.settings(RENDITION_ENCODER_PROFILE='smallest'):
+            self.assertTrue(photo.is_outdated())
+
+
+@override_settings(
+    MEDIA_ROOT=tempfile.gettempdir(), RENDITION_UPLOAD_PROFILE='fast', RENDITION_ENCODER_PROFILE='smallest'
+)
+class TestUploadProfile(TestCase):
+    def setUp(self):
+        redis_client._client['failed'] = 0
+        patcher = mock.patch('gallery.redis_client.get_redis', return_value=FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.temp_file = tempfile.NamedTemporaryFile(delete=True, suffix='.jpg')
+        Image.new('RGB', (500, 400), color=(4, 5, 6)).save(self.temp_file, format='JPEG')
+        self.temp_file.flush()
+        with mock.patch('gallery.models.post_process_image'):
+            self.photo = Photo(
+                title='Upload', image=self.temp_file.name, album=Album.objects.create(title='Album'), ready=False
+            )
+            self.photo.save()
+
+    @mock.patch('gallery.tasks.save_exif_data.delay')
+    @mock.patch('gallery.tasks.complete_renditions.delay')
+    def test_encoded_again_in_background(self, complete, save_exif_data):
+        post_process_image(self.photo.id)
+        photo = Photo.objects.get(pk=self.photo.pk)
+        fast_file = photo.thumbnail_img.path
+        self.assertEqual(path.basename(fast_file), rendition_specs('fast')[0].key + '.jpg')
+        complete.assert_called_once_with(photo.id)
+        complete_renditions(photo.id)
+        photo.refresh_from_db()
+        self.assertEqual(path.basename(photo.thumbnail_img.name), rendition_specs()[0].key + '.jpg')
+        self.assertTrue(path.isfile(photo.thumbnail_img.path))
+        self.assertFalse(path.isfile(fast_file))
+
+    @mock.patch('gallery.tasks.save_exif_data.delay')
+    @mock.patch('gallery.tasks.complete_renditions.delay')
+    def test_shared_renditions_encoded_again(self, complete, save_exif_data):
+        post_process_image(self.photo.id)
+        photo = Photo.objects.get(pk=self.photo.pk)
+        fast_file = photo.thumbnail_img.path
+        copy = tempfile.NamedTemporaryFile(delete=True, suffix='.jpg')
+        with open(self.temp_file.name, 'rb') as f:
+            copy.write(f.read())
+        copy.flush()
+        duplicate = Photo(title='Duplicate', image=copy.name, album=photo.album)
+        duplicate.link_renditions(photo)
+        duplicate.save()
+        complete_renditions(photo.id)
+        photo.refresh_from_db()
+        duplicate.refresh_from_db()
+        self.assertEqual(duplicate.renditions, photo.renditions)
+        self.assertTrue(path.isfile(duplicate.thumbnail_img.path))
+        # No photo uses the files of the upload profile anymore
+        self.assertFalse(path.isfile(fast_file))
+
+
+class TestTaskRoutes(TestCase):
+    def queue(self, task):
+        return app.amqp.router.route({}, task)['queue'].name
+
+    def test_upload_before_album_updates(self):
+        self.assertEqual(self.queue('gallery.tasks.post_process_image'), 'interactive')
+        self.assertEqual(self.queue('gallery.tasks.complete_renditions'), 'renditions')
+        self.assertEqual(self.queue('gallery.tasks.save_photos'), 'bulk')
+        self.assertEqual(self.queue('gallery.tasks.update_photo_geocoding'), 'geocoding')
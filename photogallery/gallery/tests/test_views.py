@@ -1,12 +1,25 @@
 import json
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from hashlib import sha256
+from io import BytesIO
+from os import chdir, getcwd, makedirs, path
+from time import time
+from unittest import mock
+from zipfile import ZipFile
 
 from PIL import Image
-from django.contrib.auth.models import User
+from django.contrib.auth.models import Permission, User
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import TestCase, override_settings
 from django.urls import reverse
 
-from gallery.models import Album, Photo
+from gallery import progress, redis_client
+from gallery.models import Album, Photo, Upload
+from gallery.renditions import rendition_specs
+from gallery.tasks import expire_uploads, post_process_image
+from gallery.tests.test_locks import FakeRedis
 
 
 def get_temporary_image(temp_file, width, height):
@@ -148,6 +161,28 @@ class TestAlbumView(TestCase):
     def test_description(self):
         self.assertContains(self.response, 'Test description')
 
+    def test_original_format_without_accept(self):
+        self.assertContains(self.response, self.photo.thumbnail_img.url + '"')
+        self.assertIn('Accept', [header.strip() for header in self.response['Vary'].split(',')])
+
+    def test_webp_thumbnails(self):
+        response = self.client.get(self.url, HTTP_ACCEPT='text/html,image/webp,*/*;q=0.8')
+        self.assertContains(response, self.photo.thumbnail_img.url + '.webp 380w')
+        self.assertContains(response, self.photo.hidpi_thumbnail_img.url + '.webp 600w')
+
+    def test_client_hints(self):
+        self.assertIn('DPR', self.response['Accept-CH'])
+        response = self.client.get(self.url, HTTP_SEC_CH_DPR='2')
+        self.assertContains(response, f'src="{self.photo.hidpi_thumbnail_img.url}"')
+
+    def test_rejected_format(self):
+        response = self.client.get(self.url, HTTP_ACCEPT='text/html,image/webp;q=0')
+        self.assertNotContains(response, '.webp')
+
+    def test_placeholder(self):
+        placeholder = Photo.objects.get(pk=self.photo.pk).placeholder
+        self.assertContains(self.response, f'style="background: url({placeholder}) center / cover no-repeat"')
+
     def test_page_loads_logged_in(self):
         self.client.force_login(User.objects.get_or_create(username='user')[0])
         self.response = self.client.get(self.url)
@@ -194,6 +229,89 @@ class TestAlbumLargeView(TestCase):
         self.assertTrue(self.response.context['user'].is_authenticated)
 
 
+@override_settings(MEDIA_ROOT=tempfile.gettempdir())
+class TestAlbumProgressStream(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.album = Album.objects.create(title='Test Album')
+        cls.temp_file = get_temporary_image(tempfile.NamedTemporaryFile(suffix='.jpg'), 100, 100)
+        cls.url = reverse('gallery:album-progress', kwargs={'slug': cls.album.directory})
+
+    def setUp(self):
+        redis_client._client['failed'] = 0
+        patcher = mock.patch('gallery.redis_client.get_redis', return_value=FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        with mock.patch('gallery.models.post_process_image'):
+            Photo(title='Photo', image=self.temp_file.name, album=self.album, ready=False).save()
+        self.client.force_login(User.objects.get_or_create(username='user')[0])
+
+    def events(self, response):
+        for chunk in response.streaming_content:
+            for line in chunk.decode().splitlines():
+                if line.startswith('data: '):
+                    yield json.loads(line[len('data: '):])
+
+    def test_pushed_changes(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = self.events(response)
+        self.assertEqual(next(events), {'post_processing': 1, 'updating': 0, 'failed': 0})
+        progress.start(self.album.directory, 'job', 3)
+        self.assertEqual(next(events), {'post_processing': 1, 'updating': 3, 'failed': 0})
+        progress.publish(self.album.directory, post_processing=0)
+        progress.advance(self.album.directory, 'job', done=2, failed=1)
+        self.assertEqual(next(events), {'post_processing': 0, 'updating': 3, 'failed': 0})
+        # The stream ends when nothing is pending
+        self.assertEqual(list(events), [{'post_processing': 0, 'updating': 0, 'failed': 1}])
+
+    def test_without_redis(self):
+        redis_client._client['failed'] = time()
+        response = self.client.get(self.url)
+        self.assertEqual(list(self.events(response)), [{'post_processing': 1, 'updating': 0, 'failed': 0}])
+
+    def test_anonymous_access(self):
+        self.client.logout()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 302)
+
+
+class TestDownloadZipView(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.album = Album.objects.create(title='Zip Album', downloadable=True)
+        makedirs(path.join(self.media_root.name, self.album.media_dir))
+        # Stored relative to MEDIA_ROOT, like uploaded photos
+        for name in ['a.jpg', 'b.jpg']:
+            image = path.join(self.album.media_dir, name)
+            get_temporary_image(path.join(self.media_root.name, image), width=10, height=10)
+            Photo(title=name, image=image, album=self.album).save()
+        Photo.objects.filter(album=self.album).update(ready=True)
+        self.url = reverse('gallery:album-download', kwargs={'slug': self.album.directory})
+
+    def test_download(self):
+        # Another request may change the working directory while the files are read
+        working_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(working_dir.cleanup)
+        self.addCleanup(chdir, getcwd())
+        responses = [self.client.get(self.url) for index in range(4)]
+        chdir(working_dir.name)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            contents = list(executor.map(lambda response: b''.join(response.streaming_content), responses))
+        self.assertEqual(getcwd(), path.realpath(working_dir.name))
+        self.assertEqual(responses[0]['Content-Type'], 'application/zip')
+        for content in contents:
+            self.assertEqual(sorted(ZipFile(BytesIO(content)).namelist()), ['a.jpg', 'b.jpg'])
+
+    def test_not_downloadable(self):
+        Album.objects.filter(pk=self.album.pk).update(downloadable=False)
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+
 @override_settings(MEDIA_ROOT=tempfile.gettempdir())
 class TestPhotoView(TestCase):
     @classmethod
@@ -685,3 +803,309 @@ class TestSearchAPIView(TestCase):
         self.assertEqual(data['results'][0]['description'], 'xyz')
         self.assertEqual(data['results'][0]['url'], self.photo2.get_absolute_url())
         self.assertEqual(data['results'][0]['image'], self.photo2.thumbnail_img.url)
+
+
+@override_settings(MEDIA_ROOT=tempfile.gettempdir())
+class TestAlbumDetailAPIView(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.album = Album.objects.create(title='Test Album')
+        temp_file = tempfile.NamedTemporaryFile(delete=True, suffix='.jpg')
+        cls.test_image = get_temporary_image(temp_file, width=100, height=100)
+        cls.photo = Photo(title='Test Photo', image=cls.test_image.name, album=cls.album)
+        cls.photo.save()
+        cls.url = reverse('gallery:album-detail', kwargs={'pk': cls.album.id})
+
+    def test_original_format(self):
+        response = self.client.get(self.url, HTTP_ACCEPT='application/json')
+        photo = json.loads(response.content)['photos'][0]
+        self.assertTrue(photo['thumbnail_img'].endswith(self.photo.thumbnail_img.url))
+        self.assertIsNone(photo['preview_img'])
+
+    def test_webp_format(self):
+        response = self.client.get(self.url, HTTP_ACCEPT='application/json, image/webp')
+        photo = json.loads(response.content)['photos'][0]
+        self.assertTrue(photo['thumbnail_img'].endswith(self.photo.thumbnail_img.url + '.webp'))
+        self.assertTrue(photo['hidpi_thumbnail_img'].endswith(self.photo.hidpi_thumbnail_img.url + '.webp'))
+
+    def test_rendition_groups(self):
+        response = self.client.get(self.url, HTTP_ACCEPT='application/json')
+        thumbnails = json.loads(response.content)['photos'][0]['renditions']['thumbnails']
+        self.assertTrue(thumbnails['src'].endswith(self.photo.thumbnail_img.url))
+        self.assertIn(self.photo.hidpi_thumbnail_img.url + ' 600w', thumbnails['srcset'])
+        self.assertEqual(thumbnails['sizes'], '(max-width: 767px) 50vw, 282px')
+
+    def test_dimensions(self):
+        response = self.client.get(self.url, HTTP_ACCEPT='application/json')
+        photo = json.loads(response.content)['photos'][0]
+        self.assertEqual((photo['width'], photo['height'], photo['aspect_ratio']), (100, 100, 1.0))
+        thumbnails = photo['renditions']['thumbnails']
+        self.assertEqual((thumbnails['width'], thumbnails['height'], thumbnails['aspect_ratio']), (600, 600, 1.0))
+
+
+@override_settings(MEDIA_ROOT=tempfile.gettempdir(), RESIZE_CACHE_DIR=path.join(tempfile.gettempdir(), 'resized'))
+class TestResizedPhotoView(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.album = Album.objects.create(title='Test Album')
+        temp_file = tempfile.NamedTemporaryFile(delete=True, suffix='.jpg')
+        cls.test_image = get_temporary_image(temp_file, width=1000, height=500)
+        cls.photo = Photo(title='Test Photo', image=cls.test_image.name, album=cls.album)
+        cls.photo.save()
+
+    def get_image(self, response):
+        return Image.open(BytesIO(b''.join(response.streaming_content)))
+
+    def test_contain(self):
+        response = self.client.get(self.photo.resize_url(400, 400))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertIn('Accept', response['Vary'])
+        self.assertEqual(self.get_image(response).size, (400, 200))
+
+    def test_cover(self):
+        response = self.client.get(self.photo.resize_url(200, 200, 'cover', 'jpeg'))
+        self.assertEqual(self.get_image(response).size, (200, 200))
+        self.assertNotIn('Accept', [header.strip() for header in response.get('Vary', '').split(',')])
+
+    def test_negotiated_format(self):
+        response = self.client.get(self.photo.resize_url(200, 200), HTTP_ACCEPT='image/webp,*/*')
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertEqual(self.get_image(response).format, 'WEBP')
+
+    def test_invalid_signature(self):
+        url = self.photo.resize_url(200, 200).replace('w=200', 'w=2000')
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+    def test_signing_api(self):
+        url = reverse('gallery:photo-resize-url', kwargs={'pk': self.photo.id})
+        response = self.client.get(url, {'w': 300, 'h': 300, 'fit': 'cover'})
+        self.assertEqual(response.status_code, 200)
+        image_response = self.client.get(json.loads(response.content)['url'])
+        self.assertEqual(self.get_image(image_response).size, (320, 320))
+        response = self.client.get(url, {'w': 300, 'h': 300, 'fit': 'stretch'})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(MEDIA_ROOT=tempfile.gettempdir())
+class TestPhotoUploadAPIView(TestCase):
+    def setUp(self):
+        user = User.objects.get_or_create(username='user')[0]
+        user.user_permissions.add(Permission.objects.get(codename='add_photo'))
+        self.client.force_login(user)
+        self.album = Album.objects.create(title='Upload Album')
+        self.content = self.get_content(color=(1, 2, 3))
+        self.temp_file = tempfile.NamedTemporaryFile(delete=True, suffix='.jpg')
+        self.temp_file.write(self.content)
+        self.temp_file.flush()
+        self.existing = Photo(title='Existing', image=self.temp_file.name, album=self.album)
+        self.existing.save()
+
+    def get_content(self, color):
+        content = BytesIO()
+        Image.new('RGB', (500, 400), color=color).save(content, format='JPEG')
+        return content.getvalue()
+
+    def upload(self, content, name='upload.jpg'):
+        return self.client.post(reverse('gallery:upload'), {
+            'album': self.album.id,
+            'files': [SimpleUploadedFile(name, content, content_type='image/jpeg')],
+        })
+
+    def test_new_photo_hashed_while_uploaded(self):
+        content = self.get_content(color=(4, 5, 6))
+        with mock.patch('gallery.models.post_process_image'), mock.patch('gallery.models.calc_hash') as calc_hash:
+            response = self.upload(content)
+        self.assertEqual(response.status_code, 201)
+        calc_hash.assert_not_called()
+        photo = Photo.objects.get(title='upload')
+        self.assertEqual(photo.file_hash, sha256(content).hexdigest())
+        self.assertEqual(path.dirname(photo.image.name), 'photos/upload-album')
+        with open(photo.image.path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_duplicate_linked(self):
+        with mock.patch('gallery.renditions._save') as save:
+            response = self.upload(self.content)
+        self.assertEqual(json.loads(response.content), {'newPhotos': 1, 'rejectedPhotos': 0, 'duplicatePhotos': 1})
+        save.assert_not_called()
+        photo = Photo.objects.get(title='upload')
+        self.assertTrue(photo.ready)
+        self.assertEqual(photo.file_hash, self.existing.file_hash)
+        self.assertEqual(photo.renditions, self.existing.renditions)
+        self.assertEqual(photo.thumbnail_img.name, self.existing.thumbnail_img.name)
+
+    def test_duplicate_with_legacy_renditions_processed(self):
+        legacy_file = path.join('previews', self.album.directory, 'existing.jpg')
+        renditions = {
+            name: dict(rendition, sources={'image/jpeg': legacy_file})
+            for name, rendition in self.existing.renditions.items()
+        }
+        Photo.objects.filter(pk=self.existing.pk).update(renditions=renditions, thumbnail_img=legacy_file)
+        with mock.patch('gallery.models.post_process_image') as post_process_image:
+            response = self.upload(self.content)
+        self.assertEqual(json.loads(response.content), {'newPhotos': 1, 'rejectedPhotos': 0, 'duplicatePhotos': 1})
+        photo = Photo.objects.get(title='upload')
+        self.assertFalse(photo.ready)
+        self.assertEqual(photo.renditions, {})
+        post_process_image.delay.assert_called_once_with(photo.id)
+
+    @override_settings(RENDITION_UPLOAD_PROFILE='fast')
+    def test_new_photo_completed_in_background(self):
+        with mock.patch('gallery.tasks.post_process_image.delay') as post_process:
+            self.upload(self.get_content(color=(4, 5, 6)))
+        photo = Photo.objects.get(title='upload')
+        self.assertFalse(photo.ready)
+        post_process.assert_called_once_with(photo.id)
+        with mock.patch('gallery.tasks.complete_renditions.delay') as complete, \
+                mock.patch('gallery.tasks.save_exif_data.delay') as save_exif_data:
+            post_process_image(photo.id)
+        photo.refresh_from_db()
+        self.assertTrue(photo.ready)
+        self.assertEqual({rendition['group'] for rendition in photo.renditions.values()}, {'thumbnails'})
+        self.assertEqual(path.basename(photo.thumbnail_img.name), rendition_specs('fast')[0].key + '.jpg')
+        complete.assert_called_once_with(photo.id)
+        save_exif_data.assert_called_once_with(photo.id)
+
+    @override_settings(UPLOAD_DUPLICATES='skip')
+    def test_duplicate_skipped(self):
+        response = self.upload(self.content)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(json.loads(response.content)['duplicatePhotos'], 1)
+        self.assertEqual(Photo.objects.filter(album=self.album).count(), 1)
+
+
+@override_settings(MEDIA_ROOT=tempfile.gettempdir())
+class TestResumableUpload(TestCase):
+    def setUp(self):
+        self.user = User.objects.get_or_create(username='user')[0]
+        self.user.user_permissions.add(Permission.objects.get(codename='add_photo'))
+        self.client.force_login(self.user)
+        self.album = Album.objects.create(title='Resumable Album')
+        self.content = BytesIO()
+        Image.new('RGB', (500, 400), color=(7, 8, 9)).save(self.content, format='JPEG')
+        self.content = self.content.getvalue()
+
+    def create(self, content_type='image/jpeg'):
+        return self.client.post(reverse('gallery:upload-list'), {
+            'album': self.album.id,
+            'name': 'resumed.jpg',
+            'size': len(self.content),
+            'content_type': content_type,
+        }, content_type='application/json')
+
+    def send(self, url, offset, end):
+        return self.client.patch(
+            url, self.content[offset:end], content_type='application/offset+octet-stream', HTTP_UPLOAD_OFFSET=offset
+        )
+
+    def test_resume(self):
+        response = self.create()
+        self.assertEqual(response.status_code, 201)
+        url = response['Location']
+        upload = Upload.objects.get(pk=response.data['id'])
+        half = len(self.content) // 2
+        with mock.patch('gallery.models.post_process_image') as post_process_image:
+            self.assertEqual(self.send(url, 0, half)['Upload-Offset'], str(half))
+            self.assertEqual(self.client.head(url)['Upload-Offset'], str(half))
+            post_process_image.delay.assert_not_called()
+            # A chunk that was already received
+            response = self.send(url, 0, half)
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(response['Upload-Offset'], str(half))
+            response = self.send(url, half, None)
+        self.assertEqual(response.status_code, 200)
+        photo = Photo.objects.get(pk=response.data['photo'])
+        post_process_image.delay.assert_called_once_with(photo.id)
+        self.assertEqual(photo.album, self.album)
+        self.assertEqual(photo.title, 'resumed')
+        self.assertEqual(photo.file_hash, sha256(self.content).hexdigest())
+        with open(photo.image.path, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertFalse(path.exists(upload.staging_file))
+        self.assertEqual(self.send(url, len(self.content), None).status_code, 409)
+
+    def test_chunk_too_long(self):
+        url = self.create()['Location']
+        response = self.client.patch(
+            url, self.content + b'extra', content_type='application/offset+octet-stream', HTTP_UPLOAD_OFFSET=0
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response['Upload-Offset'], '0')
+
+    def test_other_user(self):
+        response = self.create()
+        url = response['Location']
+        self.assertEqual(Upload.objects.get(pk=response.data['id']).user, self.user)
+        other_user = User.objects.create(username='other')
+        self.client.force_login(other_user)
+        self.assertEqual(self.create().status_code, 403)
+        other_user.user_permissions.add(Permission.objects.get(codename='add_photo'))
+        self.assertEqual(self.client.head(url).status_code, 404)
+        self.assertEqual(self.send(url, 0, None).status_code, 404)
+        self.assertEqual(self.client.delete(url).status_code, 404)
+        self.assertTrue(Upload.objects.filter(pk=response.data['id']).exists())
+
+    def test_unsupported_type(self):
+        self.assertEqual(self.create(content_type='text/plain').status_code, 400)
+        self.assertFalse(Upload.objects.exists())
+
+    @override_settings(UPLOAD_DUPLICATES='skip')
+    def test_duplicate_skipped(self):
+        temp_file = tempfile.NamedTemporaryFile(delete=True, suffix='.jpg')
+        temp_file.write(self.content)
+        temp_file.flush()
+        existing = Photo(title='Existing', image=temp_file.name, album=self.album)
+        existing.save()
+        response = self.create()
+        upload = Upload.objects.get(pk=response.data['id'])
+        response = self.send(response['Location'], 0, None)
+        self.assertEqual((response.data['photo'], response.data['duplicate']), (None, existing.id))
+        self.assertEqual(Photo.objects.filter(album=self.album).count(), 1)
+        self.assertFalse(path.exists(upload.staging_file))
+
+    def test_cancel_and_expire(self):
+        response = self.create()
+        self.send(response['Location'], 0, 100)
+        upload = Upload.objects.get(pk=response.data['id'])
+        self.assertTrue(path.isfile(upload.staging_file))
+        self.assertEqual(self.client.delete(response['Location']).status_code, 204)
+        self.assertFalse(path.exists(upload.staging_file))
+
+        upload = Upload.objects.get(pk=self.create().data['id'])
+        expire_uploads()
+        self.assertTrue(Upload.objects.filter(pk=upload.pk).exists())
+        Upload.objects.filter(pk=upload.pk).update(created=upload.created - timedelta(days=2))
+        expire_uploads()
+        self.assertFalse(Upload.objects.filter(pk=upload.pk).exists())
+        self.assertFalse(path.exists(upload.staging_file))
+
+
+@override_settings(MEDIA_ROOT=tempfile.gettempdir())
+class TestSimilarPhotoList(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.album = Album.objects.create(title='Test Album')
+        cls.temp_files = []
+        cls.photos = []
+        for color in ((200, 100, 50), (205, 105, 55)):
+            temp_file = tempfile.NamedTemporaryFile(delete=True, suffix='.jpg')
+            image = Image.new('RGB', (400, 300), color=color)
+            image.paste((20, 40, 60), (0, 0, 200, 300))
+            image.save(temp_file, format='JPEG')
+            cls.temp_files.append(temp_file)
+            photo = Photo(title='Similar Photo', image=temp_file.name, album=cls.album)
+            photo.save()
+            cls.photos.append(photo)
+        cls.url = reverse('gallery:photo-similar', kwargs={'pk': cls.photos[0].id})
+
+    def test_similar_photos(self):
+        self.client.force_login(User.objects.get_or_create(username='user')[0])
+        response = self.client.get(self.url, {'distance': 2})
+        data = json.loads(response.content)
+        self.assertEqual([photo['id'] for photo in data], [self.photos[1].id])
+        self.assertEqual(data[0]['distance'], 0)
+        self.assertEqual(data[0]['album'], self.album.id)
+
+    def test_anonymous_access(self):
+        self.assertEqual(self.client.get(self.url).status_code, 401)
@@ -0,0 +1,62 @@
+import tempfile
+from os import makedirs, path, utime
+from time import monotonic, time
+from unittest import mock
+
+from PIL import Image
+from django.test import TestCase, override_settings
+
+from gallery.models import Album, Photo
+from gallery.watcher import DirectoryPoller, Ingester, album_directory
+
+
+class TestWatcher(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.album = Album.objects.create(title='Watched album')
+        self.album_dir = path.join(self.media_root.name, self.album.media_dir)
+        makedirs(self.album_dir)
+        patcher = mock.patch('gallery.models.post_process_photos')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def add_file(self, name, age):
+        file = path.join(self.album_dir, name)
+        Image.new('RGB', (10, 10)).save(file, format='JPEG')
+        utime(file, (time() - age, time() - age))
+        return file
+
+    def test_album_directory(self):
+        self.assertEqual(album_directory(path.join(self.album_dir, 'a.jpg')), 'watched-album')
+        self.assertIsNone(album_directory(path.join(self.media_root.name, 'photos', 'a.jpg')))
+        self.assertIsNone(album_directory(path.join(self.media_root.name, 'renditions', 'ab', 'a.jpg')))
+
+    def test_settle_time(self):
+        ingester = Ingester(settle_time=5)
+        ingester.file_changed(self.add_file('old.jpg', age=60))
+        ingester.file_changed(self.add_file('new.jpg', age=0))
+        self.assertEqual(ingester.run_due(), [])
+        self.assertEqual(ingester.run_due(now=monotonic() + 5), ['watched-album'])
+        self.assertEqual(list(Photo.objects.filter(album=self.album).values_list('title', flat=True)), ['old'])
+        # The file that was still being written is added by the next scan
+        self.assertIn('watched-album', ingester.pending)
+        utime(path.join(self.album_dir, 'new.jpg'), (time() - 60, time() - 60))
+        self.assertEqual(ingester.run_due(now=monotonic() + 10), ['watched-album'])
+        self.assertEqual(Photo.objects.filter(album=self.album).count(), 2)
+        self.assertEqual(ingester.pending, {})
+
+    def test_poller(self):
+        ingester = Ingester(settle_time=0)
+        poller = DirectoryPoller(ingester)
+        poller.poll()
+        ingester.run_due()
+        poller.poll()
+        self.assertEqual(ingester.pending, {})
+        self.add_file('a.jpg', age=60)
+        poller.poll()
+        self.assertEqual(ingester.run_due(), ['watched-album'])
+        self.assertTrue(Photo.objects.filter(album=self.album, title='a').exists())
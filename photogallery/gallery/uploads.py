@@ -0,0 +1,66 @@
+import tempfile
+from os import makedirs, path
+
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile, UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+
+from .utils import HASH_ALGORITHMS
+
+# Directory under MEDIA_ROOT for uploads that are still being received
+UPLOAD_STAGING_DIR = 'uploads'
+# Content types of the files the upload API accepts
+UPLOAD_CONTENT_TYPES = ('image/jpeg', 'image/png')
+# Bytes read from the request at a time when a chunk of a resumable upload is appended
+CHUNK_BUFFER_SIZE = 64 * 1024
+
+
+class UploadConflict(Exception):
+    # A chunk that doesn't start where the resumable upload ends, or that arrives while
+    # another chunk of it is being received
+    pass
+
+
+class HashedUploadedFile(TemporaryUploadedFile):
+    # Staged on the same file system as MEDIA_ROOT, so storing the photo is a rename
+    # instead of a copy. file_hash is set once the whole file has been received.
+    def __init__(self, name, content_type, size, charset, content_type_extra=None):
+        staging_dir = path.join(settings.MEDIA_ROOT, UPLOAD_STAGING_DIR)
+        makedirs(staging_dir, exist_ok=True)
+        file = tempfile.NamedTemporaryFile(suffix='.upload' + path.splitext(name)[1], dir=staging_dir)
+        UploadedFile.__init__(self, file, name, content_type, size, charset, content_type_extra)
+        self.file_hash = None
+
+
+class StagedUploadedFile(UploadedFile):
+    # A resumable upload that has been received completely. Like HashedUploadedFile, it's
+    # moved into place when the photo is saved.
+    def __init__(self, file_path, name, content_type, size, file_hash):
+        UploadedFile.__init__(self, open(file_path, 'rb'), name, content_type, size)
+        self.file_hash = file_hash
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+class HashingUploadHandler(FileUploadHandler):
+    # Hashes uploads with FILE_HASH_ALGORITHM while they're streamed to disk, so that
+    # duplicates can be found before a Photo is created and the original isn't read again
+    def new_file(self, *args, **kwargs):
+        super(HashingUploadHandler, self).new_file(*args, **kwargs)
+        self.file = HashedUploadedFile(self.file_name, self.content_type, 0, self.charset, self.content_type_extra)
+        self.digest = HASH_ALGORITHMS[settings.FILE_HASH_ALGORITHM]()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.digest.update(raw_data)
+        self.file.write(raw_data)
+
+    def file_complete(self, file_size):
+        self.file.seek(0)
+        self.file.size = file_size
+        self.file.file_hash = self.digest.hexdigest()
+        return self.file
+
+    def upload_interrupted(self):
+        if hasattr(self, 'file'):
+            self.file.close()
@@ -17,10 +17,12 @@ urlpatterns = [
     url('album/<slug:slug>/edit', EditAlbumView.as_view(), name='album-edit'),
     url('album/<slug:slug>/scan', ScanNewPhotosView.as_view(), name='album-scan'),
     url('album/<slug:slug>/in-progress', InProgressView.as_view(), name='album-in-progress'),
+    url('album/<slug:slug>/progress', AlbumProgressStreamView.as_view(), name='album-progress'),
     url('album/<slug:slug>/refresh', UpdatePhotosView.as_view(), name='album-update'),
     url('album/<slug:slug>/download', DownloadZipView.as_view(), name='album-download'),
     url('album/<slug:slug>/delete', DeleteAlbumView.as_view(), name='album-delete'),
     url('photo/new', NewPhotoView.as_view(), name='photo-new'),
+    url('photo/<int:pk>/resize', ResizedPhotoView.as_view(), name='photo-resize'),
     url('photo/<slug:slug>', PhotoView.as_view(), name='photo'),
     url('photo/<slug:slug>/map', PhotoMapView.as_view(), name='photo-map'),
     url('photo/<slug:slug>/edit', EditPhotoView.as_view(), name='photo-edit'),
@@ -42,5 +44,9 @@ urlpatterns = [
     url('api/albums', AlbumList.as_view(), name="album-list"),
     url('api/all-albums', AllAlbumsList.as_view(), name="all-albums"),
     url('api/albums/<int:pk>', AlbumDetail.as_view(), name='album-detail'),
-    url('api/upload', PhotoUpload.as_view(), name="upload")
+    url('api/upload', PhotoUpload.as_view(), name="upload"),
+    url('api/uploads', UploadList.as_view(), name='upload-list'),
+    url('api/uploads/<uuid:pk>', UploadDetail.as_view(), name='upload-detail'),
+    url('api/photos/<int:pk>/resize', PhotoResizeURL.as_view(), name='photo-resize-url'),
+    url('api/photos/<int:pk>/similar', SimilarPhotoList.as_view(), name='photo-similar')
 ]
@@ -1,48 +1,113 @@
-from hashlib import sha256
+from functools import wraps
+from hashlib import blake2b, sha256
 from json import load as jsonload
 from logging import getLogger
-from os import environ
+from os import environ, stat
 from urllib import parse, request
 
 from PIL import Image
+from django.conf import settings
 from django.contrib.postgres.search import SearchQuery
+from django.utils.cache import patch_vary_headers
 from psycopg2.extensions import adapt
 
 log = getLogger(__name__)
 
+CLIENT_HINTS = ('Sec-CH-DPR', 'Sec-CH-Width', 'Sec-CH-Viewport-Width', 'DPR', 'Width', 'Viewport-Width')
+
+
+HASH_ALGORITHMS = {
+    'sha256': sha256,
+    # Same digest length as SHA-256, so hashes fit the same fields and paths
+    'blake2b': lambda: blake2b(digest_size=32),
+}
+
+HASH_BUFFER_SIZE = 1024 * 1024
+
 
 def calc_hash(filename):
-    sha2 = sha256()
-    with open(filename, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            sha2.update(chunk)
-    return sha2.hexdigest()
+    digest = HASH_ALGORITHMS[settings.FILE_HASH_ALGORITHM]()
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(filename, 'rb', buffering=0) as f:
+        for size in iter(lambda: f.readinto(buffer), 0):
+            digest.update(view[:size])
+    return digest.hexdigest()
+
+
+def file_fingerprint(filename):
+    # Changes when the file is modified or replaced, without reading its contents.
+    # The hash algorithm is included so that changing it rehashes every photo.
+    stat_result = stat(filename)
+    return (
+        f'{settings.FILE_HASH_ALGORITHM}:{stat_result.st_size}:'
+        f'{stat_result.st_mtime_ns}:{stat_result.st_ino}'
+    )
+
+
+def exif_orientation(image):
+    # The EXIF orientation of any format, 1 if there is none or it can't be read
+    try:
+        orientation = image.getexif().get(0x0112, 1)
+    except Exception:
+        return 1
+    return orientation if orientation in range(1, 9) else 1
 
 
 def auto_orient(image):
-    if hasattr(image, '_getexif'):
-        try:
-            exif = image._getexif()
-        except Exception:
-            exif = None
-        if exif is not None:
-            orientation = exif.get(0x0112, 1)
-            if 1 <= orientation <= 8:
-                operations = {
-                    1: (),
-                    2: (Image.FLIP_LEFT_RIGHT,),
-                    3: (Image.ROTATE_180,),
-                    4: (Image.ROTATE_180, Image.FLIP_LEFT_RIGHT),
-                    5: (Image.ROTATE_270, Image.FLIP_LEFT_RIGHT),
-                    6: (Image.ROTATE_270,),
-                    7: (Image.ROTATE_90, Image.FLIP_LEFT_RIGHT),
-                    8: (Image.ROTATE_90,),
-                }
-                for operation in operations[orientation]:
-                    image = image.transpose(operation)
+    operations = {
+        1: (),
+        2: (Image.FLIP_LEFT_RIGHT,),
+        3: (Image.ROTATE_180,),
+        4: (Image.ROTATE_180, Image.FLIP_LEFT_RIGHT),
+        5: (Image.ROTATE_270, Image.FLIP_LEFT_RIGHT),
+        6: (Image.ROTATE_270,),
+        7: (Image.ROTATE_90, Image.FLIP_LEFT_RIGHT),
+        8: (Image.ROTATE_90,),
+    }
+    for operation in operations[exif_orientation(image)]:
+        image = image.transpose(operation)
     return image
 
 
+def _client_hint(meta, name, convert):
+    for header in (f'Sec-CH-{name}', name):
+        value = meta.get('HTTP_' + header.upper().replace('-', '_'))
+        if value:
+            try:
+                return convert(value)
+            except ValueError:
+                return None
+    return None
+
+
+def get_client_hints(request):
+    if request is None:
+        return {'dpr': 1.0, 'width': None, 'viewport_width': None}
+    return {
+        'dpr': _client_hint(request.META, 'DPR', float) or 1.0,
+        'width': _client_hint(request.META, 'Width', int),
+        'viewport_width': _client_hint(request.META, 'Viewport-Width', int),
+    }
+
+
+def get_accept(request):
+    if request is None:
+        return ''
+    return request.META.get('HTTP_ACCEPT', '')
+
+
+def rendition_negotiation(view):
+    # For views that pick rendition formats and sizes from the request headers
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        response['Accept-CH'] = ', '.join(CLIENT_HINTS)
+        patch_vary_headers(response, ('Accept',) + CLIENT_HINTS)
+        return response
+    return wrapper
+
+
 def google_geocode_lookup(latitude, longitude):
     coordinates = str(latitude) + ',' + str(longitude)
     base_url = 'https://maps.googleapis.com/maps/api/geocode/json?'
@@ -1,5 +1,5 @@
 from logging import getLogger
-from os import chdir, environ
+from os import environ, path
 from urllib import parse
 
 from django.conf import settings
@@ -9,23 +9,32 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.views import LoginView
 from django.contrib.postgres.search import SearchRank, SearchVector
 from django.db.models import Count, Q
-from django.http import HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.core.signing import BadSignature
+from django.http import (
+    FileResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+)
 from django.shortcuts import get_object_or_404, redirect
 from django.urls import reverse_lazy
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.decorators import method_decorator
 from django.utils.http import is_safe_url
 from django.utils.translation import ugettext_lazy as _
 from django.views.generic import ListView, DetailView, View
 from django.views.generic.edit import CreateView, UpdateView, DeleteView, FormView
 from zipstream import ZipFile, ZIP_STORED
 
+from . import progress
 from .forms import *
 from .models import Album, Photo, ExifData
-from .tasks import async_save_photo, update_album_localities
-from .utils import PartialQuery
+from .rendition_cache import get_cache
+from .renditions import MIME_TYPES, can_write, render_resized, resize_cache_key, resize_format, verify_resize
+from .tasks import update_album, update_album_localities
+from .utils import PartialQuery, get_accept, get_client_hints, rendition_negotiation
 
 log = getLogger(__name__)
 
 
+@method_decorator(rendition_negotiation, name='dispatch')
 class IndexView(ListView):
     template_name = 'index.html'
     context_object_name = 'albums'
@@ -53,6 +62,7 @@ class IndexView(ListView):
             )
 
 
+@method_decorator(rendition_negotiation, name='dispatch')
 class AlbumView(ListView):
     template_name = 'album.html'
     context_object_name = 'photos'
@@ -93,6 +103,7 @@ class AlbumView(ListView):
         return context
 
 
+@method_decorator(rendition_negotiation, name='dispatch')
 class LargeAlbumView(ListView):
     template_name = 'album-large.html'
     context_object_name = 'photos'
@@ -151,14 +162,16 @@ class DownloadZipView(View):
             .iterator()
         )
         file = ZipFile(mode='w', compression=ZIP_STORED)
-        chdir(settings.MEDIA_ROOT)
+        # The files are read while the response streams, maybe on another thread, so
+        # their paths can't depend on the working directory
         for photo in photos:
-            file.write(photo, path.basename(photo))
+            file.write(path.join(settings.MEDIA_ROOT, photo), path.basename(photo))
         response = StreamingHttpResponse(file, content_type='application/zip')
         response['Content-Disposition'] = f'attachment; filename={album.directory}.zip'
         return response
 
 
+@method_decorator(rendition_negotiation, name='dispatch')
 class PhotoView(DetailView):
     model = Photo
     slug_field = 'slug'
@@ -167,6 +180,33 @@ class PhotoView(DetailView):
     queryset = Photo.objects.select_related('album', 'exifdata')
 
 
+class ResizedPhotoView(View):
+    def get(self, request, *args, **kwargs):
+        try:
+            width, height, fit, image_format = verify_resize(kwargs['pk'], request.GET)
+        except BadSignature:
+            return HttpResponseForbidden()
+        photo = get_object_or_404(Photo, pk=kwargs['pk'], ready=True)
+        output_format = resize_format(image_format, photo.image.name, get_accept(request))
+        if not can_write(output_format):
+            return HttpResponseBadRequest()
+        quality = settings.RESIZE_QUALITY
+        profile = settings.RESIZE_ENCODER_PROFILE
+        key = resize_cache_key(photo.file_hash, width, height, fit, output_format, quality, profile)
+        file = get_cache().get_or_create(
+            key,
+            lambda output_file: render_resized(
+                photo.image.path, output_file, width, height, fit, output_format, quality, profile
+            )
+        )
+        response = FileResponse(file, content_type=MIME_TYPES[output_format])
+        response['ETag'] = f'"{key}"'
+        patch_cache_control(response, public=True, max_age=settings.RESIZE_CACHE_SECONDS)
+        if image_format == 'auto':
+            patch_vary_headers(response, ('Accept',))
+        return response
+
+
 class PhotoMapView(LoginRequiredMixin, DetailView):
     model = Photo
     slug_field = 'slug'
@@ -241,16 +281,14 @@ class MassUploadView(LoginRequiredMixin, FormView):
         files = request.FILES.getlist('image')
         if form.is_valid():
             album = Album.objects.get(pk=form.instance.album.id)
+            duplicates = 0
             for file in files:
-                title = path.splitext(file.name)[0]
-                instance = Photo(
-                    title=title,
-                    album_id=form.instance.album.id,
-                    ready=False,
-                    image=file)
-                instance.save()
+                photo, duplicate = album.add_uploaded_photo(file)
+                if duplicate:
+                    duplicates += 1
             return JsonResponse({
                 'message': 'OK',
+                'duplicates': duplicates,
                 'successUrl': album.get_absolute_url()
             })
         else:
@@ -276,19 +314,30 @@ class ScanNewPhotosView(LoginRequiredMixin, View):
 class InProgressView(LoginRequiredMixin, View):
     def get(self, request, *args, **kwargs):
         album = get_object_or_404(Album, directory=kwargs.get('slug'))
-        post_processing = Photo.objects.filter(album=album.id).filter(ready=False).count()
-        updating = album.pending_updates
-        data = {
-            'post_processing': post_processing,
-            'updating': updating
-        }
-        return JsonResponse(data)
+        return JsonResponse(album.processing_state())
+
+
+class AlbumProgressStreamView(LoginRequiredMixin, View):
+    # Pushes the counts of InProgressView as server-sent events when the tasks change
+    # them, so open pages don't query the database every second
+    def get(self, request, *args, **kwargs):
+        album = get_object_or_404(Album, directory=kwargs.get('slug'))
+        response = StreamingHttpResponse(
+            progress.stream(album.directory, album.processing_state, settings.PROGRESS_STREAM_TIMEOUT),
+            content_type='text/event-stream'
+        )
+        response['Cache-Control'] = 'no-cache'
+        # Keeps nginx from buffering the events
+        response['X-Accel-Buffering'] = 'no'
+        return response
 
 
 class UpdatePhotosView(LoginRequiredMixin, View):
     def get(self, request, *args, **kwargs):
         album = get_object_or_404(Album, directory=kwargs.get('slug'))
-        async_save_photo.delay(album.id)
+        # Only photos that changed are updated unless ?full=1 is given
+        if not update_album(album.id, full=bool(request.GET.get('full'))):
+            messages.info(request, _('The album is already being updated.'))
         return redirect('gallery:album', slug=album.directory)
 
 
@@ -306,6 +355,7 @@ class EditExifDataView(LoginRequiredMixin, UpdateView):
         return super(EditExifDataView, self).form_valid(form)
 
 
+@method_decorator(rendition_negotiation, name='dispatch')
 class SearchView(ListView):
     template_name = 'search.html'
     context_object_name = 'results'
@@ -346,6 +396,7 @@ class SearchView(ListView):
             return Photo.objects.none()
 
 
+@method_decorator(rendition_negotiation, name='dispatch')
 class SearchAPIView(View):
     def get(self, request, *args, **kwargs):
         query = self.request.GET.get('q')
@@ -388,7 +439,8 @@ class SearchAPIView(View):
             item = {
                 'title': result.title,
                 'description': result.description,
-                'image': result.thumbnail_img.url,
+                'image': result.rendition_src('thumbnails', get_accept(request), get_client_hints(request)),
+                'placeholder': result.placeholder,
                 'url': result.get_absolute_url()
             }
             items.append(item)
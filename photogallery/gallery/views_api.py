@@ -1,19 +1,28 @@
 from logging import getLogger
-from os import path
 
+from django.conf import settings
 from django.db.models import Count, Prefetch
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils.decorators import method_decorator
 from rest_framework import generics, permissions
 from rest_framework import status
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from .models import Album, Photo
-from .serializers import AlbumListSerializer, AlbumSerializer, AllAlbumsSerializer
+from .models import Album, Photo, Upload
+from .serializers import (
+    AlbumListSerializer, AlbumSerializer, AllAlbumsSerializer, SimilarPhotoSerializer, UploadSerializer
+)
+from .similarity import similar_photos
+from .uploads import UPLOAD_CONTENT_TYPES, UploadConflict
+from .utils import rendition_negotiation
 
 log = getLogger(__name__)
 
 
+@method_decorator(rendition_negotiation, name='dispatch')
 class AlbumList(generics.ListCreateAPIView):
     serializer_class = AlbumListSerializer
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
@@ -41,6 +50,7 @@ class AlbumList(generics.ListCreateAPIView):
             )
 
 
+@method_decorator(rendition_negotiation, name='dispatch')
 class AlbumDetail(generics.RetrieveUpdateDestroyAPIView):
     queryset = (
         Album.objects
@@ -64,33 +74,129 @@ class AllAlbumsList(generics.ListAPIView):
     queryset = Album.objects.all()
 
 
+class CanAddPhotos(permissions.BasePermission):
+    def has_permission(self, request, view):
+        return request.user.has_perm('gallery.add_photo')
+
+
 class PhotoUpload(APIView):
     parser_classes = (FormParser, MultiPartParser)
-    permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
+    permission_classes = (permissions.IsAuthenticated, CanAddPhotos)
 
     def post(self, request):
         album = request.data['album']
         files = request.FILES.getlist('files')
         album = Album.objects.get(pk=album)
-        accepted_types = ['image/jpeg', 'image/png']
-        results = {'newPhotos': 0, 'rejectedPhotos': 0}
+        results = {'newPhotos': 0, 'rejectedPhotos': 0, 'duplicatePhotos': 0}
 
         for file in files:
             try:
-                if file.content_type in accepted_types:
-                    title = path.splitext(file.name)[0]
-                    instance = Photo(
-                        title=title,
-                        album_id=album.id,
-                        ready=False,
-                        image=file)
-                    instance.save()
-                    results['newPhotos'] += 1
+                if file.content_type in UPLOAD_CONTENT_TYPES:
+                    photo, duplicate = album.add_uploaded_photo(file)
+                    if photo:
+                        results['newPhotos'] += 1
+                    if duplicate:
+                        results['duplicatePhotos'] += 1
                 else:
                     raise Exception(f'Unsupported file type {file.content_type} in {file.name}')
             except Exception as e:
                 log.error(f'Failed to process photo: {file.name} Error: {e}')
                 results['rejectedPhotos'] += 1
-        if results['newPhotos'] == 0:
+        if results['newPhotos'] == 0 and results['duplicatePhotos'] == 0:
             return Response(data=results, status=status.HTTP_406_NOT_ACCEPTABLE)
         return Response(data=results, status=status.HTTP_201_CREATED)
+
+
+def upload_response(upload, data=None, status_code=status.HTTP_200_OK):
+    response = Response(data=UploadSerializer(upload).data if data is None else data, status=status_code)
+    response['Upload-Offset'] = upload.offset
+    response['Upload-Length'] = upload.size
+    response['Cache-Control'] = 'no-store'
+    return response
+
+
+class UploadList(APIView):
+    # Starts a resumable upload of one photo. Its chunks are sent to the returned Location,
+    # see UploadDetail.
+    permission_classes = (permissions.IsAuthenticated, CanAddPhotos)
+
+    def post(self, request):
+        serializer = UploadSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(data=serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        upload = serializer.save(user=request.user)
+        upload.start()
+        response = upload_response(upload, status_code=status.HTTP_201_CREATED)
+        response['Location'] = request.build_absolute_uri(reverse('gallery:upload-detail', kwargs={'pk': upload.pk}))
+        return response
+
+
+class UploadDetail(APIView):
+    # GET and HEAD return the offset where the next chunk of an upload starts. PATCH
+    # appends the request body to the upload at the offset in its Upload-Offset header,
+    # and the photo is added as soon as the last chunk has been received, so uploading
+    # the next file overlaps with processing this one. DELETE cancels the upload. Users
+    # only see their own uploads.
+    permission_classes = (permissions.IsAuthenticated, CanAddPhotos)
+
+    def get_upload(self, request, pk):
+        return get_object_or_404(Upload.objects.filter(user=request.user), pk=pk)
+
+    def get(self, request, pk):
+        return upload_response(self.get_upload(request, pk))
+
+    def patch(self, request, pk):
+        upload = self.get_upload(request, pk)
+        try:
+            offset = int(request.META['HTTP_UPLOAD_OFFSET'])
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except (KeyError, ValueError):
+            return Response(data={'detail': 'Upload-Offset must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            upload.receive(request.stream, offset, length)
+        except UploadConflict as e:
+            return upload_response(upload, {'detail': str(e)}, status.HTTP_409_CONFLICT)
+        except ValueError as e:
+            return upload_response(upload, {'detail': str(e)}, status.HTTP_400_BAD_REQUEST)
+        return upload_response(upload)
+
+    def delete(self, request, pk):
+        self.get_upload(request, pk).delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+@method_decorator(rendition_negotiation, name='dispatch')
+class SimilarPhotoList(APIView):
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request, pk):
+        photo = get_object_or_404(Photo, pk=pk)
+        try:
+            distance = int(request.query_params.get('distance', settings.PERCEPTUAL_HASH_DISTANCE))
+        except ValueError:
+            return Response(data={'detail': 'distance must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        distances = {photo_id: distance for distance, photo_id in similar_photos(photo, distance)}
+        photos = Photo.objects.filter(id__in=distances).filter(ready=True)
+        photos = sorted(photos, key=lambda similar: (distances[similar.id], similar.id))
+        serializer = SimilarPhotoSerializer(
+            photos, many=True, context={'request': request, 'distances': distances}
+        )
+        return Response(data=serializer.data)
+
+
+class PhotoResizeURL(APIView):
+    permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
+
+    def get(self, request, pk):
+        photo = get_object_or_404(Photo, pk=pk, ready=True)
+        params = request.query_params
+        try:
+            url = photo.resize_url(
+                params.get('w', ''),
+                params.get('h', ''),
+                params.get('fit', 'contain'),
+                params.get('format', 'auto')
+            )
+        except ValueError as e:
+            return Response(data={'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(data={'url': request.build_absolute_uri(url)})
@@ -0,0 +1,137 @@
+from logging import getLogger
+from os import path, scandir
+from threading import Lock
+from time import monotonic, sleep, time
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .models import Album
+
+log = getLogger(__name__)
+
+
+def photos_root():
+    return path.join(settings.MEDIA_ROOT, 'photos')
+
+
+def album_directory(file_path):
+    # Directory name of the album a file in the photos directory belongs to
+    relative = path.relpath(file_path, photos_root())
+    parts = relative.split(path.sep)
+    if len(parts) != 2 or parts[0] in (path.curdir, path.pardir):
+        return None
+    return parts[0]
+
+
+class Ingester:
+    # Collects the albums that changed and adds their new files when the files haven't
+    # been modified for settle_time seconds. Changes may come from another thread.
+    def __init__(self, settle_time):
+        self.settle_time = settle_time
+        self.lock = Lock()
+        # Album directory: monotonic time when it's scanned
+        self.pending = {}
+
+    def changed(self, directory, delay=None):
+        # The first change schedules the scan, so a long copy is added in batches
+        # instead of only when it's done
+        with self.lock:
+            self.pending.setdefault(directory, monotonic() + (self.settle_time if delay is None else delay))
+
+    def file_changed(self, file_path):
+        directory = album_directory(file_path)
+        if directory and not path.basename(file_path).startswith('.'):
+            self.changed(directory)
+
+    def run_due(self, now=None):
+        now = monotonic() if now is None else now
+        with self.lock:
+            due = [directory for directory, scan_at in self.pending.items() if scan_at <= now]
+            for directory in due:
+                del self.pending[directory]
+        for directory in due:
+            try:
+                self.ingest(directory)
+            except Exception as e:
+                log.error(f'Failed to add new photos to {directory}: {e}')
+        return due
+
+    def ingest(self, directory):
+        album = Album.objects.filter(directory=directory).first()
+        if not album:
+            return
+        settled = time() - self.settle_time
+        new_photos, errors = album.scan_new_photos(modified_before=settled)
+        if new_photos:
+            log.info(f'Added {new_photos} photos to {album.title}')
+        # Files that were still being written are added by a later scan
+        if len(album.get_photos_in_dir()) > len(album.get_photos_in_dir(settled)):
+            self.changed(directory)
+
+
+class DirectoryPoller:
+    # Finds the album directories that had files added, removed or renamed by their
+    # mtime, without listing their files
+    def __init__(self, ingester):
+        self.ingester = ingester
+        self.mtimes = {}
+
+    def poll(self):
+        mtimes = {}
+        try:
+            with scandir(photos_root()) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        mtimes[entry.name] = entry.stat().st_mtime_ns
+        except FileNotFoundError:
+            pass
+        for directory, mtime in mtimes.items():
+            if self.mtimes.get(directory) != mtime:
+                self.ingester.changed(directory)
+        self.mtimes = mtimes
+
+
+def start_observer(ingester):
+    # Watches the photos directory with inotify. Returns None if watchdog isn't
+    # installed and the directories have to be polled instead.
+    try:
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+    except ImportError:
+        return None
+
+    class Handler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            # Reading the originals doesn't count as a change
+            if event.is_directory or event.event_type not in ('created', 'modified', 'moved', 'closed'):
+                return
+            ingester.file_changed(getattr(event, 'dest_path', None) or event.src_path)
+
+    observer = Observer()
+    observer.schedule(Handler(), photos_root(), recursive=True)
+    observer.start()
+    return observer
+
+
+def watch(settle_time, poll_interval, use_inotify=True):
+    ingester = Ingester(settle_time)
+    # Files copied while nothing was watching
+    for directory in Album.objects.values_list('directory', flat=True):
+        ingester.changed(directory, delay=0)
+    observer = start_observer(ingester) if use_inotify else None
+    poller = None if observer else DirectoryPoller(ingester)
+    log.info(f'Watching {photos_root()} with {"inotify" if observer else "polling"}')
+    next_poll = 0
+    try:
+        while True:
+            if poller and monotonic() >= next_poll:
+                poller.poll()
+                next_poll = monotonic() + poll_interval
+            close_old_connections()
+            ingester.run_due()
+            sleep(1)
+    finally:
+        if observer:
+            observer.stop()
+            observer.join()
@@ -208,16 +208,210 @@ LOGGING = {
             'level': 'INFO',
             'propagate': True,
         },
+        'gallery.watcher': {
+            'handlers': ['console', 'logfile'],
+            'level': 'INFO',
+            'propagate': True,
+        },
     }
 }
 
 # Celery
-CELERY_BROKER_URL = 'redis://redis:6379'
+REDIS_URL = environ.get('REDIS_URL', 'redis://redis:6379')
+
+CELERY_BROKER_URL = REDIS_URL
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 CELERY_RESULT_BACKEND = 'django-db'
+# Stored task results are deleted after this many seconds by celery.backend_cleanup,
+# which celery beat runs every night
+CELERY_RESULT_EXPIRES = int(environ.get('TASK_RESULT_EXPIRE_DAYS', 7)) * 24 * 60 * 60
+CELERY_BEAT_SCHEDULE = {
+    'expire-uploads': {'task': 'gallery.tasks.expire_uploads', 'schedule': 60 * 60},
+}
+
+# Task queues. Workers take tasks from the first queue in their -Q list that has any,
+# so with "-Q interactive,renditions,metadata,bulk,geocoding" a photo that was just
+# uploaded doesn't wait for an album update. Tasks without a route go to the bulk queue.
+CELERY_TASK_DEFAULT_QUEUE = 'bulk'
+CELERY_TASK_ROUTES = {
+    'gallery.tasks.post_process_image': {'queue': 'interactive'},
+    'gallery.tasks.post_process_photos': {'queue': 'interactive'},
+    'gallery.tasks.complete_renditions': {'queue': 'renditions'},
+    'gallery.tasks.save_exif_data': {'queue': 'metadata'},
+    'gallery.tasks.update_photo_geocoding': {'queue': 'geocoding'},
+    'gallery.tasks.update_album_localities': {'queue': 'geocoding'},
+}
+CELERY_BROKER_TRANSPORT_OPTIONS = {'queue_order_strategy': 'priority'}
+# Long rendering tasks aren't reserved in advance, so they can't hold back newer uploads
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+# Photos and albums are locked in Redis while a task processes them, so repeated saves
+# and update requests don't start the same work twice. The locks and the progress of
+# album updates expire after these many seconds in case a worker dies during a job.
+PHOTO_JOB_TIMEOUT = 15 * 60
+ALBUM_JOB_TIMEOUT = 6 * 60 * 60
+
+# Seconds an album progress stream stays open before the browser has to reconnect.
+# Every open stream holds a Gunicorn thread, so streams are kept short like long polls.
+PROGRESS_STREAM_TIMEOUT = int(environ.get('PROGRESS_STREAM_TIMEOUT', 5))
+
+# Album updates are split into tasks of this many photos, which run in parallel
+ALBUM_UPDATE_CHUNK_SIZE = int(environ.get('ALBUM_UPDATE_CHUNK_SIZE', 50))
+
+# Photo renditions
+# Every photo gets the renditions listed here. Renditions in the same group are
+# alternatives for the same slot in the layout and end up in one srcset. Cropped
+# renditions are centered squares, others fit inside a size x size box and are
+# only created when the original is larger.
+#
+# JPEG originals are decoded at 1/2, 1/4 or 1/8 scale when the decoded image is still
+# at least draft_oversampling times larger than every rendition rendered from it.
+# Lower values are faster, higher values give the LANCZOS pass more pixels to work with.
+#
+# A rendition can set 'profile' to one of RENDITION_ENCODER_PROFILES, otherwise it's
+# encoded with RENDITION_ENCODER_PROFILE.
+RENDITIONS = [
+    {
+        'name': 'thumbnail',
+        'group': 'thumbnails',
+        'size': 380,
+        'quality': 80,
+        'crop': True,
+        'draft_oversampling': 2.0,
+    },
+    {
+        'name': 'hidpi_thumbnail',
+        'group': 'thumbnails',
+        'size': 600,
+        'quality': 80,
+        'crop': True,
+        'draft_oversampling': 2.0,
+    },
+    {
+        'name': 'preview',
+        'group': 'previews',
+        'size': 1327,
+        'quality': 90,
+        'draft_oversampling': 1.5,
+    },
+    {
+        'name': 'hidpi_preview',
+        'group': 'previews',
+        'size': 2340,
+        'quality': 90,
+        'draft_oversampling': 1.5,
+    },
+]
+
+# Layout of each rendition group in CSS pixels. display_size is the box the photo is
+# shown in on large screens and sizes is the img sizes attribute, where {width} is
+# replaced with the width of the photo in that box.
+RENDITION_GROUPS = {
+    'thumbnails': {
+        'display_size': 282,
+        'sizes': '(max-width: 767px) 50vw, 282px',
+    },
+    'previews': {
+        'display_size': 1327,
+        'sizes': '(max-width: {width}px) 100vw, {width}px',
+    },
+}
+
+# Additional formats written for every rendition, in order of preference. Formats the
+# installed Pillow can't write are skipped. Each rendition is served in the first one
+# the client lists in its Accept header, or in the format of the original. AVIF needs
+# a Pillow built with libavif, which the pinned pillow-simd 7 isn't.
+RENDITION_EXTRA_FORMATS = [
+    image_format for image_format in environ.get('RENDITION_EXTRA_FORMATS', 'WEBP').upper().split(',') if image_format
+]
+
+# Encoder options of renditions. subsampling is the JPEG chroma subsampling, PNG uses
+# compress_level unless optimize is set, webp_method and avif_speed trade encoding time
+# for size. A profile can also set 'quality' to override the quality of the renditions.
+# Encoding a 2340x1755 preview took 18 ms as JPEG and 0.35 s as PNG with 'fast', 95 ms
+# and 2.2 s with 'balanced' and 95 ms and 5.9 s with 'smallest'. Compared to 'smallest',
+# 'fast' made 6% larger JPEGs and 22% larger PNGs, 'balanced' 2% larger PNGs.
+RENDITION_ENCODER_PROFILES = {
+    'fast': {
+        'optimize': False,
+        'progressive': False,
+        'subsampling': '4:2:0',
+        'compress_level': 1,
+        'webp_method': 0,
+        'avif_speed': 8,
+    },
+    'balanced': {
+        'optimize': True,
+        'progressive': True,
+        'subsampling': '4:2:0',
+        'compress_level': 6,
+        'webp_method': 4,
+        'avif_speed': 6,
+    },
+    'smallest': {
+        'optimize': True,
+        'progressive': True,
+        'subsampling': '4:2:0',
+        'compress_level': 9,
+        'webp_method': 6,
+        'avif_speed': 4,
+    },
+}
+
+RENDITION_ENCODER_PROFILE = environ.get('RENDITION_ENCODER_PROFILE', 'balanced')
+
+# Profile of the renditions created right after an upload. The renditions are then
+# encoded again in the background with the profiles in RENDITIONS. Empty to encode
+# them only once.
+RENDITION_UPLOAD_PROFILE = environ.get('RENDITION_UPLOAD_PROFILE', 'fast')
+
+# Rendition groups created before an uploaded photo is shown. The other groups are
+# created by a follow-up task on the renditions queue.
+RENDITION_UPLOAD_GROUPS = ['thumbnails']
+
+# Number of threads used to encode the renditions of a single photo
+RENDITION_THREADS = int(environ.get('RENDITION_THREADS', 2))
+
+# Digest used for Photo.file_hash, either 'sha256' or 'blake2b'. BLAKE2b is faster on CPUs
+# without SHA instructions, SHA-256 on CPUs that have them. Changing it rehashes every
+# photo on its next save, and renditions are then stored by the new hash.
+FILE_HASH_ALGORITHM = environ.get('FILE_HASH_ALGORITHM', 'sha256')
+
+# Uploads are hashed while they're received and staged under MEDIA_ROOT
+FILE_UPLOAD_HANDLERS = ['gallery.uploads.HashingUploadHandler']
+
+# What to do with uploads identical to an existing photo: 'link' adds the photo using the
+# renditions and EXIF data of the existing one, 'skip' ignores the upload and 'process'
+# handles it like any other upload
+UPLOAD_DUPLICATES = environ.get('UPLOAD_DUPLICATES', 'link')
+
+# Resumable uploads can be continued for this many hours, after which they're removed
+# with what was received of them
+UPLOAD_EXPIRE_HOURS = int(environ.get('UPLOAD_EXPIRE_HOURS', 24))
+
+# Photos whose perceptual hashes differ in at most this many of their 64 bits are near-duplicates
+PERCEPTUAL_HASH_DISTANCE = 6
+
+# On-demand resizing
+# Signed resize URLs render any size of a photo on first request and keep it in a disk
+# cache. The least recently used files are removed when the cache grows over its budget.
+RESIZE_CACHE_DIR = environ.get('RESIZE_CACHE_DIR', path.join(BASE_DIR, 'cache', 'resized'))
+
+RESIZE_CACHE_MAX_BYTES = int(environ.get('RESIZE_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+
+# Requested sizes are rounded up to a multiple of RESIZE_SIZE_STEP and capped at RESIZE_MAX_SIZE
+RESIZE_SIZE_STEP = 40
+
+RESIZE_MAX_SIZE = 4096
+
+RESIZE_QUALITY = 85
+
+RESIZE_ENCODER_PROFILE = 'balanced'
+
+RESIZE_CACHE_SECONDS = 7 * 24 * 60 * 60
 
 # Other
 MEDIA_ROOT = path.join(BASE_DIR, 'media')
@@ -249,8 +443,12 @@ CORS_ALLOW_HEADERS = (
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
+    'upload-offset',
 )
 
+# Read by the front end to resume uploads
+CORS_EXPOSE_HEADERS = ('location', 'upload-offset', 'upload-length')
+
 CORS_ALLOW_CREDENTIALS = True
 
 # Debug configuration
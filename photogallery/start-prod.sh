@@ -3,6 +3,8 @@ python manage.py migrate
 python manage.py collectstatic --noinput
 gunicorn photogallery.wsgi:application \
 --workers $GUNICORN_WORKERS \
+--worker-class gthread \
+--threads ${GUNICORN_THREADS:-4} \
 --bind unix:/run/gallery/gallery.socket \
 --timeout 300 \
 --log-level=info \
@@ -9,6 +9,8 @@ echo "PostgreSQL started"
 python manage.py migrate
 gunicorn photogallery.wsgi:application \
 --workers $GUNICORN_WORKERS \
+--worker-class gthread \
+--threads ${GUNICORN_THREADS:-4} \
 --bind 0.0.0.0:8000 \
 --reload \
 --timeout 120 \